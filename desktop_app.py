@@ -1,9 +1,10 @@
+import multiprocessing
 import os
 import sys
 import threading
 import webbrowser
 import time
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, g, Response, stream_with_context
 
 if getattr(sys, 'frozen', False):
     application_path = sys._MEIPASS
@@ -12,31 +13,29 @@ else:
 
 sys.path.insert(0, application_path)
 
-from organoid_analysis import analyze_organoids as analyze_basic
-from organoid_analysis_watershed import analyze_organoids_watershed
-from organoid_analysis_hough import analyze_organoids_hough
-from organoid_analysis_morphology import analyze_organoids_morphology
-from organoid_analysis_commercial_sims import analyze_arivis_sim, analyze_assayscope_sim
-
-try:
-    from organoid_analysis_unet import analyze_organoids_unet
-    UNET_AVAILABLE = True
-except Exception as e:
-    print(f"Warning: U-Net not available. Using fallback.")
-    UNET_AVAILABLE = False
-    def analyze_organoids_unet(image_paths):
-        from organoid_analysis_unet import analyze_organoids_unet_fallback
-        return analyze_organoids_unet_fallback(image_paths)
-
-try:
-    from organoid_analysis_stardist import analyze_organoids_stardist
-    STARDIST_AVAILABLE = True
-except Exception as e:
-    print(f"Warning: StarDist not available. Using fallback.")
-    STARDIST_AVAILABLE = False
-    def analyze_organoids_stardist(image_paths):
-        from organoid_analysis_stardist import analyze_organoids_stardist_fallback
-        return analyze_organoids_stardist_fallback(image_paths)
+# Pooled analysis processes are spawned on Windows, which re-runs this module's startup in each
+# of them, so the desktop app analyzes in-process unless isolation is asked for explicitly.
+os.environ.setdefault('ORGANOID_ISOLATION', 'inline')
+
+from organoid_resources import governor
+from organoid_dispatch import attach_urls, stream_analysis, resolve_method, model_availability
+from organoid_buffers import MemoryTracker
+from organoid_workspace import Workspace
+from organoid_retention import RetentionManager
+from organoid_frames import expand_sources
+from organoid_sweep import run_sweep, parse_grid
+from organoid_sessions import SessionStore, SessionTooLarge
+from organoid_http import finalize_response
+from organoid_progressive import JobCancel, JobStore, start_progressive, preview_unavailable
+from organoid_watch import FolderWatcher
+from organoid_store import ResultStore, RESULTS_DB, query_filters
+from organoid_isolation import run_guarded, is_partial, summarize, REQUEST_BUDGET, ISOLATION, pool as isolation_pool
+from organoid_profiling import RequestProfile, profile_mode, is_admin, artifact_path, PROFILE_DIR
+from organoid_coalesce import SingleFlight, request_key
+from organoid_queue import stats as queue_stats
+from organoid_uploads import ChunkedUpload, UploadError, create_upload, iter_uploaded, upload_params
+from organoid_roi import roi_options
+from organoid_admission import AdmissionController, Overloaded, Warmup, declared_cost, estimate_cost, readiness
 
 app = Flask(__name__, 
             template_folder=os.path.join(application_path, 'templates'),
@@ -49,6 +48,7 @@ else:
 
 UPLOAD_FOLDER = os.path.join(app_root, 'static', 'uploads')
 RESULTS_FOLDER = os.path.join(app_root, 'static', 'results')
+PROFILES_FOLDER = os.path.join(app_root, PROFILE_DIR)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
@@ -56,9 +56,55 @@ app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULTS_FOLDER, exist_ok=True)
 
+# Isolated analysis workers (organoid_isolation) re-import a directly run script as __mp_main__;
+# only the server process runs the background sweeps.
+SERVER_PROCESS = __name__ != '__mp_main__'
+
+retention = RetentionManager(UPLOAD_FOLDER, RESULTS_FOLDER)
+if SERVER_PROCESS:
+    retention.start()
+
+sessions = SessionStore(upload_root=UPLOAD_FOLDER)
+if SERVER_PROCESS:
+    sessions.start()
+
+results_store = ResultStore(os.path.join(app_root, RESULTS_DB))
+if SERVER_PROCESS:
+    results_store.start()
+
+jobs = JobStore(store=results_store, upload_root=UPLOAD_FOLDER)
+coalescer = SingleFlight()
+admission = AdmissionController()
+warmup = Warmup()
+if SERVER_PROCESS:
+    warmup.start(ISOLATION)
+
+watcher = None
+watcher_lock = threading.Lock()
+
+def cleanup_folders():
+    return retention.sweep()
+
+@app.after_request
+def track_workspace_access(response):
+    prefix = '/static/uploads/jobs/'
+    if request.path.startswith(prefix):
+        retention.touch(request.path[len(prefix):].split('/', 1)[0])
+    return response
+
+@app.after_request
+def cache_and_compress(response):
+    return finalize_response(request, response, app.static_url_path + '/', app.static_folder)
+
+@app.teardown_request
+def release_workspace(exc):
+    workspace = g.pop('workspace', None)
+    if workspace is not None:
+        workspace.release()
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', watch=True)
 
 @app.route('/methods')
 def methods():
@@ -67,79 +113,146 @@ def methods():
         return send_file(methods_path)
     return "Methods explanation not found", 404
 
+@app.route('/retention')
+def retention_status():
+    return jsonify(retention.stats())
+
+@app.route('/resources')
+def resources_status():
+    return jsonify(dict(governor.stats(), isolation=isolation_pool.stats(), queue=queue_stats(),
+                        coalescing=coalescer.stats(), admission=admission.stats()))
+
+@app.route('/ready')
+def ready():
+    # For load balancers: 200 when this process takes new analyses, 503 while warming up or full.
+    body, status = readiness(admission, warmup, models=model_availability(),
+                             warm_workers=isolation_pool.stats()['idle'])
+    return jsonify(body), status
+
+def overloaded(e):
+    return jsonify(e.body()), 429, {'Retry-After': str(e.retry_after)}
+
+@app.route('/profiles/<name>')
+def download_profile(name):
+    if not is_admin(request, allow_local=True):
+        return jsonify({'error': 'Profiles are restricted to admins'}), 403
+    path = artifact_path(name, PROFILES_FOLDER)
+    if path is None:
+        return jsonify({'error': 'Unknown or expired profile'}), 404
+    return send_file(path, as_attachment=True)
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
     try:
+        if admission.saturated():
+            # Refused before the upload is read.
+            return overloaded(Overloaded("Server busy: the analysis queue is full", admission.retry_after()))
         if 'images[]' not in request.files:
             return jsonify({'error': 'No images uploaded'}), 400
         
         files = request.files.getlist('images[]')
         method = request.form.get('method', 'basic')
+        circle_mode = request.form.get('circle_mode', 'full')
+        estimate_radius = request.form.get('estimate_radius', '0') in ('1', 'true', 'on')
+        stream = request.form.get('stream', '0') in ('1', 'true', 'on')
+        # Methods whose preview is not accurate enough are analyzed at full resolution straight away,
+        # and the response says why (`preview_skipped`).
+        preview = request.form.get('preview', '0') in ('1', 'true', 'on')
+        preview_skipped = preview_unavailable(method) if preview else None
+        preview = preview and preview_skipped is None
+        output = request.form.get('output', 'image')
+        frame_step = max(1, request.form.get('frame_step', 1, type=int))
+        channel = request.form.get('channel', type=int)
+        bit_depth = request.form.get('bit_depth', type=int)
+        zstack = request.form.get('zstack', '0') in ('1', 'true', 'on')
+        projection = request.form.get('projection', 'max')
+        z_scale = request.form.get('z_scale', type=float)
+        meta = {'experiment': request.form.get('experiment'), 'well': request.form.get('well')}
+        profile = profile_mode(request.form.get('profile'))
         
         if not files or files[0].filename == '':
             return jsonify({'error': 'No selected file'}), 400
         
-        image_map = {}
-        saved_paths = []
-        
         files.sort(key=lambda x: x.filename)
+        if profile:
+            if not is_admin(request, allow_local=True):
+                return jsonify({'error': 'Profiling is restricted to admins'}), 403
+            # A profile covers one synchronous request analyzed in this process.
+            stream = preview = False
+            preview_skipped = None
 
+        workspace = Workspace(UPLOAD_FOLDER)
+        g.workspace = workspace
         for i, file in enumerate(files):
             if file and file.filename:
-                filename = file.filename
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
                 try:
-                    file.save(filepath)
-                    day_label = i + 1
-                    image_map[day_label] = filepath
-                    saved_paths.append(filepath)
+                    workspace.save_upload(file, i + 1)
                 except Exception as e:
-                    print(f"Error saving file {filename}: {e}")
-                    return jsonify({'error': f'Failed to save file {filename}: {str(e)}'}), 500
+                    workspace.discard()
+                    print(f"Error saving file {file.filename}: {e}")
+                    return jsonify({'error': f'Failed to save file {file.filename}: {str(e)}'}), 500
+
+        workspace.finalize()
+        image_map = workspace.image_map()
 
         if not image_map:
+            workspace.discard()
             return jsonify({'error': 'No valid images were uploaded'}), 400
 
-        print(f"Running {method} analysis on {len(saved_paths)} images...")
-        
-        try:
-            if method == 'watershed':
-                results = analyze_organoids_watershed(image_map)
-                debug_subfolder = 'debug_output_watershed'
-            elif method == 'hough':
-                results = analyze_organoids_hough(image_map)
-                debug_subfolder = 'debug_output_hough'
-            elif method == 'stardist':
-                results = analyze_organoids_stardist(image_map)
-                if isinstance(results, dict) and "error" in results:
-                    return jsonify({'error': results["error"]}), 500
-                debug_subfolder = 'debug_output_stardist'
-            elif method == 'morphology':
-                results = analyze_organoids_morphology(image_map)
-                debug_subfolder = 'debug_output_morphology'
-            elif method == 'arivis':
-                results = analyze_arivis_sim(image_map)
-                debug_subfolder = 'debug_output_arivis'
-            elif method == 'assayscope':
-                results = analyze_assayscope_sim(image_map)
-                debug_subfolder = 'debug_output_assayscope'
-            elif method == 'unet':
-                results = analyze_organoids_unet(image_map)
-                if isinstance(results, dict) and "error" in results:
-                    return jsonify({'error': results["error"]}), 500
-                debug_subfolder = 'debug_output_unet'
-            else:
-                results = analyze_organoids_basic_wrapper(image_map)
-                debug_subfolder = 'debug_output'
-            
-            if results is None:
-                return jsonify({'error': 'Analysis returned None. Please check your images and try again.'}), 500
-            
-            if not isinstance(results, list):
-                return jsonify({'error': f'Analysis returned invalid format. Expected list, got {type(results)}'}), 500
+        origins = {}
+        source_args = {'step': frame_step, 'channel': channel, 'bit_depth': bit_depth, 'zstack': zstack,
+                       'projection': projection, 'z_scale': z_scale}
+        sources = expand_sources(image_map, origins=origins, **source_args)
+        options = {'circle_mode': circle_mode, 'estimate_radius': estimate_radius, 'output': output,
+                   **roi_options(request.form.get('roi'), **meta)}
+        cost = estimate_cost(resolve_method(method), image_map, **source_args)
+
+        if stream:
+            try:
+                ticket = admission.admit(cost)
+            except Overloaded as e:
+                workspace.discard()
+                return overloaded(e)
+            response = Response(stream_with_context(stream_analysis(method, sources, origins, workspace, options,
+                                                                    results_store, meta)),
+                                mimetype='application/x-ndjson')
+            response.call_on_close(ticket.release)
+            return response
+
+        if preview:
+            # The preview is answered right away; the full run waits its turn in the background job.
+            try:
+                ticket = admission.reserve(cost)
+            except Overloaded as e:
+                workspace.discard()
+                return overloaded(e)
+            response = start_progressive(jobs, method, workspace, expand_sources(image_map, **source_args),
+                                         sources, origins, options, meta, admission=ticket)
+            if 'error' in response:
+                ticket.release()
+                return jsonify({'error': response['error']}), 500
+            g.pop('workspace', None)  # released by the background job
+            return jsonify(response)
+
+        print(f"Running {method} analysis on {len(image_map)} uploads...")
+
+        def compute():
+            try:
+                ticket = admission.admit(cost)
+            except Overloaded as e:
+                return e.body(), 429
+            with ticket, governor.request_slot() as threads, MemoryTracker() as mem, \
+                    RequestProfile(profile, f"{method} analysis of {len(image_map)} uploads ({workspace.id})",
+                                   PROFILES_FOLDER) as prof:
+                # Profiled requests analyze inline, where the profiler can see the analyzer code.
+                results, images = run_guarded(method, sources, options, threads=threads, budget=REQUEST_BUDGET,
+                                              isolation='inline' if profile else ISOLATION, memory=mem)
             
             if len(results) == 0:
-                return jsonify({'error': 'Analysis returned no results. Please check your images and try again.'}), 500
+                failed = [i for i in images if 'error' in i]
+                if failed:
+                    return {'error': failed[0]['error'], 'images': images}, 500
+                return {'error': 'Analysis returned no results. Please check your images and try again.'}, 500
                 
             processed_results = []
             for res in results:
@@ -151,42 +264,44 @@ def analyze():
                     print(f"Warning: Result missing 'day' field: {res}")
                     continue
                     
-                day = res['day']
-                
-                if method == 'watershed':
-                    debug_name = f"watershed_debug_day{day}.jpg"
-                elif method == 'hough':
-                    debug_name = f"hough_debug_day{day}.jpg"
-                elif method == 'stardist':
-                    debug_name = f"stardist_debug_day{day}.jpg"
-                elif method == 'morphology':
-                    debug_name = f"morphology_debug_day{day}.jpg"
-                elif method == 'arivis':
-                    debug_name = f"arivis_debug_day{day}.jpg"
-                elif method == 'assayscope':
-                    debug_name = f"assayscope_debug_day{day}.jpg"
-                elif method == 'unet':
-                    debug_name = f"unet_debug_day{day}.jpg"
-                else:
-                    debug_name = f"debug_day{day}.jpg"
-
-                debug_url = f"/static/uploads/{debug_subfolder}/{debug_name}"
-                
-                orig_filename = os.path.basename(image_map.get(day, ''))
-                orig_url = f"/static/uploads/{orig_filename}"
-
-                res['original_url'] = orig_url
-                res['debug_url'] = debug_url
+                attach_urls(res, method, workspace, origins)
                 processed_results.append(res)
             
             if len(processed_results) == 0:
-                return jsonify({'error': 'No valid results after processing. Please check your images.'}), 500
+                return {'error': 'No valid results after processing. Please check your images.'}, 500
+
+            results_store.record(workspace.id, method, processed_results, images, **meta)
                 
-            return jsonify({
+            return {
                 'success': True,
                 'method': method,
-                'results': processed_results
-            })
+                'workspace': workspace.id,
+                'results': processed_results,
+                'images': images,
+                'image_status': summarize(images),
+                'partial': is_partial(images),
+                'memory': mem.report(),
+                'threads': threads,
+                'profile': prof.info() if prof.enabled else None
+            }, 200
+
+        try:
+            if profile:
+                body, status = compute()
+            else:
+                # Identical requests already running are joined instead of analyzed again; the
+                # joiner's uploads are dropped and its response points at the first request's files.
+                key = request_key(workspace.digest, method, options=options, sources=source_args)
+                (body, status), shared = coalescer.do(key, compute)
+                if shared:
+                    workspace.discard()
+                body = dict(body, coalesced=shared)
+            if preview_skipped and status == 200:
+                body = dict(body, preview=False, preview_skipped=preview_skipped)
+            if status == 429:
+                workspace.discard()
+                return jsonify(body), status, {'Retry-After': str(body['retry_after'])}
+            return jsonify(body), status
 
         except Exception as e:
             import traceback
@@ -208,14 +323,316 @@ def analyze():
             'details': error_trace.split('\n')[-2] if len(error_trace.split('\n')) > 1 else None
         }), 500
 
-def analyze_organoids_basic_wrapper(image_map):
-    return analyze_basic(image_map)
+@app.route('/analyze/<job_id>')
+def analyze_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    state = job.state()
+    if job.status == 'error':
+        return jsonify(state), 500
+    return jsonify(state), 202 if job.status == 'running' else 200
+
+@app.route('/analyze/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    job.cancel()
+    return jsonify(job.state())
+
+@app.route('/uploads', methods=['POST'])
+def create_upload_session():
+    # A chunked, resumable alternative to /analyze for large sets: declare the files (name, size,
+    # sha256) and the analysis options as JSON, then PUT each file's bytes in order. The analysis
+    # is a background job (polled at /analyze/<job>) that takes each file as soon as it arrives.
+    body = request.get_json(silent=True) or {}
+    try:
+        method, options, source_args, meta = upload_params(body)
+        workspace = create_upload(UPLOAD_FOLDER, body.get('files'))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    upload = ChunkedUpload.load(UPLOAD_FOLDER, workspace.id)
+    # Queued like a preview's full run: the files arrive while the job waits for its turn.
+    try:
+        ticket = admission.reserve(declared_cost(resolve_method(method), upload.files))
+    except Overloaded as e:
+        workspace.discard()
+        return overloaded(e)
+    origins = {}
+    cancelled = JobCancel()
+    job = jobs.submit(method, workspace, iter_uploaded(upload, cancelled, origins, **source_args), origins, options,
+                      meta, cancelled=cancelled, admission=ticket)
+    workspace.write_manifest(job=job.id)
+    upload.job = job.id
+    return jsonify(dict(upload.state(), success=True, method=method)), 201
+
+@app.route('/uploads/<upload_id>')
+def upload_status(upload_id):
+    upload = ChunkedUpload.load(UPLOAD_FOLDER, upload_id)
+    if upload is None:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    return jsonify(upload.state())
+
+@app.route('/uploads/<upload_id>/files/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    upload = ChunkedUpload.load(UPLOAD_FOLDER, upload_id)
+    if upload is None:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        offset = request.args.get('offset', type=int)
+    try:
+        return jsonify(upload.write_chunk(index, offset, request.stream))
+    except UploadError as e:
+        return jsonify(dict(e.details, error=str(e))), e.status
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    upload = ChunkedUpload.load(UPLOAD_FOLDER, upload_id)
+    if upload is None:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    upload.discard()
+    return jsonify({'success': True})
+
+@app.route('/sweep', methods=['POST'])
+def sweep():
+    try:
+        if admission.saturated():
+            return overloaded(Overloaded("Server busy: the analysis queue is full", admission.retry_after()))
+        if 'images[]' not in request.files:
+            return jsonify({'error': 'No images uploaded'}), 400
+
+        files = request.files.getlist('images[]')
+        method = request.form.get('method', 'watershed')
+        grid = request.form.get('grid', '{}')
+        frame_step = max(1, request.form.get('frame_step', 1, type=int))
+        channel = request.form.get('channel', type=int)
+        bit_depth = request.form.get('bit_depth', type=int)
+
+        if not files or files[0].filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+
+        try:
+            parse_grid(method, grid)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        files.sort(key=lambda x: x.filename)
+
+        workspace = Workspace(UPLOAD_FOLDER)
+        g.workspace = workspace
+        for i, file in enumerate(files):
+            if file and file.filename:
+                try:
+                    workspace.save_upload(file, i + 1)
+                except Exception as e:
+                    workspace.discard()
+                    print(f"Error saving file {file.filename}: {e}")
+                    return jsonify({'error': f'Failed to save file {file.filename}: {str(e)}'}), 500
+
+        workspace.finalize()
+        image_map = workspace.image_map()
+        sources = expand_sources(image_map, step=frame_step, channel=channel, bit_depth=bit_depth)
+        # The grid points reuse each image's intermediates, so a sweep costs about one analysis.
+        try:
+            ticket = admission.admit(estimate_cost(method, image_map, step=frame_step))
+        except Overloaded as e:
+            workspace.discard()
+            return overloaded(e)
+
+        with ticket, governor.request_slot() as threads:
+            table = run_sweep(method, sources, grid)
+        table.update({'success': True, 'workspace': workspace.id, 'threads': threads})
+        return jsonify(table)
+
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        print(f"Sweep Error: {e}")
+        print(f"Traceback:\n{error_trace}")
+        return jsonify({
+            'error': f'Sweep failed: {str(e)}',
+            'details': error_trace.split('\n')[-2] if len(error_trace.split('\n')) > 1 else None
+        }), 500
+
+@app.route('/session', methods=['POST'])
+def create_session():
+    if admission.saturated():
+        return overloaded(Overloaded("Server busy: the analysis queue is full", admission.retry_after()))
+    if 'images[]' not in request.files:
+        return jsonify({'error': 'No images uploaded'}), 400
+
+    files = request.files.getlist('images[]')
+    method = request.form.get('method', 'watershed')
+    frame_step = max(1, request.form.get('frame_step', 1, type=int))
+    channel = request.form.get('channel', type=int)
+    bit_depth = request.form.get('bit_depth', type=int)
+
+    if not files or files[0].filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    files.sort(key=lambda x: x.filename)
+
+    # The session keeps the decoded images in memory; the uploads stay in the workspace so other
+    # server processes can rebuild it.
+    workspace = Workspace(UPLOAD_FOLDER)
+    source_args = {'step': frame_step, 'channel': channel, 'bit_depth': bit_depth}
+    try:
+        for i, file in enumerate(files):
+            if file:
+                workspace.save_upload(file, i + 1)
+        workspace.finalize()
+        image_map = workspace.image_map()
+        sources = expand_sources(image_map, **source_args)
+        # Decoding the images and the default segmentation cost about one analysis.
+        ticket = admission.admit(estimate_cost(method, image_map, step=frame_step))
+        with ticket, governor.request_slot():
+            session, initial = sessions.create(method, sources, workspace, source_args)
+    except Overloaded as e:
+        workspace.discard()
+        return overloaded(e)
+    except SessionTooLarge as e:
+        workspace.discard()
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        workspace.discard()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        workspace.discard()
+        print(f"Session Error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    initial.update({'success': True, 'expires_in': sessions.ttl_seconds})
+    return jsonify(initial)
+
+@app.route('/session/<session_id>', methods=['POST'])
+def update_session(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found or expired'}), 404
+    try:
+        result = session.update(request.get_json(silent=True) or request.form.to_dict())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    result['success'] = True
+    return jsonify(result)
+
+@app.route('/session/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    if not sessions.delete(session_id):
+        return jsonify({'error': 'Session not found or expired'}), 404
+    return jsonify({'success': True})
+
+@app.route('/results')
+def results_status():
+    return jsonify(results_store.stats())
+
+@app.route('/results/runs')
+def results_runs():
+    if not results_store.enabled:
+        return jsonify({'error': 'Results store is disabled'}), 404
+    started = time.perf_counter()
+    runs = results_store.runs(limit=request.args.get('limit', 100, type=int),
+                              offset=request.args.get('offset', 0, type=int), **query_filters(request.args))
+    return jsonify({'runs': runs, 'query_ms': round((time.perf_counter() - started) * 1000, 2)})
+
+@app.route('/results/runs/<run_key>')
+def results_run(run_key):
+    if not results_store.enabled:
+        return jsonify({'error': 'Results store is disabled'}), 404
+    run = results_store.run(run_key, with_objects=request.args.get('objects', '0') in ('1', 'true', 'on'))
+    if run is None:
+        return jsonify({'error': 'Unknown run'}), 404
+    return jsonify(run)
+
+@app.route('/results/aggregate')
+def results_aggregate():
+    if not results_store.enabled:
+        return jsonify({'error': 'Results store is disabled'}), 404
+    started = time.perf_counter()
+    group_by = request.args.get('group_by', 'experiment,method').split(',')
+    rows = results_store.aggregate(group_by, **query_filters(request.args))
+    return jsonify({'groups': rows, 'query_ms': round((time.perf_counter() - started) * 1000, 2)})
+
+@app.route('/results/objects')
+def results_objects():
+    if not results_store.enabled:
+        return jsonify({'error': 'Results store is disabled'}), 404
+    started = time.perf_counter()
+    histogram = results_store.objects(bins=max(1, min(200, request.args.get('bins', 20, type=int))),
+                                      max_area=request.args.get('max_area', type=float), **query_filters(request.args))
+    return jsonify(dict(histogram, query_ms=round((time.perf_counter() - started) * 1000, 2)))
+
+@app.route('/sessions')
+def sessions_status():
+    return jsonify(sessions.stats())
+
+def start_watcher(folder, method='basic', output='image', circle_mode='full', estimate_radius=False,
+                  frame_step=1, include_existing=False, experiment=None, well=None, roi=None):
+    global watcher
+    with watcher_lock:
+        if watcher is not None:
+            watcher.stop()
+        options = {'circle_mode': circle_mode, 'estimate_radius': estimate_radius, 'output': output,
+                   **roi_options(roi, experiment, well)}
+        watcher = FolderWatcher(folder, method, UPLOAD_FOLDER, options=options, source_args={'step': frame_step},
+                                include_existing=include_existing, store=results_store,
+                                meta={'experiment': experiment, 'well': well}).start()
+        print(f"Watching {watcher.folder} ({watcher.backend}) with {watcher.method}")
+        return watcher
+
+@app.route('/watch', methods=['POST'])
+def watch_start():
+    try:
+        folder = request.form.get('folder', '').strip()
+        if not folder:
+            return jsonify({'error': 'No folder given'}), 400
+        started = start_watcher(
+            os.path.expanduser(folder),
+            method=request.form.get('method', 'basic'),
+            output=request.form.get('output', 'image'),
+            circle_mode=request.form.get('circle_mode', 'full'),
+            estimate_radius=request.form.get('estimate_radius', '0') in ('1', 'true', 'on'),
+            frame_step=max(1, request.form.get('frame_step', 1, type=int)),
+            include_existing=request.form.get('include_existing', '0') in ('1', 'true', 'on'),
+            experiment=request.form.get('experiment'),
+            well=request.form.get('well'),
+            roi=request.form.get('roi'),
+        )
+        return jsonify(started.status())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        print(f"Watch Error: {e}")
+        print(f"Traceback:\n{error_trace}")
+        return jsonify({'error': f'Could not start watching: {str(e)}'}), 500
+
+@app.route('/watch')
+def watch_status():
+    current = watcher
+    if current is None:
+        return jsonify({'running': False})
+    return jsonify(current.status(since=request.args.get('since', 0, type=int)))
+
+@app.route('/watch', methods=['DELETE'])
+def watch_stop():
+    current = watcher
+    if current is None:
+        return jsonify({'running': False})
+    current.stop()
+    return jsonify(current.status(since=current.status()['total']))
 
 def open_browser(port_num):
     time.sleep(1.5)
     webbrowser.open(f'http://127.0.0.1:{port_num}')
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     port = int(os.environ.get('PORT', 5000))
+    if os.environ.get('ORGANOID_WATCH_DIR'):
+        start_watcher(os.environ['ORGANOID_WATCH_DIR'], method=os.environ.get('ORGANOID_WATCH_METHOD', 'basic'))
     threading.Thread(target=open_browser, args=(port,), daemon=True).start()
     app.run(host='127.0.0.1', port=port, debug=False, use_reloader=False)
@@ -17,6 +17,31 @@ a = Analysis(
         ('organoid_analysis_stardist.py', '.'),
         ('organoid_analysis_unet.py', '.'),
         ('organoid_analysis_cellpose.py', '.'),
+        ('organoid_circles.py', '.'),
+        ('organoid_buffers.py', '.'),
+        ('organoid_workspace.py', '.'),
+        ('organoid_retention.py', '.'),
+        ('organoid_resources.py', '.'),
+        ('organoid_microscopy.py', '.'),
+        ('organoid_frames.py', '.'),
+        ('organoid_zstack.py', '.'),
+        ('organoid_sweep.py', '.'),
+        ('organoid_sessions.py', '.'),
+        ('organoid_vectors.py', '.'),
+        ('organoid_http.py', '.'),
+        ('organoid_progressive.py', '.'),
+        ('organoid_unet_runtime.py', '.'),
+        ('organoid_watch.py', '.'),
+        ('organoid_isolation.py', '.'),
+        ('organoid_shm.py', '.'),
+        ('organoid_store.py', '.'),
+        ('organoid_profiling.py', '.'),
+        ('organoid_coalesce.py', '.'),
+        ('organoid_queue.py', '.'),
+        ('organoid_uploads.py', '.'),
+        ('organoid_roi.py', '.'),
+        ('organoid_admission.py', '.'),
+        ('organoid_dispatch.py', '.'),
     ],
     hiddenimports=[
         'flask',
@@ -32,6 +57,31 @@ a = Analysis(
         'organoid_analysis_stardist',
         'organoid_analysis_unet',
         'organoid_analysis_cellpose',
+        'organoid_circles',
+        'organoid_buffers',
+        'organoid_workspace',
+        'organoid_retention',
+        'organoid_resources',
+        'organoid_microscopy',
+        'organoid_frames',
+        'organoid_zstack',
+        'organoid_sweep',
+        'organoid_sessions',
+        'organoid_vectors',
+        'organoid_http',
+        'organoid_progressive',
+        'organoid_unet_runtime',
+        'organoid_watch',
+        'organoid_isolation',
+        'organoid_shm',
+        'organoid_store',
+        'organoid_profiling',
+        'organoid_coalesce',
+        'organoid_queue',
+        'organoid_uploads',
+        'organoid_roi',
+        'organoid_admission',
+        'organoid_dispatch',
     ],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,9 @@
+import os
+
+# Loaded by gunicorn from the working directory whatever the command line. organoid_resources
+# divides the cores (and organoid_admission the memory) by the number of worker processes, which
+# it reads from ORGANOID_WORKERS; a worker cannot see gunicorn's -w otherwise. post_fork runs in
+# each worker before app.py is imported.
+
+def post_fork(server, worker):
+    os.environ.setdefault('ORGANOID_WORKERS', str(server.num_workers))
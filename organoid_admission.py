@@ -0,0 +1,397 @@
+import math
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from organoid_frames import is_video
+from organoid_microscopy import MicroscopyImage, is_tiff
+from organoid_resources import governor, worker_processes
+
+# Cost of a request in work units: megapixels analyzed (every frame of a stack or video) times the
+# method's weight below. Units allowed to run at once in this server process; 0 admits everything.
+ADMISSION_BUDGET = float(os.environ.get('ORGANOID_ADMISSION_BUDGET', str(50 * governor.budget)))
+# Units allowed to wait for the budget; beyond that requests are refused with 429.
+ADMISSION_QUEUE = float(os.environ.get('ORGANOID_ADMISSION_QUEUE', str(4 * ADMISSION_BUDGET)))
+# Longest a synchronous or streamed request waits in the queue before it gets 429 after all.
+ADMISSION_WAIT = float(os.environ.get('ORGANOID_ADMISSION_WAIT', '30'))
+# Free memory (MemAvailable) that admitting a request must leave untouched.
+MEMORY_RESERVE_MB = float(os.environ.get('ORGANOID_ADMISSION_RESERVE_MB', '512'))
+# Comma-separated methods analyzed once on a small synthetic image at startup, so the first real
+# request does not pay for imports and model loading. /ready answers 503 until they are done.
+WARMUP_METHODS = tuple(m.strip() for m in os.environ.get('ORGANOID_WARMUP', '').split(',') if m.strip())
+
+# method -> (work per megapixel relative to basic, peak working memory in MB per megapixel).
+# Deep-learning methods run float tensors and a model; Cellpose is listed for when it is dispatched.
+METHOD_WEIGHTS = {
+    'basic': (1, 12),
+    'hough': (2, 12),
+    'assayscope': (2, 12),
+    'watershed': (4, 24),
+    'morphology': (4, 24),
+    'arivis': (4, 24),
+    'unet': (8, 48),
+    'stardist': (10, 64),
+    'cellpose': (20, 96),
+}
+# Assumed throughput until requests have completed here (about 0.05 s per basic megapixel).
+DEFAULT_UNITS_PER_SECOND = 20
+MAX_RETRY_AFTER = 300
+WAIT_POLL = 0.2
+
+def _memory_budget_mb():
+    # This process's share of the machine's (or container's) memory, or None when unknown.
+    value = os.environ.get('ORGANOID_ADMISSION_MEMORY_MB')
+    if value:
+        return float(value)
+    total = None
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            total = int(limit)
+    except (OSError, ValueError):
+        pass
+    if total is None:
+        try:
+            total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
+    return total / 2 ** 20 * 0.7 / worker_processes()
+
+def available_memory_mb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>xHH', f.read(5))
+            return width, height
+        f.seek(length - 2, 1)
+
+def image_dimensions(path, step=1):
+    # (width, height, frames) from the file header where possible, without decoding the pixels.
+    if is_tiff(path):
+        with MicroscopyImage(path) as stack:
+            return stack.shape[stack.axes.index('X')], stack.shape[stack.axes.index('Y')], stack.planes
+    if is_video(path):
+        cap = cv2.VideoCapture(path)
+        try:
+            frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or 1
+            return (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    math.ceil(frames / max(1, step)))
+        finally:
+            cap.release()
+    with open(path, 'rb') as f:
+        head = f.read(26)
+        if head.startswith(b'\x89PNG'):
+            return struct.unpack('>II', head[16:24]) + (1,)
+        if head.startswith(b'\xff\xd8'):
+            size = _jpeg_size(f)
+            if size is not None:
+                return size + (1,)
+        if head.startswith(b'BM'):
+            width, height = struct.unpack('<ii', head[18:26])
+            return width, abs(height), 1
+    # Other formats: decode at 1/8 scale, which is cheap for most codecs.
+    small = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if small is None:
+        return 0, 0, 1
+    return small.shape[1] * 8, small.shape[0] * 8, 1
+
+class Cost:
+    __slots__ = ('method', 'images', 'megapixels', 'work', 'memory_mb')
+
+    def __init__(self, method, images, megapixels, largest):
+        weight, memory = METHOD_WEIGHTS.get(method, METHOD_WEIGHTS['basic'])
+        self.method = method
+        self.images = images
+        self.megapixels = megapixels
+        self.work = megapixels * weight
+        # Frames are analyzed one at a time, so the largest one sets the peak.
+        self.memory_mb = largest * memory
+
+    def info(self):
+        return {'method': self.method, 'images': self.images, 'megapixels': round(self.megapixels, 1),
+                'work': round(self.work, 1), 'memory_mb': round(self.memory_mb)}
+
+def estimate_cost(method, image_map, step=1, zstack=False, **_):
+    # Cost of analyzing a {day: path} map with `method` (already resolved); takes /analyze's source
+    # arguments. Unreadable files cost nothing; the analysis reports them.
+    images, megapixels, largest = 0, 0.0, 0.0
+    for path in image_map.values():
+        try:
+            width, height, frames = image_dimensions(path, step)
+        except Exception:
+            continue
+        if is_tiff(path) and not zstack:
+            frames = math.ceil(frames / max(1, step))
+        mp = width * height / 1e6
+        images += frames
+        megapixels += mp * frames
+        largest = max(largest, mp)
+    return Cost(method, images, megapixels, largest)
+
+def declared_cost(method, files):
+    # Cost of a chunked upload whose bytes have not arrived yet, from the declared file sizes at one
+    # byte per pixel: exact for 8-bit planes, high for compressed images, low for 16-bit stacks.
+    sizes = [entry['size'] / 1e6 for entry in files]
+    return Cost(method, len(sizes), sum(sizes), max(sizes, default=0.0))
+
+class Overloaded(ValueError):
+    def __init__(self, message, retry_after, **details):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.details = details
+
+    def body(self):
+        return dict(self.details, error=str(self), retry_after=self.retry_after)
+
+class Ticket:
+    # A request's place in the admission controller: 'queued', then 'running' once its cost fits,
+    # then 'done' after release(). Also a context manager that releases on exit.
+    def __init__(self, controller, cost):
+        self.controller = controller
+        self.cost = cost
+        self.state = 'queued'
+        self.queued_at = time.monotonic()
+        self.started = None
+
+    def wait(self, timeout=None, cancel=None):
+        # True once admitted; False after `timeout` seconds or when `cancel` is set.
+        return self.controller._wait(self, timeout, cancel)
+
+    def release(self):
+        self.controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+    # Admits requests while the work and peak memory of those running fit the budgets, and queues
+    # the rest in arrival order up to a queue budget; later arrivals are refused with an estimate
+    # of when to retry. A request that does not fit even an idle server still runs, alone.
+    def __init__(self, budget=ADMISSION_BUDGET, queue_budget=ADMISSION_QUEUE, memory_mb=None,
+                 reserve_mb=MEMORY_RESERVE_MB):
+        self.budget = budget
+        self.queue_budget = queue_budget
+        self.memory_mb = _memory_budget_mb() if memory_mb is None else memory_mb
+        self.reserve_mb = reserve_mb
+        self.running = []
+        self.queue = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.memory_waits = 0
+        # Work finished and the time anything was running, for the Retry-After estimate.
+        self.work_done = 0.0
+        self.busy_seconds = 0.0
+        self._busy_since = None
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def _work(self, tickets):
+        return sum(t.cost.work for t in tickets)
+
+    def _fits(self, cost):
+        if not self.running:
+            return True
+        if self._work(self.running) + cost.work > self.budget:
+            return False
+        if self.memory_mb is not None and sum(t.cost.memory_mb for t in self.running) + cost.memory_mb > self.memory_mb:
+            return False
+        free = available_memory_mb()
+        if free is not None and free - cost.memory_mb < self.reserve_mb:
+            self.memory_waits += 1
+            return False
+        return True
+
+    def _start(self, ticket):
+        if not self.running:
+            self._busy_since = time.monotonic()
+        ticket.state = 'running'
+        ticket.started = time.monotonic()
+        self.running.append(ticket)
+        self.admitted += 1
+
+    def _promote(self):
+        # Strictly first come, first served, so a large request is not starved by small ones.
+        while self.queue and self._fits(self.queue[0].cost):
+            self._start(self.queue.popleft())
+        self._cond.notify_all()
+
+    def reserve(self, cost):
+        # A running or queued Ticket for `cost`; raises Overloaded when the queue is full.
+        ticket = Ticket(self, cost)
+        with self._cond:
+            if not self.enabled or (not self.queue and self._fits(cost)):
+                self._start(ticket)
+            elif self._work(self.queue) + cost.work <= self.queue_budget or not self.queue:
+                self.queue.append(ticket)
+                self.queued += 1
+            else:
+                self.rejected += 1
+                raise Overloaded(f"Server busy: {len(self.queue)} requests already waiting", self._retry_after(cost.work),
+                                 queue_depth=len(self.queue), cost=cost.info())
+        return ticket
+
+    def admit(self, cost, timeout=ADMISSION_WAIT, cancel=None):
+        # reserve() and wait up to `timeout` seconds to run; Overloaded if it does not get to.
+        ticket = self.reserve(cost)
+        if ticket.wait(timeout, cancel):
+            return ticket
+        ticket.release()
+        with self._cond:
+            self.timed_out += 1
+            retry_after = self._retry_after(cost.work)
+        raise Overloaded(f"Server busy: no capacity within {timeout:g} s", retry_after,
+                         queue_depth=len(self.queue), cost=cost.info())
+
+    def _wait(self, ticket, timeout, cancel):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while ticket.state == 'queued':
+                if cancel is not None and cancel.is_set():
+                    return False
+                remaining = WAIT_POLL if deadline is None else min(WAIT_POLL, deadline - time.monotonic())
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+                # Memory freed outside the controller is only noticed by looking again.
+                self._promote()
+            return ticket.state == 'running'
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.state == 'running':
+                self.running.remove(ticket)
+                self.work_done += ticket.cost.work
+                if not self.running:
+                    self.busy_seconds += time.monotonic() - self._busy_since
+            elif ticket.state == 'queued':
+                self.queue.remove(ticket)
+            else:
+                return
+            ticket.state = 'done'
+            self._promote()
+
+    def _retry_after(self, work=0.0):
+        # Seconds until the work ahead (running, queued, plus `work`) has drained below the budget,
+        # at the throughput measured while busy.
+        busy = self.busy_seconds + (time.monotonic() - self._busy_since if self.running else 0)
+        rate = self.work_done / busy if self.work_done and busy else DEFAULT_UNITS_PER_SECOND
+        ahead = self._work(self.running) + self._work(self.queue) + work - self.budget
+        return int(min(MAX_RETRY_AFTER, max(1, math.ceil(ahead / rate))))
+
+    def retry_after(self):
+        with self._cond:
+            return self._retry_after()
+
+    def saturated(self):
+        # No room left in the queue, so any request would be refused; checked before reading an upload.
+        with self._cond:
+            return self.enabled and bool(self.queue) and self._work(self.queue) >= self.queue_budget
+
+    def stats(self):
+        with self._cond:
+            return {'enabled': self.enabled, 'budget': self.budget, 'queue_budget': self.queue_budget,
+                    'memory_budget_mb': None if self.memory_mb is None else round(self.memory_mb),
+                    'available_memory_mb': available_memory_mb(),
+                    'running': len(self.running), 'running_work': round(self._work(self.running), 1),
+                    'queue_depth': len(self.queue), 'queued_work': round(self._work(self.queue), 1),
+                    'admitted': self.admitted, 'queued': self.queued, 'rejected': self.rejected,
+                    'timed_out': self.timed_out, 'memory_waits': self.memory_waits,
+                    'retry_after': self._retry_after()}
+
+def _warmup_image():
+    img = np.full((256, 256), 180, np.uint8)
+    for x, y, r in ((70, 80, 18), (170, 100, 25), (120, 190, 14)):
+        cv2.circle(img, (x, y), r, 90, -1)
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+class Warmup:
+    # Runs each of `methods` once on a small synthetic image through the app's isolation mode, so
+    # TensorFlow/StarDist and the models are loaded (in the pooled worker with 'process' isolation)
+    # before traffic arrives. In 'queue' mode the standalone workers do the analysis; nothing to warm.
+    def __init__(self, methods=WARMUP_METHODS):
+        self.methods = {m: {'status': 'pending'} for m in methods}
+        self._lock = threading.Lock()
+
+    def start(self, isolation):
+        if not self.methods:
+            return self
+        threading.Thread(target=self._run, args=(isolation,), name='organoid-warmup', daemon=True).start()
+        return self
+
+    def _run(self, isolation):
+        from organoid_frames import Frame
+        from organoid_isolation import run_guarded
+
+        work_dir = tempfile.mkdtemp(prefix='organoid-warmup-')
+        try:
+            for method in self.methods:
+                started = time.perf_counter()
+                if isolation == 'queue':
+                    status = 'skipped'
+                else:
+                    try:
+                        _, images = run_guarded(method, [(1, Frame(_warmup_image(), os.path.join(work_dir, method)))],
+                                                {'output': 'vector', 'roi': 'off'}, isolation=isolation)
+                        status = 'warm' if images and images[0]['status'] in ('ok', 'empty') else 'error'
+                    except Exception as e:
+                        print(f"Warm-up of {method} failed: {e}")
+                        status = 'error'
+                with self._lock:
+                    self.methods[method] = {'status': status, 'seconds': round(time.perf_counter() - started, 2)}
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    @property
+    def done(self):
+        with self._lock:
+            return all(m['status'] != 'pending' for m in self.methods.values())
+
+    def stats(self):
+        with self._lock:
+            return {m: dict(s) for m, s in self.methods.items()}
+
+def readiness(admission, warmup, **extra):
+    # (body, status) for a load balancer: 503 while warming up or while the queue is full.
+    reasons = []
+    if not warmup.done:
+        reasons.append('warming up')
+    if admission.saturated():
+        reasons.append('queue full')
+    stats = admission.stats()
+    body = {'ready': not reasons, 'reasons': reasons, 'queue_depth': stats['queue_depth'],
+            'queued_work': stats['queued_work'], 'running': stats['running'], 'running_work': stats['running_work'],
+            'budget': stats['budget'], 'retry_after': stats['retry_after'], 'warmup': warmup.stats()}
+    body.update(extra)
+    return body, 200 if not reasons else 503
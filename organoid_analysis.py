@@ -1,28 +1,24 @@
 import cv2
 import numpy as np
 import os
+from organoid_buffers import get_pool
+from organoid_frames import iter_images
+from organoid_vectors import Overlay
 
-def analyze_organoids(image_paths):
+def analyze_organoids(image_paths, output='image', scale=1.0):
     results = []
 
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            print(f"Error: {img_path} not found.")
-            continue
+    for day, img_path, img in iter_images(image_paths):
+        pool = get_pool()
 
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"Error: Could not read {img_path}")
-            continue
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=pool.get('gray', img.shape[:2]))
 
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=gray)
 
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-
-        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=blurred)
 
         if cv2.countNonZero(thresh) > (thresh.size / 2):
-            thresh = cv2.bitwise_not(thresh)
+            thresh = cv2.bitwise_not(thresh, dst=thresh)
 
         contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -30,15 +26,15 @@ def analyze_organoids(image_paths):
         valid_contours = []
         for cnt in contours:
             area = cv2.contourArea(cnt)
-            if area > 100: 
+            if area > 100 * scale ** 2:
                 organoid_areas.append(area)
                 valid_contours.append(cnt)
         
-        debug_img = img.copy()
-        cv2.drawContours(debug_img, valid_contours, -1, (0, 255, 0), 2)
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"debug_day{day}.jpg"), debug_img)
+        overlay = Overlay(img, output, pool)
+        overlay.contours(valid_contours, (0, 255, 0), 2)
+        for cnt, area in zip(valid_contours, organoid_areas):
+            overlay.measure(cnt, area)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output"), f"debug_day{day}.jpg", img_path)
 
         count = len(organoid_areas)
         avg_size = float(np.mean(organoid_areas)) if organoid_areas else 0.0
@@ -46,13 +42,13 @@ def analyze_organoids(image_paths):
         
         h, w = img.shape[:2]
 
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(count),
             "avg_size": avg_size,
             "total_area": total_area,
             "resolution": f"{w}x{h}"
-        })
+        }))
 
     return results
 
@@ -3,25 +3,18 @@ import os
 import cv2
 from cellpose import models
 import time
+from organoid_frames import iter_images
+from organoid_vectors import Overlay
 
-def analyze_organoids_cellpose(image_paths):
+def analyze_organoids_cellpose(image_paths, output='image'):
     print("Loading Cellpose model (cyto2)...")
     model = models.Cellpose(gpu=False, model_type='cyto2')
     
     results = []
 
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            print(f"Error: {img_path} not found.")
-            continue
-
+    for day, img_path, img in iter_images(image_paths):
         print(f"Processing {img_path}...")
         
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"Error: Could not read {img_path}")
-            continue
-            
         img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         masks, flows, styles, diams = model.eval(
@@ -46,26 +39,26 @@ def analyze_organoids_cellpose(image_paths):
         avg_size = np.mean(organoid_areas) if organoid_areas else 0
         total_area = np.sum(organoid_areas) if organoid_areas else 0
         
-        debug_img = img.copy()
+        overlay = Overlay(img, output)
         
-        for mask_id in valid_masks:
+        for mask_id, area in zip(valid_masks, organoid_areas):
             obj_mask = np.uint8(masks == mask_id)
             contours, _ = cv2.findContours(obj_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            cv2.drawContours(debug_img, contours, -1, (0, 0, 255), 2)
+            overlay.contours(contours, (0, 0, 255), 2)
+            if contours:
+                overlay.measure(contours[0], area)
 
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_cellpose")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"cellpose_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_cellpose"), f"cellpose_debug_day{day}.jpg", img_path)
         
         h, w = img.shape[:2]
 
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": count,
             "avg_size": avg_size,
             "total_area": total_area,
             "resolution": f"{w}x{h}"
-        })
+        }))
 
     return results
 
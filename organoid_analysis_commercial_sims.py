@@ -1,98 +1,106 @@
 import cv2
 import numpy as np
 import os
+from organoid_buffers import get_pool
+from organoid_circles import detect_circles_cached
+from organoid_frames import iter_images
+from organoid_vectors import Overlay
+from organoid_zstack import iter_stacks, volume_report
 
-def analyze_arivis_sim(image_paths):
+def analyze_arivis_sim(image_paths, output='image', scale=1.0):
     results = []
     
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path): continue
-        img = cv2.imread(img_path)
-        if img is None: continue
+    for day, img_path, img, stack in iter_stacks(image_paths):
+        pool = get_pool()
+        shape = img.shape[:2]
         
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        if cv2.countNonZero(thresh) > (thresh.size / 2): thresh = cv2.bitwise_not(thresh)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=pool.get('gray', shape))
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=gray)
+        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=blurred)
+        if cv2.countNonZero(thresh) > (thresh.size / 2): thresh = cv2.bitwise_not(thresh, dst=thresh)
         
         kernel = np.ones((3,3), np.uint8)
-        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=2)
-        dist = cv2.distanceTransform(opening, cv2.DIST_L2, 5)
-        _, fg = cv2.threshold(dist, 0.5 * dist.max(), 255, 0)
-        fg = np.uint8(fg)
-        bg = cv2.dilate(opening, kernel, iterations=3)
-        unk = cv2.subtract(bg, fg)
-        ret, markers = cv2.connectedComponents(fg)
-        markers = markers + 1
+        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, dst=pool.get('opening', shape), iterations=2)
+        dist = cv2.distanceTransform(opening, cv2.DIST_L2, 5, dst=pool.get('dist', shape, np.float32))
+        _, fg = cv2.threshold(dist, 0.5 * dist.max(), 255, 0, dst=dist)
+        fg = pool.get('sure_fg', shape)
+        np.copyto(fg, dist, casting='unsafe')
+        bg = cv2.dilate(opening, kernel, dst=pool.get('sure_bg', shape), iterations=3)
+        unk = cv2.subtract(bg, fg, dst=bg)
+        ret, markers = cv2.connectedComponents(fg, labels=pool.get('markers', shape, np.int32))
+        markers += 1
         markers[unk == 255] = 0
         markers = cv2.watershed(img, markers)
         
         total_vol = 0
         organoids = []
-        debug_img = img.copy()
+        object_labels = []
+        overlay = Overlay(img, output, pool)
+        mask = pool.get('mask', shape)
         
         labels = np.unique(markers)
         for label in labels:
             if label <= 1: continue
-            mask = np.uint8(markers == label) * 255
+            cv2.compare(markers, int(label), cv2.CMP_EQ, dst=mask)
             area = cv2.countNonZero(mask)
             
-            if area > 100:
+            if area > 100 * scale ** 2:
                 r = np.sqrt(area / np.pi)
                 vol = (4/3) * np.pi * (r**3)
                 surf = 4 * np.pi * (r**2)
                 total_vol += vol
                 
                 organoids.append(vol)
+                object_labels.append(label)
                 
                 cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
                 if cnts:
-                    cv2.drawContours(debug_img, cnts, -1, (0, 255, 255), 1)
+                    overlay.contours(cnts, (0, 255, 255), 1)
+                    overlay.measure(cnts[0], area)
                     M = cv2.moments(cnts[0])
                     if M["m00"] != 0:
                         cX = int(M["m10"] / M["m00"])
                         cY = int(M["m01"] / M["m00"])
-                        cv2.line(debug_img, (cX-5, cY), (cX+5, cY), (0, 165, 255), 1)
-                        cv2.line(debug_img, (cX, cY-5), (cX, cY+5), (0, 165, 255), 1)
+                        overlay.marker((cX, cY), 5, (0, 165, 255), 1)
         
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_arivis")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"arivis_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_arivis"), f"arivis_debug_day{day}.jpg", img_path)
         
         h, w = img.shape[:2]
-        results.append({
+        result = {
             "day": day,
             "count": int(len(organoids)),
             "est_volume": float(total_vol),
             "avg_volume": float(np.mean(organoids)) if organoids else 0.0,
             "resolution": f"{w}x{h}"
-        })
+        }
+        if stack is not None:
+            proj_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            result.update(volume_report(stack, markers, proj_gray, object_labels, organoids))
+        results.append(overlay.attach(result))
         
     return results
 
-def analyze_assayscope_sim(image_paths):
+def analyze_assayscope_sim(image_paths, circle_mode='full', estimate_radius=False, output='image', scale=1.0):
     results = []
     
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path): continue
-        img = cv2.imread(img_path)
-        if img is None: continue
-        
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.medianBlur(gray, 5)
-        circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, 1.2, 40, param1=50, param2=30, minRadius=10, maxRadius=150)
+    for day, img_path, img in iter_images(image_paths):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=get_pool().get('gray', img.shape[:2]))
+        circles = detect_circles_cached(img_path, gray, mode=circle_mode, estimate_radius=estimate_radius,
+                                        dp=1.2, min_dist=40 * scale, param1=50, param2=max(1.0, 30 * scale),
+                                        min_radius=max(1, round(10 * scale)), max_radius=round(150 * scale))
         
         radii = []
-        debug_img = img.copy()
+        overlay = Overlay(img, output, get_pool())
         
         if circles is not None:
             circles = np.uint16(np.around(circles))
             for i in circles[0, :]:
-                center = (i[0], i[1])
-                r = i[2]
+                # Plain ints: a box reaching past the top or left edge must not wrap around in uint16.
+                x, y, r = (int(v) for v in i)
                 radii.append(r)
                 
-                cv2.rectangle(debug_img, (i[0]-r, i[1]-r), (i[0]+r, i[1]+r), (0, 255, 0), 1)
+                overlay.box((x-r, y-r), (x+r, y+r), (0, 255, 0), 1)
+                overlay.measure_circle((x, y), r, 'box')
         
         if radii:
             mean_r = np.mean(radii)
@@ -104,17 +112,15 @@ def analyze_assayscope_sim(image_paths):
         else:
             mean_r = 0; cv_r = 0; homogeneity = 0
             
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_assayscope")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"assayscope_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_assayscope"), f"assayscope_debug_day{day}.jpg", img_path)
         
         h, w = img.shape[:2]
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(len(radii)),
             "mean_radius": float(mean_r),
             "homogeneity_score": float(homogeneity),
             "resolution": f"{w}x{h}"
-        })
+        }))
         
     return results
\ No newline at end of file
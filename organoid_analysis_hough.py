@@ -1,32 +1,30 @@
 import cv2
 import numpy as np
 import os
+from organoid_buffers import get_pool
+from organoid_circles import detect_circles_cached
+from organoid_vectors import Overlay
+from organoid_zstack import iter_stacks, volume_report
 
-def analyze_organoids_hough(image_paths):
+def analyze_organoids_hough(image_paths, circle_mode='full', estimate_radius=False, output='image', scale=1.0):
     results = []
     
     dp = 1.2
-    minDist = 40
+    minDist = 40 * scale
     param1 = 50
-    param2 = 30
-    minRadius = 10
-    maxRadius = 150
+    # Accumulator votes grow with a circle's circumference, so the vote threshold scales like a length.
+    param2 = max(1.0, 30 * scale)
+    minRadius = max(1, round(10 * scale))
+    maxRadius = round(150 * scale)
 
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            continue
-
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-            
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        blurred = cv2.medianBlur(gray, 5)
+    for day, img_path, img, stack in iter_stacks(image_paths):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=get_pool().get('gray', img.shape[:2]))
         
-        circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, dp, minDist,
-                                   param1=param1, param2=param2,
-                                   minRadius=minRadius, maxRadius=maxRadius)
+        circles = detect_circles_cached(img_path, gray, mode=circle_mode,
+                                        estimate_radius=estimate_radius,
+                                        dp=dp, min_dist=minDist,
+                                        param1=param1, param2=param2,
+                                        min_radius=minRadius, max_radius=maxRadius)
         
         organoid_circles = []
         
@@ -51,28 +49,35 @@ def analyze_organoids_hough(image_paths):
                 total_area += area
                 total_volume += vol
         
-        debug_img = img.copy()
+        overlay = Overlay(img, output, get_pool())
         if circles is not None:
             for i in circles[0, :]:
                 center = (i[0], i[1])
                 radius = i[2]
-                cv2.circle(debug_img, center, 1, (0, 100, 100), 3)
-                cv2.circle(debug_img, center, radius, (255, 0, 255), 2)
+                overlay.circle(center, 1, (0, 100, 100), 3)
+                overlay.circle(center, radius, (255, 0, 255), 2)
+                overlay.measure_circle(center, radius)
 
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_hough")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"hough_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_hough"), f"hough_debug_day{day}.jpg", img_path)
         
         h, w = img.shape[:2]
 
-        results.append({
+        result = {
             "day": day,
             "count": int(count),
             "avg_size": float(total_area / count) if count > 0 else 0.0,
             "total_area": float(total_area),
             "total_volume": float(total_volume),
             "resolution": f"{w}x{h}"
-        })
+        }
+        if stack is not None:
+            labels = np.zeros((h, w), np.int32)
+            for k, c in enumerate(organoid_circles, start=1):
+                cv2.circle(labels, (int(c[0]), int(c[1])), int(c[2]), k, -1)
+            spherical = [(4/3) * np.pi * (float(c[2])**3) for c in organoid_circles]
+            proj_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            result.update(volume_report(stack, labels, proj_gray, range(1, count + 1), spherical))
+        results.append(overlay.attach(result))
 
     return results
 
@@ -2,52 +2,53 @@ import cv2
 import numpy as np
 import os
 from organoid_analysis_watershed import analyze_organoids_watershed
+from organoid_buffers import get_pool
+from organoid_frames import iter_images
+from organoid_vectors import Overlay
 
-def analyze_organoids_morphology(image_paths):
+def analyze_organoids_morphology(image_paths, output='image', scale=1.0):
     
     results = []
 
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            continue
+    for day, img_path, img in iter_images(image_paths):
+        pool = get_pool()
+        shape = img.shape[:2]
 
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=pool.get('gray', shape))
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=gray)
+        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=blurred)
         
         if cv2.countNonZero(thresh) > (thresh.size / 2):
-            thresh = cv2.bitwise_not(thresh)
+            thresh = cv2.bitwise_not(thresh, dst=thresh)
 
         kernel = np.ones((3,3), np.uint8)
-        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=2)
-        sure_bg = cv2.dilate(opening, kernel, iterations=3)
-        dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5)
-        _, sure_fg = cv2.threshold(dist_transform, 0.5 * dist_transform.max(), 255, 0)
-        sure_fg = np.uint8(sure_fg)
-        unknown = cv2.subtract(sure_bg, sure_fg)
-        ret, markers = cv2.connectedComponents(sure_fg)
-        markers = markers + 1
+        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, dst=pool.get('opening', shape), iterations=2)
+        sure_bg = cv2.dilate(opening, kernel, dst=pool.get('sure_bg', shape), iterations=3)
+        dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5, dst=pool.get('dist', shape, np.float32))
+        _, sure_fg = cv2.threshold(dist_transform, 0.5 * dist_transform.max(), 255, 0, dst=dist_transform)
+        sure_fg = pool.get('sure_fg', shape)
+        np.copyto(sure_fg, dist_transform, casting='unsafe')
+        unknown = cv2.subtract(sure_bg, sure_fg, dst=sure_bg)
+        ret, markers = cv2.connectedComponents(sure_fg, labels=pool.get('markers', shape, np.int32))
+        markers += 1
         markers[unknown == 255] = 0
         markers = cv2.watershed(img, markers)
 
         organoid_features = []
-        debug_img = img.copy()
+        overlay = Overlay(img, output, pool)
+        mask = pool.get('mask', shape)
         
         unique_labels = np.unique(markers)
         
-        avg_cell_area_projection = 150.0
+        avg_cell_area_projection = 150.0 * scale ** 2
 
         for label in unique_labels:
             if label <= 1: continue 
             
-            mask = np.uint8(markers == label) * 255
+            cv2.compare(markers, int(label), cv2.CMP_EQ, dst=mask)
             area = cv2.countNonZero(mask)
             
-            if area > 100:
+            if area > 100 * scale ** 2:
                 cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
                 if not cnts: continue
                 cnt = cnts[0]
@@ -77,7 +78,8 @@ def analyze_organoids_morphology(image_paths):
                 })
                 
                 color = (0, int(255*solidity), 255-int(255*solidity))
-                cv2.drawContours(debug_img, [cnt], -1, color, 2)
+                overlay.contours([cnt], color, 2)
+                overlay.measure(cnt, area)
 
         count = len(organoid_features)
         
@@ -94,13 +96,11 @@ def analyze_organoids_morphology(image_paths):
             avg_eccentricity = 0.0
             total_cells = 0
 
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_morphology")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"morphology_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_morphology"), f"morphology_debug_day{day}.jpg", img_path)
         
         h, w = img.shape[:2]
 
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(count),
             "avg_size": avg_size,
@@ -109,6 +109,6 @@ def analyze_organoids_morphology(image_paths):
             "avg_eccentricity": avg_eccentricity,
             "est_total_cells": total_cells,
             "resolution": f"{w}x{h}"
-        })
+        }))
 
     return results
\ No newline at end of file
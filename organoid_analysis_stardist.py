@@ -1,6 +1,10 @@
 import cv2
 import numpy as np
 import os
+import threading
+from organoid_buffers import get_pool
+from organoid_frames import iter_images
+from organoid_vectors import Overlay
 
 try:
     from stardist.models import StarDist2D
@@ -10,75 +14,83 @@ except (ImportError, AttributeError, TypeError, Exception) as e:
     STARDIST_AVAILABLE = False
     print(f"StarDist not available due to: {type(e).__name__}")
 
-def analyze_organoids_stardist(image_paths):
+def analyze_organoids_stardist(image_paths, output='image', scale=1.0):
     if not STARDIST_AVAILABLE:
         print("StarDist not available. using Aggressive Convex Geometry fallback.")
-        return analyze_organoids_stardist_fallback(image_paths)
+        return analyze_organoids_stardist_fallback(image_paths, output, scale)
 
     try:
         model = StarDist2D.from_pretrained('2D_versatile_fluo')
     except Exception as e:
          print(f"StarDist load failed: {e}. Switching to fallback.")
-         return analyze_organoids_stardist_fallback(image_paths)
+         return analyze_organoids_stardist_fallback(image_paths, output, scale)
 
     results = []
     
     return []
 
-def analyze_organoids_stardist_fallback(image_paths):
+def _ksize(size, scale):
+    # An odd kernel size (or window) of `size` pixels at full resolution, for an image scaled by `scale`.
+    return max(3, int(round(size * scale)) | 1)
+
+def _iterations(n, scale):
+    return max(1, int(round(n * scale)))
+
+def analyze_organoids_stardist_fallback(image_paths, output='image', scale=1.0):
     results = []
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            continue
+    for day, img_path, img in iter_images(image_paths):
+        pool = get_pool()
+        shape = img.shape[:2]
 
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-            
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=pool.get('gray', shape))
         
-        blurred = cv2.GaussianBlur(gray, (7, 7), 0)
+        # Filter sizes are in full-resolution pixels and shrink with `scale` like the area cut-off.
+        k7 = _ksize(7, scale)
+        blurred = cv2.GaussianBlur(gray, (k7, k7), 0, dst=gray)
         
-        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=blurred)
         
         if cv2.countNonZero(thresh) > (thresh.size / 2):
-            thresh = cv2.bitwise_not(thresh)
+            thresh = cv2.bitwise_not(thresh, dst=thresh)
             
         kernel = np.ones((3,3), np.uint8)
-        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=2)
+        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, dst=pool.get('opening', shape),
+                                   iterations=_iterations(2, scale))
         
-        dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5)
+        dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5, dst=pool.get('dist', shape, np.float32))
         
-        _, sure_fg = cv2.threshold(dist_transform, 0.55 * dist_transform.max(), 255, 0)
+        _, sure_fg = cv2.threshold(dist_transform, 0.55 * dist_transform.max(), 255, 0, dst=dist_transform)
         
-        sure_fg = np.uint8(sure_fg)
-        sure_bg = cv2.dilate(opening, kernel, iterations=3)
-        unknown = cv2.subtract(sure_bg, sure_fg)
+        sure_fg = pool.get('sure_fg', shape)
+        np.copyto(sure_fg, dist_transform, casting='unsafe')
+        sure_bg = cv2.dilate(opening, kernel, dst=pool.get('sure_bg', shape), iterations=_iterations(3, scale))
+        unknown = cv2.subtract(sure_bg, sure_fg, dst=sure_bg)
         
-        ret, markers = cv2.connectedComponents(sure_fg)
-        markers = markers + 1
+        ret, markers = cv2.connectedComponents(sure_fg, labels=pool.get('markers', shape, np.int32))
+        markers += 1
         markers[unknown == 255] = 0
         
         markers = cv2.watershed(img, markers)
         
         organoid_areas = []
-        debug_img = img.copy()
+        overlay = Overlay(img, output, pool)
+        mask = pool.get('mask', shape)
         
         labels = np.unique(markers)
         for label in labels:
             if label <= 1: continue
             
-            mask = np.uint8(markers == label) * 255
+            cv2.compare(markers, int(label), cv2.CMP_EQ, dst=mask)
             area = cv2.countNonZero(mask)
             
-            if area > 80:
+            if area > 80 * scale ** 2:
                 organoid_areas.append(area)
                 cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                cv2.drawContours(debug_img, cnts, -1, (255, 255, 0), 2)
+                overlay.contours(cnts, (255, 255, 0), 2)
+                if cnts:
+                    overlay.measure(cnts[0], area)
 
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_stardist")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"stardist_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_stardist"), f"stardist_debug_day{day}.jpg", img_path)
 
         count = len(organoid_areas)
         avg_size = float(np.mean(organoid_areas)) if organoid_areas else 0.0
@@ -86,34 +98,37 @@ def analyze_organoids_stardist_fallback(image_paths):
         
         h, w = img.shape[:2]
 
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(count),
             "avg_size": avg_size,
             "total_area": total_area,
             "resolution": f"{w}x{h}"
-        })
+        }))
         
     return results
 
-def analyze_organoids_stardist(image_paths):
+_model = None
+_model_lock = threading.Lock()
+
+def load_stardist_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = StarDist2D.from_pretrained('2D_versatile_fluo')
+        return _model
+
+def analyze_organoids_stardist(image_paths, output='image', scale=1.0):
     if not STARDIST_AVAILABLE:
-        return analyze_organoids_stardist_fallback(image_paths)
+        return analyze_organoids_stardist_fallback(image_paths, output, scale)
 
     try:
-        model = StarDist2D.from_pretrained('2D_versatile_fluo')
+        model = load_stardist_model()
     except Exception as e:
-        return analyze_organoids_stardist_fallback(image_paths)
+        return analyze_organoids_stardist_fallback(image_paths, output, scale)
 
     results = []
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            continue
-
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-            
+    for day, img_path, img in iter_images(image_paths):
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         img_norm = normalize(gray, 1, 99.8, axis=(0,1))
         
@@ -121,33 +136,33 @@ def analyze_organoids_stardist(image_paths):
         
         organoid_areas = []
         unique_labels = np.unique(labels)
-        debug_img = img.copy()
+        overlay = Overlay(img, output)
 
         for label in unique_labels:
             if label == 0: continue
             mask = np.uint8(labels == label)
             area = np.sum(mask)
             
-            if area > 100:
+            if area > 100 * scale ** 2:
                 organoid_areas.append(area)
                 cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                cv2.drawContours(debug_img, cnts, -1, (255, 255, 0), 2) 
+                overlay.contours(cnts, (255, 255, 0), 2)
+                if cnts:
+                    overlay.measure(cnts[0], area)
 
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_stardist")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"stardist_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_stardist"), f"stardist_debug_day{day}.jpg", img_path)
 
         count = len(organoid_areas)
         avg_size = float(np.mean(organoid_areas)) if organoid_areas else 0.0
         total_area = float(np.sum(organoid_areas)) if organoid_areas else 0.0
         h, w = img.shape[:2]
 
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(count),
             "avg_size": avg_size,
             "total_area": total_area,
             "resolution": f"{w}x{h}"
-        })
+        }))
 
     return results
\ No newline at end of file
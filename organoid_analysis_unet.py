@@ -1,16 +1,33 @@
 import cv2
+import importlib.util
 import numpy as np
 import os
+import threading
+from organoid_buffers import get_pool
+from organoid_resources import governor
+from organoid_frames import Frame, iter_images
+from organoid_vectors import Overlay
+from organoid_unet_runtime import load_runtime_model, preprocess
 
+# TensorFlow takes seconds and about a gigabyte to import, so it is only imported when a Keras
+# model is actually needed; an exported ONNX/TFLite model (organoid_unet_runtime) never imports it.
 try:
-    import tensorflow as tf
-    from tensorflow import keras
-    from tensorflow.keras import layers
-    TENSORFLOW_AVAILABLE = True
-except (ImportError, AttributeError, TypeError, Exception) as e:
+    TENSORFLOW_AVAILABLE = importlib.util.find_spec('tensorflow') is not None
+except (ImportError, ValueError):
     TENSORFLOW_AVAILABLE = False
+tf = keras = layers = None
+
+def import_tensorflow():
+    global tf, keras, layers
+    if tf is None:
+        import tensorflow
+        from tensorflow import keras as tf_keras
+        from tensorflow.keras import layers as tf_layers
+        tf, keras, layers = tensorflow, tf_keras, tf_layers
+    return tf
 
 def build_unet_model(input_shape=(256, 256, 1)):
+    import_tensorflow()
     inputs = keras.Input(shape=input_shape)
     
     conv1 = layers.Conv2D(64, 3, activation='relu', padding='same')(inputs)
@@ -51,67 +68,78 @@ def build_unet_model(input_shape=(256, 256, 1)):
     model = keras.Model(inputs=inputs, outputs=outputs)
     return model
 
-def analyze_organoids_unet_fallback(image_paths):
+def _ksize(size, scale):
+    # An odd kernel size (or window) of `size` pixels at full resolution, for an image scaled by `scale`.
+    return max(3, int(round(size * scale)) | 1)
+
+def _iterations(n, scale):
+    return max(1, int(round(n * scale)))
+
+def analyze_organoids_unet_fallback(image_paths, output='image', scale=1.0):
     results = []
     
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            continue
+    for day, img_path, img in iter_images(image_paths):
+        pool = get_pool()
+        shape = img.shape[:2]
 
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-            
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=pool.get('gray', shape))
         
-        blurred1 = cv2.GaussianBlur(gray, (5, 5), 0)
-        blurred2 = cv2.GaussianBlur(gray, (9, 9), 0)
-        blurred3 = cv2.GaussianBlur(gray, (15, 15), 0)
+        # Filter sizes are in full-resolution pixels and shrink with `scale` like the area cut-off.
+        k5, k9, k15 = (_ksize(k, scale) for k in (5, 9, 15))
+        blurred1 = cv2.GaussianBlur(gray, (k5, k5), 0, dst=pool.get('blurred', shape))
+        blurred2 = cv2.GaussianBlur(gray, (k9, k9), 0, dst=pool.get('blurred2', shape))
+        blurred3 = cv2.GaussianBlur(gray, (k15, k15), 0, dst=gray)
         
-        combined = cv2.addWeighted(blurred1, 0.5, blurred2, 0.3, 0)
-        combined = cv2.addWeighted(combined, 0.7, blurred3, 0.3, 0)
+        combined = cv2.addWeighted(blurred1, 0.5, blurred2, 0.3, 0, dst=blurred1)
+        combined = cv2.addWeighted(combined, 0.7, blurred3, 0.3, 0, dst=combined)
         
         thresh = cv2.adaptiveThreshold(
             combined, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2
+            cv2.THRESH_BINARY, _ksize(11, scale), 2, dst=blurred2
         )
         
         if cv2.countNonZero(thresh) > (thresh.size / 2):
-            thresh = cv2.bitwise_not(thresh)
+            thresh = cv2.bitwise_not(thresh, dst=thresh)
             
         kernel = np.ones((3,3), np.uint8)
-        mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=2)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=3)
+        mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, dst=pool.get('opening', shape),
+                                iterations=_iterations(2, scale))
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, dst=mask, iterations=_iterations(3, scale))
         
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((5,5), np.uint8), iterations=1)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((k5, k5), np.uint8), dst=mask, iterations=1)
         
         organoids = []
+        kept = []
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
         for cnt in contours:
             area = cv2.contourArea(cnt)
-            if area > 80:
+            if area > 80 * scale ** 2:
                 organoids.append(area)
+                kept.append(cnt)
         
-        dist_transform = cv2.distanceTransform(mask, cv2.DIST_L2, 5)
-        
-        if dist_transform.max() > 0:
-            dist_disp = cv2.normalize(dist_transform, None, 0, 255, cv2.NORM_MINMAX)
-            dist_disp = np.uint8(dist_disp)
-        else:
-            dist_disp = np.zeros(mask.shape, dtype=np.uint8)
+        overlay = Overlay(img, output, pool)
+        if not overlay.vector:
+            dist_transform = cv2.distanceTransform(mask, cv2.DIST_L2, 5, dst=pool.get('dist', shape, np.float32))
             
-        heatmap = cv2.applyColorMap(dist_disp, cv2.COLORMAP_JET)
-        heatmap[mask == 0] = [0, 0, 0]
-        
-        cv2.drawContours(heatmap, contours, -1, (255, 255, 255), 2)
-        
-        debug_img = cv2.addWeighted(img, 0.4, heatmap, 0.6, 0)
-        cv2.drawContours(debug_img, contours, -1, (0, 255, 0), 2)
+            dist_disp = pool.get('sure_fg', shape)
+            if dist_transform.max() > 0:
+                cv2.normalize(dist_transform, dist_transform, 0, 255, cv2.NORM_MINMAX)
+                np.copyto(dist_disp, dist_transform, casting='unsafe')
+            else:
+                dist_disp.fill(0)
+                
+            heatmap = cv2.applyColorMap(dist_disp, cv2.COLORMAP_JET, dst=pool.get('heatmap', img.shape))
+            heatmap[mask == 0] = [0, 0, 0]
+            
+            cv2.drawContours(heatmap, contours, -1, (255, 255, 255), 2)
+            
+            cv2.addWeighted(img, 0.4, heatmap, 0.6, 0, dst=overlay.canvas)
+        overlay.contours(contours, (0, 255, 0), 2)
+        for cnt, area in zip(kept, organoids):
+            overlay.measure(cnt, area)
         
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_unet")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"unet_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_unet"), f"unet_debug_day{day}.jpg", img_path)
         
         count = len(organoids)
         avg_size = float(np.mean(organoids)) if organoids else 0.0
@@ -119,36 +147,42 @@ def analyze_organoids_unet_fallback(image_paths):
         
         h, w = img.shape[:2]
         
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(count),
             "avg_size": avg_size,
             "total_area": total_area,
             "resolution": f"{w}x{h}"
-        })
+        }))
     
     return results
 
-def analyze_organoids_unet(image_paths):
-    if not TENSORFLOW_AVAILABLE:
-        print("TensorFlow not available. Using advanced image processing fallback.")
-        return analyze_organoids_unet_fallback(image_paths)
-    
-    model = None
-    model_path = None
-    
-    possible_model_paths = [
-        'models/unet_organoid_model.h5',
-        'unet_organoid_model.h5',
-        'models/unet_weights.h5'
-    ]
-    
-    for path in possible_model_paths:
-        if os.path.exists(path):
-            model_path = path
-            break
-    
-    try:
+_model = None
+_model_lock = threading.Lock()
+
+def load_unet_model():
+    # Loaded once per process; per-frame streaming calls this for every timepoint.
+    global _model
+    with _model_lock:
+        if _model is not None:
+            return _model
+
+        import_tensorflow()
+        governor.configure_tensorflow(tf)
+
+        model_path = None
+        
+        possible_model_paths = [
+            'models/unet_organoid_model.h5',
+            'unet_organoid_model.h5',
+            'models/unet_weights.h5'
+        ]
+        
+        for path in possible_model_paths:
+            if os.path.exists(path):
+                model_path = path
+                break
+        
         if model_path and os.path.exists(model_path):
             print(f"Loading pre-trained U-Net model from {model_path}...")
             model = keras.models.load_model(model_path)
@@ -157,73 +191,91 @@ def analyze_organoids_unet(image_paths):
             print("For best results, train the model on organoid data and save weights.")
             model = build_unet_model(input_shape=(None, None, 1))
             model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+
+        _model = model
+        return _model
+
+def prob_map_to_mask(prob_map, shape, threshold=0.5):
+    mask_resized = (prob_map > threshold).astype(np.uint8) * 255
+    
+    mask = cv2.resize(mask_resized, (shape[1], shape[0]), 
+                    interpolation=cv2.INTER_NEAREST)
+    
+    kernel = np.ones((3, 3), np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+    return mask
+
+def load_inference_model():
+    # An exported ONNX/TFLite model if one is configured (see organoid_unet_runtime), else Keras.
+    try:
+        model = load_runtime_model()
+        if model is not None:
+            return model
+    except Exception as e:
+        print(f"Exported U-Net failed to load: {e}. Trying Keras.")
+    if not TENSORFLOW_AVAILABLE:
+        return None
+    return load_unet_model()
+
+def analyze_organoids_unet(image_paths, output='image', scale=1.0):
+    try:
+        model = load_inference_model()
     except Exception as e:
         print(f"U-Net model initialization failed: {e}. Using fallback.")
-        return analyze_organoids_unet_fallback(image_paths)
+        return analyze_organoids_unet_fallback(image_paths, output, scale)
+    
+    if model is None:
+        print("TensorFlow not available. Using advanced image processing fallback.")
+        return analyze_organoids_unet_fallback(image_paths, output, scale)
     
     results = []
     
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            continue
-
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-        
+    for day, img_path, img in iter_images(image_paths):
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         original_shape = gray.shape
         
-        target_size = (256, 256)
-        gray_resized = cv2.resize(gray, target_size)
-        
-        gray_normalized = gray_resized.astype(np.float32) / 255.0
-        
-        input_tensor = np.expand_dims(np.expand_dims(gray_normalized, axis=0), axis=-1)
+        input_tensor = preprocess(gray)
         
         try:
             prediction = model.predict(input_tensor, verbose=0)
             
             prob_map = prediction[0, :, :, 0]
             
-            threshold = 0.5
-            mask_resized = (prob_map > threshold).astype(np.uint8) * 255
-            
-            mask = cv2.resize(mask_resized, (original_shape[1], original_shape[0]), 
-                            interpolation=cv2.INTER_NEAREST)
-            
-            kernel = np.ones((3, 3), np.uint8)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+            mask = prob_map_to_mask(prob_map, original_shape)
             
         except Exception as e:
             print(f"U-Net prediction failed for {img_path}: {e}. Using fallback for this image.")
-            fallback_result = analyze_organoids_unet_fallback({day: img_path})
+            fallback_result = analyze_organoids_unet_fallback({day: Frame(img, img_path)}, output, scale)
             if fallback_result:
                 results.extend(fallback_result)
             continue
         
         organoids = []
+        kept = []
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
         for cnt in contours:
             area = cv2.contourArea(cnt)
-            if area > 80:
+            if area > 80 * scale ** 2:
                 organoids.append(area)
+                kept.append(cnt)
         
-        prob_map_resized = cv2.resize(prob_map, (original_shape[1], original_shape[0]), 
-                                     interpolation=cv2.INTER_LINEAR)
-        prob_map_uint8 = (prob_map_resized * 255).astype(np.uint8)
-        
-        heatmap = cv2.applyColorMap(prob_map_uint8, cv2.COLORMAP_JET)
-        
-        debug_img = cv2.addWeighted(img, 0.5, heatmap, 0.5, 0)
+        overlay = Overlay(img, output)
+        if not overlay.vector:
+            prob_map_resized = cv2.resize(prob_map, (original_shape[1], original_shape[0]), 
+                                         interpolation=cv2.INTER_LINEAR)
+            prob_map_uint8 = (prob_map_resized * 255).astype(np.uint8)
+            
+            heatmap = cv2.applyColorMap(prob_map_uint8, cv2.COLORMAP_JET)
+            
+            cv2.addWeighted(img, 0.5, heatmap, 0.5, 0, dst=overlay.canvas)
         
-        cv2.drawContours(debug_img, contours, -1, (0, 255, 0), 2)
+        overlay.contours(contours, (0, 255, 0), 2)
+        for cnt, area in zip(kept, organoids):
+            overlay.measure(cnt, area)
         
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_unet")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"unet_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_unet"), f"unet_debug_day{day}.jpg", img_path)
         
         count = len(organoids)
         avg_size = float(np.mean(organoids)) if organoids else 0.0
@@ -231,13 +283,13 @@ def analyze_organoids_unet(image_paths):
         
         h, w = img.shape[:2]
         
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(count),
             "avg_size": avg_size,
             "total_area": total_area,
             "resolution": f"{w}x{h}"
-        })
+        }))
     
     return results
 
@@ -1,39 +1,39 @@
 import cv2
 import numpy as np
 import os
+from organoid_buffers import get_pool
+from organoid_frames import iter_images
+from organoid_vectors import Overlay
 
-def analyze_organoids_watershed(image_paths):
+def analyze_organoids_watershed(image_paths, output='image', scale=1.0):
     results = []
 
-    for day, img_path in image_paths.items():
-        if not os.path.exists(img_path):
-            continue
+    for day, img_path, img in iter_images(image_paths):
+        pool = get_pool()
+        shape = img.shape[:2]
 
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-            
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=pool.get('gray', shape))
         
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=gray)
+        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=blurred)
         
         if cv2.countNonZero(thresh) > (thresh.size / 2):
-            thresh = cv2.bitwise_not(thresh)
+            thresh = cv2.bitwise_not(thresh, dst=thresh)
 
         kernel = np.ones((3,3), np.uint8)
-        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=2)
+        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, dst=pool.get('opening', shape), iterations=2)
 
-        sure_bg = cv2.dilate(opening, kernel, iterations=3)
+        sure_bg = cv2.dilate(opening, kernel, dst=pool.get('sure_bg', shape), iterations=3)
 
-        dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5)
-        _, sure_fg = cv2.threshold(dist_transform, 0.4 * dist_transform.max(), 255, 0)
+        dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5, dst=pool.get('dist', shape, np.float32))
+        _, sure_fg = cv2.threshold(dist_transform, 0.4 * dist_transform.max(), 255, 0, dst=dist_transform)
 
-        sure_fg = np.uint8(sure_fg)
-        unknown = cv2.subtract(sure_bg, sure_fg)
+        sure_fg = pool.get('sure_fg', shape)
+        np.copyto(sure_fg, dist_transform, casting='unsafe')
+        unknown = cv2.subtract(sure_bg, sure_fg, dst=sure_bg)
 
-        ret, markers = cv2.connectedComponents(sure_fg)
-        markers = markers + 1
+        ret, markers = cv2.connectedComponents(sure_fg, labels=pool.get('markers', shape, np.int32))
+        markers += 1
         markers[unknown == 255] = 0
 
         markers = cv2.watershed(img, markers)
@@ -44,17 +44,17 @@ def analyze_organoids_watershed(image_paths):
         
         labels = np.unique(markers)
         
-        debug_img = img.copy()
+        overlay = Overlay(img, output, pool)
+        mask = pool.get('mask', shape)
         
         for label in labels:
             if label <= 1: continue
             
-            mask = np.zeros(gray.shape, dtype=np.uint8)
-            mask[markers == label] = 255
+            cv2.compare(markers, int(label), cv2.CMP_EQ, dst=mask)
             
             area = cv2.countNonZero(mask)
             
-            if area > 100:
+            if area > 100 * scale ** 2:
                 organoid_areas.append(area)
                 
                 cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -65,13 +65,13 @@ def analyze_organoids_watershed(image_paths):
                         circ = 4 * np.pi * area / (perimeter * perimeter)
                         circularities.append(circ)
                     
-                    cv2.drawContours(debug_img, cnts, -1, (0, 0, 255), 2)
+                    overlay.contours(cnts, (0, 0, 255), 2)
+                    overlay.measure(cnt, area)
 
-        debug_img[markers == -1] = [0, 255, 255]
+        if not overlay.vector:
+            overlay.canvas[markers == -1] = [0, 255, 255]
 
-        debug_dir = os.path.join(os.path.dirname(img_path), "debug_output_watershed")
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"watershed_debug_day{day}.jpg"), debug_img)
+        overlay.save(os.path.join(os.path.dirname(img_path), "debug_output_watershed"), f"watershed_debug_day{day}.jpg", img_path)
 
         count = len(organoid_areas)
         avg_size = float(np.mean(organoid_areas)) if organoid_areas else 0.0
@@ -80,14 +80,14 @@ def analyze_organoids_watershed(image_paths):
         
         h, w = img.shape[:2]
 
-        results.append({
+        results.append(overlay.attach({
             "day": day,
             "count": int(count),
             "avg_size": avg_size,
             "total_area": total_area,
             "avg_circularity": avg_circularity,
             "resolution": f"{w}x{h}"
-        })
+        }))
 
     return results
 
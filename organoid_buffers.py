@@ -0,0 +1,217 @@
+import numpy as np
+import os
+import threading
+import tracemalloc
+import weakref
+from collections import OrderedDict
+
+# Each analyzing thread keeps its own pool, keyed by buffer shape, so it is capped at about one
+# large image's working set; at the end of a request a pool above POOL_KEEP_BYTES is emptied, so
+# an idle thread or worker process does not hold on to the buffers of the last large image.
+POOL_MAX_BYTES = int(os.environ.get('ORGANOID_POOL_MAX_MB', '128')) * 1024 * 1024
+POOL_KEEP_BYTES = int(os.environ.get('ORGANOID_POOL_KEEP_MB', '32')) * 1024 * 1024
+# tracemalloc's allocation peak (peak_alloc_mb) hooks every allocation and slows analysis down, so
+# it is opt-in; the resident-set high-water mark (peak_rss_mb) is always reported and costs nothing.
+TRACK_MEMORY = os.environ.get('ORGANOID_TRACK_MEMORY', '0') not in ('0', 'false', 'off')
+
+class BufferPool:
+    def __init__(self, max_bytes=POOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # Largest nbytes since a MemoryTracker started on this thread; survives trim().
+        self.peak_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.trims = 0
+        self._buffers = OrderedDict()
+
+    def get(self, name, shape, dtype=np.uint8):
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        buf = self._buffers.get(key)
+        if buf is not None:
+            self._buffers.move_to_end(key)
+            self.hits += 1
+            return buf
+
+        self.misses += 1
+        buf = np.empty(shape, dtype=dtype)
+        self._buffers[key] = buf
+        self.nbytes += buf.nbytes
+        self.peak_bytes = max(self.peak_bytes, self.nbytes)
+
+        # Evicting only drops the pool's reference; a caller still holding the array keeps it alive.
+        while self.nbytes > self.max_bytes and len(self._buffers) > 1:
+            old_key, old = self._buffers.popitem(last=False)
+            if old_key == key:
+                self._buffers[key] = old
+                break
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+        return buf
+
+    def copy_of(self, name, arr):
+        buf = self.get(name, arr.shape, arr.dtype)
+        np.copyto(buf, arr)
+        return buf
+
+    def clear(self):
+        self._buffers.clear()
+        self.nbytes = 0
+
+    def trim(self, keep_bytes=POOL_KEEP_BYTES):
+        if self.nbytes > keep_bytes:
+            self.clear()
+            self.trims += 1
+
+    def stats(self):
+        return {
+            'buffers': len(self._buffers),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'trims': self.trims,
+        }
+
+_local = threading.local()
+_pools = weakref.WeakSet()
+_pools_lock = threading.Lock()
+
+def get_pool():
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = BufferPool()
+        _local.pool = pool
+        with _pools_lock:
+            _pools.add(pool)
+    return pool
+
+def trim_pool(keep_bytes=POOL_KEEP_BYTES):
+    # Called by the thread that analyzed a request once it is done; other threads' pools are
+    # left alone, since they may be in use.
+    pool = getattr(_local, 'pool', None)
+    if pool is not None:
+        pool.trim(keep_bytes)
+
+def pool_stats():
+    totals = {'pools': 0, 'buffers': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'trims': 0}
+    with _pools_lock:
+        pools = list(_pools)
+    for pool in pools:
+        totals['pools'] += 1
+        for k, v in pool.stats().items():
+            totals[k] += v
+    return totals
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _rss_peak_bytes():
+    # VmHWM: the process's resident-set high-water mark (Linux).
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _reset_rss_peak():
+    # Restarts VmHWM from the current RSS; where that is not allowed it stays the lifetime peak.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _max(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_owned = False
+_rss_users = 0
+
+class MemoryTracker:
+    # tracemalloc (when enabled) sees NumPy (and therefore cv2) array allocations; the RSS
+    # high-water mark sees everything, including the interpreter and libraries. Both peaks are
+    # process-wide, so requests overlapping in the same worker report their combined peak. Images
+    # analyzed in isolated worker processes are measured there (peaks()) and credited with add_worker().
+    def __init__(self, enabled=TRACK_MEMORY):
+        self.enabled = enabled
+        self.peak_bytes = None
+        self.rss_peak = None
+        self.worker_peak_bytes = None
+        self.worker_rss_peak = None
+        self.worker_pool_bytes = None
+        self.rss_start = None
+        self.rss_end = None
+        self._base_bytes = 0
+
+    def __enter__(self):
+        global _tracing_users, _tracing_owned, _rss_users
+        self.rss_start = _rss_bytes()
+        pool = get_pool()
+        pool.peak_bytes = pool.nbytes
+        with _tracing_lock:
+            # Only the first of overlapping trackers restarts the high-water mark.
+            if _rss_users == 0:
+                _reset_rss_peak()
+            _rss_users += 1
+        if self.enabled:
+            with _tracing_lock:
+                if _tracing_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _tracing_owned = True
+                _tracing_users += 1
+                tracemalloc.reset_peak()
+                self._base_bytes = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _tracing_users, _tracing_owned, _rss_users
+        with _tracing_lock:
+            self.rss_peak = _rss_peak_bytes()
+            _rss_users -= 1
+        if self.enabled:
+            with _tracing_lock:
+                self.peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - self._base_bytes)
+                _tracing_users -= 1
+                if _tracing_users == 0 and _tracing_owned:
+                    tracemalloc.stop()
+                    _tracing_owned = False
+        self.rss_end = _rss_bytes()
+        return False
+
+    def peaks(self):
+        # This tracker's measurement, as sent back from a worker process; includes its own workers.
+        return {'alloc': _max(self.peak_bytes, self.worker_peak_bytes),
+                'rss': _max(self.rss_peak, self.worker_rss_peak),
+                'pool': _max(get_pool().peak_bytes, self.worker_pool_bytes)}
+
+    def add_worker(self, peaks):
+        # Images run one after another, so the request's peak is the largest of its images'.
+        if peaks:
+            self.worker_peak_bytes = _max(self.worker_peak_bytes, peaks.get('alloc'))
+            self.worker_rss_peak = _max(self.worker_rss_peak, peaks.get('rss'))
+            self.worker_pool_bytes = _max(self.worker_pool_bytes, peaks.get('pool'))
+
+    def report(self):
+        mb = lambda b: round(b / (1024 * 1024), 2) if b is not None else None
+        return {
+            'peak_alloc_mb': mb(_max(self.peak_bytes, self.worker_peak_bytes)),
+            'worker_peak_alloc_mb': mb(self.worker_peak_bytes),
+            # Of the process that analyzed the images: the worker's when they ran isolated.
+            'peak_rss_mb': mb(self.worker_rss_peak if self.worker_rss_peak is not None else self.rss_peak),
+            'rss_start_mb': mb(self.rss_start),
+            'rss_end_mb': mb(self.rss_end),
+            'pool_mb': mb(_max(get_pool().peak_bytes, self.worker_pool_bytes)),
+        }
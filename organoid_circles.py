@@ -0,0 +1,134 @@
+import cv2
+import hashlib
+import numpy as np
+import threading
+from collections import OrderedDict
+
+DP = 1.2
+MIN_DIST = 40
+PARAM1 = 50
+PARAM2 = 30
+MIN_RADIUS = 10
+MAX_RADIUS = 150
+
+CIRCLE_MODES = ('full', 'pyramid')
+PYRAMID_LEVELS = 1
+CACHE_SIZE = 32
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def estimate_radius_range(gray, min_radius=MIN_RADIUS, max_radius=MAX_RADIUS):
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    if cv2.countNonZero(thresh) > (thresh.size / 2):
+        thresh = cv2.bitwise_not(thresh)
+
+    dist = cv2.distanceTransform(thresh, cv2.DIST_L2, 5)
+
+    # Local maxima of the distance transform are the inscribed radii of the blobs.
+    peaks = dist[(dist == cv2.dilate(dist, np.ones((3, 3), np.uint8))) & (dist >= min_radius / 2)]
+    if peaks.size == 0:
+        return min_radius, max_radius
+
+    lo = int(np.percentile(peaks, 5) * 0.8)
+    hi = int(np.ceil(np.percentile(peaks, 99) * 1.25))
+    lo = min(max(lo, min_radius), max_radius)
+    hi = max(min(hi, max_radius), lo + 1)
+    return lo, hi
+
+def _hough(blurred, dp, min_dist, param1, param2, min_radius, max_radius):
+    return cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, dp, min_dist,
+                            param1=param1, param2=param2,
+                            minRadius=int(min_radius), maxRadius=int(max_radius))
+
+def _refine_circle(blurred, x, y, r, scale, dp, param1, param2, min_radius, max_radius):
+    h, w = blurred.shape[:2]
+    r_lo = max(min_radius, int(r - 2 * scale))
+    r_hi = min(max_radius, int(np.ceil(r + 2 * scale)))
+    if r_hi <= r_lo:
+        return x, y, r
+
+    pad = r_hi + 2 * scale
+    x0, x1 = max(0, int(x - pad)), min(w, int(x + pad) + 1)
+    y0, y1 = max(0, int(y - pad)), min(h, int(y + pad) + 1)
+    roi = blurred[y0:y1, x0:x1]
+
+    local = _hough(roi, dp, max(roi.shape), param1, param2, r_lo, r_hi)
+    if local is None:
+        return x, y, r
+
+    cands = local[0]
+    d = (cands[:, 0] + x0 - x) ** 2 + (cands[:, 1] + y0 - y) ** 2
+    cx, cy, cr = cands[int(np.argmin(d))]
+    return cx + x0, cy + y0, cr
+
+def detect_circles(gray, mode='full', estimate_radius=False, dp=DP, min_dist=MIN_DIST,
+                   param1=PARAM1, param2=PARAM2, min_radius=MIN_RADIUS, max_radius=MAX_RADIUS,
+                   levels=PYRAMID_LEVELS, blurred=None):
+    # `blurred` may be a precomputed cv2.medianBlur(gray, 5) when the same image is searched repeatedly.
+    if mode not in CIRCLE_MODES:
+        raise ValueError(f"Unknown circle detection mode '{mode}'. Expected one of {CIRCLE_MODES}.")
+
+    if estimate_radius:
+        min_radius, max_radius = estimate_radius_range(gray, min_radius, max_radius)
+
+    if blurred is None:
+        blurred = cv2.medianBlur(gray, 5)
+
+    if mode == 'full' or levels < 1:
+        return _hough(blurred, dp, min_dist, param1, param2, min_radius, max_radius)
+
+    # Coarse pass on a downsampled pyramid level, then refine each radius locally at full resolution.
+    scale = 2 ** levels
+    small = blurred
+    for _ in range(levels):
+        small = cv2.pyrDown(small)
+
+    coarse = _hough(small, dp, max(1.0, min_dist / scale), param1, max(1.0, param2 / scale),
+                    max(1, min_radius // scale), max(2, int(np.ceil(max_radius / scale))))
+    if coarse is None:
+        return None
+
+    refined = []
+    for cx, cy, cr in coarse[0]:
+        x, y, r = _refine_circle(blurred, cx * scale, cy * scale, cr * scale, scale,
+                                 dp, param1, param2, min_radius, max_radius)
+        # Refinement can pull two coarse hits onto the same organoid; keep the first (strongest).
+        if any((x - px) ** 2 + (y - py) ** 2 < min_dist ** 2 for px, py, _ in refined):
+            continue
+        refined.append((x, y, r))
+
+    return np.array([refined], dtype=np.float32)
+
+def detect_circles_cached(img_path, gray, mode='full', estimate_radius=False, **params):
+    # Keyed on file content rather than path so the same image uploaded into separate
+    # request workspaces still shares one detection.
+    try:
+        digest = hashlib.sha1()
+        with open(img_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        key = (digest.hexdigest(), gray.shape, mode, bool(estimate_radius), tuple(sorted(params.items())))
+    except OSError:
+        return detect_circles(gray, mode=mode, estimate_radius=estimate_radius, **params)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            circles = _cache[key]
+            return None if circles is None else circles.copy()
+
+    circles = detect_circles(gray, mode=mode, estimate_radius=estimate_radius, **params)
+
+    with _cache_lock:
+        _cache[key] = circles
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return None if circles is None else circles.copy()
+
+def clear_circle_cache():
+    with _cache_lock:
+        _cache.clear()
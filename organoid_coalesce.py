@@ -0,0 +1,77 @@
+import hashlib
+import json
+import threading
+import time
+
+def request_key(digest, method, **params):
+    # Identity of an analysis: the combined SHA-256 of the uploads (Workspace.digest, in day
+    # order), the method and every parameter that changes the output.
+    blob = json.dumps([digest, method, params], sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+class _Call:
+    __slots__ = ('done', 'value', 'error', 'elapsed', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.elapsed = 0.0
+        self.waiters = 0
+
+class SingleFlight:
+    # Coalesces identical in-flight work: the first caller with a key runs it, callers arriving
+    # with the same key while it runs wait and get the same value (or exception). Nothing is kept
+    # once the computation finishes, so a later identical request runs again. Per process.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.computations = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.seconds_saved = 0.0
+        self.max_waiters = 0
+
+    def do(self, key, fn):
+        # (value, shared): shared is True when this caller waited on another caller's computation.
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.computations += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+
+        if not leader:
+            call.done.wait()
+            with self._lock:
+                self.seconds_saved += call.elapsed
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        started = time.perf_counter()
+        try:
+            call.value = fn()
+            return call.value, False
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            call.elapsed = time.perf_counter() - started
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            requests = self.computations + self.coalesced
+            return {'in_flight': len(self._calls), 'computations': self.computations, 'coalesced': self.coalesced,
+                    'dedup_ratio': round(self.coalesced / requests, 4) if requests else 0.0,
+                    'seconds_saved': round(self.seconds_saved, 2), 'max_waiters': self.max_waiters,
+                    'errors': self.errors}
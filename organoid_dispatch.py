@@ -0,0 +1,138 @@
+import json
+import os
+
+from organoid_resources import governor
+from organoid_buffers import MemoryTracker
+from organoid_vectors import OUTPUT_MODES
+from organoid_roi import ROI_MODE, roi_sources, restore
+from organoid_analysis import analyze_organoids as analyze_basic
+from organoid_analysis_watershed import analyze_organoids_watershed
+from organoid_analysis_hough import analyze_organoids_hough
+from organoid_analysis_morphology import analyze_organoids_morphology
+from organoid_analysis_commercial_sims import analyze_arivis_sim, analyze_assayscope_sim
+
+try:
+    from organoid_analysis_unet import analyze_organoids_unet
+    UNET_AVAILABLE = True
+except Exception as e:
+    print(f"Warning: U-Net not available ({type(e).__name__}). U-Net method will use fallback.")
+    UNET_AVAILABLE = False
+    def analyze_organoids_unet(image_paths, output='image', scale=1.0):
+        from organoid_analysis_unet import analyze_organoids_unet_fallback
+        return analyze_organoids_unet_fallback(image_paths, output, scale)
+
+try:
+    from organoid_analysis_stardist import analyze_organoids_stardist
+    STARDIST_AVAILABLE = True
+except Exception as e:
+    print(f"Warning: StarDist not available ({e}). StarDist method will use fallback.")
+    STARDIST_AVAILABLE = False
+    def analyze_organoids_stardist(image_paths, output='image', scale=1.0):
+        from organoid_analysis_stardist import analyze_organoids_stardist_fallback
+        return analyze_organoids_stardist_fallback(image_paths, output, scale)
+
+_models = None
+
+def model_availability():
+    # Whether the deep-learning methods run a real model in this process rather than their
+    # image-processing fallback (the analyzer modules import either way). Looked up once per process.
+    global _models
+    if _models is None:
+        unet = stardist = False
+        if UNET_AVAILABLE:
+            from organoid_analysis_unet import TENSORFLOW_AVAILABLE
+            from organoid_unet_runtime import find_runtime_model
+            unet = TENSORFLOW_AVAILABLE or find_runtime_model() is not None
+        if STARDIST_AVAILABLE:
+            import organoid_analysis_stardist
+            stardist = organoid_analysis_stardist.STARDIST_AVAILABLE
+        _models = {'unet': unet, 'stardist': stardist}
+    return _models
+
+# method -> (analyzer, debug subfolder, debug image name)
+METHODS = {
+    'basic': (analyze_basic, 'debug_output', 'debug_day{day}.jpg'),
+    'watershed': (analyze_organoids_watershed, 'debug_output_watershed', 'watershed_debug_day{day}.jpg'),
+    'hough': (analyze_organoids_hough, 'debug_output_hough', 'hough_debug_day{day}.jpg'),
+    'stardist': (analyze_organoids_stardist, 'debug_output_stardist', 'stardist_debug_day{day}.jpg'),
+    'morphology': (analyze_organoids_morphology, 'debug_output_morphology', 'morphology_debug_day{day}.jpg'),
+    'arivis': (analyze_arivis_sim, 'debug_output_arivis', 'arivis_debug_day{day}.jpg'),
+    'assayscope': (analyze_assayscope_sim, 'debug_output_assayscope', 'assayscope_debug_day{day}.jpg'),
+    'unet': (analyze_organoids_unet, 'debug_output_unet', 'unet_debug_day{day}.jpg'),
+}
+
+CIRCLE_METHODS = ('hough', 'assayscope')
+
+def resolve_method(method):
+    return method if method in METHODS else 'basic'
+
+def run_analysis(method, image_map, circle_mode='full', estimate_radius=False, output='image', roi=ROI_MODE,
+                 roi_key=None, scale=1.0):
+    # `scale` is the size of the images relative to the originals (a preview's downscale factor);
+    # analyzers multiply their pixel-unit size filters and radii by it, and areas by its square.
+    analyze_fn = METHODS[resolve_method(method)][0]
+    if output not in OUTPUT_MODES:
+        output = 'image'
+    if roi != 'auto':
+        return _analyze(analyze_fn, method, image_map, circle_mode, estimate_radius, output, scale)
+    # Analyzers see only the cropped well; results are mapped back to the full frame afterwards.
+    rois = {}
+    results = _analyze(analyze_fn, method, roi_sources(image_map, rois, roi_key), circle_mode, estimate_radius,
+                       output, scale)
+    if isinstance(results, dict):
+        return results
+    return restore(results, rois, lambda day, path: debug_path(method, os.path.dirname(path), day))
+
+def _analyze(analyze_fn, method, image_map, circle_mode, estimate_radius, output, scale):
+    if method in CIRCLE_METHODS:
+        return analyze_fn(image_map, circle_mode=circle_mode, estimate_radius=estimate_radius, output=output,
+                          scale=scale)
+    return analyze_fn(image_map, output=output, scale=scale)
+
+def debug_subfolder(method):
+    return METHODS[resolve_method(method)][1]
+
+def debug_path(method, image_dir, day):
+    _, subfolder, name = METHODS[resolve_method(method)]
+    return os.path.join(image_dir, subfolder, name.format(day=day))
+
+def attach_urls(res, method, workspace, origins, image_dir=None):
+    day = res['day']
+    origin = origins.get(day)
+    res['original_url'] = workspace.url_for(origin) if origin else None
+    debug_file = debug_path(method, image_dir or workspace.path, day)
+    # Vector output skips the overlay JPEG when the browser can draw on the upload itself.
+    res['debug_url'] = workspace.url_for(debug_file) if os.path.exists(debug_file) else None
+    return res
+
+def stream_analysis(method, sources, origins, workspace, options, store=None, meta=None):
+    # One NDJSON line per processed day/frame, then a summary line. Frames are decoded and
+    # analyzed one at a time, so memory stays at a single frame however long the stack is. Each
+    # image runs under its own deadline; one that fails or times out gets an error line and the
+    # stream carries on. A client that disconnects closes the generator between images.
+    from organoid_isolation import iter_guarded, summarize
+
+    count = 0
+    images = []
+    recorded = []
+    with governor.request_slot() as threads, MemoryTracker() as mem:
+        try:
+            for entry, results in iter_guarded(method, sources, options, threads=threads, memory=mem):
+                images.append(entry)
+                if 'error' in entry:
+                    yield json.dumps({'type': 'error', 'day': entry['day'], 'status': entry['status'],
+                                      'error': entry['error']}) + '\n'
+                    continue
+                for res in results:
+                    count += 1
+                    recorded.append(res)
+                    yield json.dumps({'type': 'result', 'result': attach_urls(res, method, workspace, origins)}) + '\n'
+        except Exception as e:
+            print(f"Stream Error: {e}")
+            yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+
+    if store is not None:
+        store.record(workspace.id, method, recorded, images, origin='stream', **(meta or {}))
+    yield json.dumps({'type': 'done', 'success': True, 'method': method, 'workspace': workspace.id,
+                      'count': count, 'image_status': summarize(images), 'memory': mem.report(),
+                      'threads': threads}) + '\n'
@@ -0,0 +1,273 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from organoid_dispatch import METHODS, run_analysis
+from organoid_frames import Frame, iter_images
+from organoid_progressive import downscale, scale_result
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+DEFAULT_MODES = ('preview@480', 'preview@960')
+# Circles smaller than this are centre dots drawn next to the real outline (Hough).
+MIN_CIRCLE_RADIUS = 3
+
+# Accuracy a candidate mode must keep against the full-resolution reference, per image:
+# relative count error, relative error of the total segmented area, and IoU of the object masks.
+TOLERANCES = {
+    'max_count_error': 0.10,
+    'max_area_error': 0.10,
+    'min_iou': 0.85,
+}
+
+# Runs every analysis method at full resolution (the reference) and in each faster mode on the
+# same images, then reports count error, area error, mask IoU and speedup in one table. Exits with
+# status 1 when a mode falls outside the tolerances, so it can gate a change in CI:
+#
+#   python organoid_eval.py --synthetic 12
+#   python organoid_eval.py --images path/to/plates --methods watershed,hough --modes preview@480
+#   python organoid_eval.py --images dir --tolerances '{"min_iou": 0.9}' --json report.json
+#
+# A new fast path is added by registering a mode: a function (method, img, work_dir) -> result
+# dict with `shapes` in full-resolution pixels, like MODES below.
+
+def analyze_frame(method, img, work_dir, name, roi='off', scale=1.0):
+    # Debug output goes to work_dir, never next to the corpus images. Whole frames unless a mode
+    # asks for the ROI stage, whatever ORGANOID_ROI says.
+    results = run_analysis(method, {1: Frame(img, os.path.join(work_dir, name), 0)}, output='vector', roi=roi,
+                           scale=scale)
+    if isinstance(results, dict) or not results:
+        return None
+    return results[0]
+
+def reference_mode(method, img, work_dir):
+    return analyze_frame(method, img, work_dir, 'reference')
+
+def preview_mode(max_side):
+    def run(method, img, work_dir):
+        small = downscale(img, max_side)
+        scale = small.shape[1] / img.shape[1]
+        res = analyze_frame(method, small, work_dir, f'preview{max_side}', scale=scale)
+        if res is None:
+            return None
+        res = scale_result(res, scale, (img.shape[1], img.shape[0]))
+        res['shapes'] = [scale_shape(shape, 1.0 / scale) for shape in res.get('shapes', [])]
+        return res
+    return run
+
+def isolated_mode(method, img, work_dir):
+    # The per-image worker-process path (organoid_isolation); should match the reference exactly.
+    from organoid_isolation import run_guarded
+    results, _ = run_guarded(method, [(1, Frame(img, os.path.join(work_dir, 'isolated'), 0))],
+                             {'output': 'vector', 'roi': 'off'}, isolation='process')
+    return results[0] if results else None
+
+def roi_mode(method, img, work_dir):
+    # Only the detected well is analyzed (organoid_roi). Identical to the reference on images
+    # without a visible well; on plates, objects outside the well are meant to go missing.
+    return analyze_frame(method, img, work_dir, 'roi', roi='auto')
+
+MODES = {'isolated': isolated_mode, 'roi': roi_mode}
+
+def resolve_mode(name):
+    if name in MODES:
+        return MODES[name]
+    if name.startswith('preview@'):
+        return preview_mode(int(name.split('@', 1)[1]))
+    raise ValueError(f"Unknown mode {name!r}; available: {', '.join(sorted(MODES))}, preview@<max side>")
+
+def scale_shape(shape, f):
+    shape = dict(shape)
+    if shape['type'] == 'polygon':
+        shape['points'] = [[x * f, y * f] for x, y in shape['points']]
+    for key in ('x', 'y', 'r', 'w', 'h', 'size'):
+        if key in shape:
+            shape[key] = shape[key] * f
+    return shape
+
+def object_mask(shapes, size):
+    # Filled objects of a vector result; markers and Hough centre dots are annotations, not objects.
+    mask = np.zeros((size[1], size[0]), np.uint8)
+    for shape in shapes or ():
+        if shape['type'] == 'polygon' and len(shape['points']) >= 3:
+            cv2.fillPoly(mask, [np.round(np.asarray(shape['points'])).astype(np.int32)], 1)
+        elif shape['type'] == 'circle' and shape['r'] >= MIN_CIRCLE_RADIUS:
+            cv2.circle(mask, (round(shape['x']), round(shape['y'])), round(shape['r']), 1, -1)
+        elif shape['type'] == 'box':
+            x, y = round(shape['x']), round(shape['y'])
+            cv2.rectangle(mask, (x, y), (x + round(shape['w']), y + round(shape['h'])), 1, -1)
+    return mask
+
+def compare(ref, cand, size):
+    a = object_mask(ref.get('shapes'), size)
+    b = object_mask(cand.get('shapes'), size)
+    union = np.count_nonzero(a | b)
+    ref_area, cand_area = np.count_nonzero(a), np.count_nonzero(b)
+    return {
+        'count_error': abs(cand['count'] - ref['count']) / max(ref['count'], 1),
+        'area_error': abs(cand_area - ref_area) / max(ref_area, 1),
+        'iou': np.count_nonzero(a & b) / union if union else 1.0,
+    }
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+def synthetic_corpus(out_dir, n=12, size=(1600, 1200), seed=0):
+    # Organoid-like blobs on an uneven, noisy background: textured elliptical bodies with darker
+    # rims, a range of sizes and some touching pairs. Deterministic for a given seed.
+    rng = np.random.default_rng(seed)
+    paths = []
+    w, h = size
+    yy, xx = np.mgrid[0:h, 0:w]
+    for i in range(n):
+        background = 170 + 25 * np.sin(xx / w * np.pi + i) * np.cos(yy / h * np.pi)
+        img = background + rng.normal(0, 6, (h, w))
+        for _ in range(rng.integers(10, 30)):
+            cx, cy = rng.integers(80, w - 80), rng.integers(80, h - 80)
+            axes = (int(rng.integers(20, 90)), int(rng.integers(20, 90)))
+            angle = float(rng.uniform(0, 180))
+            body = np.zeros((h, w), np.uint8)
+            cv2.ellipse(body, (int(cx), int(cy)), axes, angle, 0, 360, 1, -1)
+            rim = np.zeros((h, w), np.uint8)
+            cv2.ellipse(rim, (int(cx), int(cy)), axes, angle, 0, 360, 1, max(2, min(axes) // 8))
+            img[body > 0] = rng.uniform(70, 110) + rng.normal(0, 10, np.count_nonzero(body))
+            img[rim > 0] -= 25
+        img = cv2.GaussianBlur(np.clip(img, 0, 255).astype(np.uint8), (5, 5), 0)
+        path = os.path.join(out_dir, f"synthetic_{i:03d}.png")
+        cv2.imwrite(path, cv2.cvtColor(img, cv2.COLOR_GRAY2BGR))
+        paths.append(path)
+    return paths
+
+def corpus(image_dir):
+    return sorted(os.path.join(image_dir, n) for n in os.listdir(image_dir)
+                  if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS)
+
+def evaluate(paths, methods, modes, tolerances=TOLERANCES):
+    # One row per (method, mode) with per-image errors aggregated (mean and worst), timings and
+    # speedup; `passed` applies the tolerances to the worst image.
+    rows = []
+    with tempfile.TemporaryDirectory() as work_dir, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        images = [(os.path.basename(p), img) for _, p, img in iter_images([(i, p) for i, p in enumerate(paths)])]
+        for method in methods:
+            references = []
+            for name, img in images:
+                ref, seconds = timed(reference_mode, method, img, work_dir)
+                references.append((name, img, ref, seconds))
+            for mode in modes:
+                fn = resolve_mode(mode)
+                per_image = []
+                for name, img, ref, ref_seconds in references:
+                    cand, seconds = timed(fn, method, img, work_dir)
+                    if ref is None or cand is None:
+                        per_image.append({'image': name, 'error': 'no result'})
+                        continue
+                    metrics = compare(ref, cand, (img.shape[1], img.shape[0]))
+                    metrics.update(image=name, count=[ref['count'], cand['count']],
+                                   reference_ms=ref_seconds * 1000, candidate_ms=seconds * 1000)
+                    per_image.append(metrics)
+                rows.append(summarize(method, mode, per_image, tolerances))
+    return rows
+
+def summarize(method, mode, per_image, tolerances):
+    ok = [m for m in per_image if 'error' not in m]
+    row = {'method': method, 'mode': mode, 'images': len(per_image), 'failed_images': len(per_image) - len(ok)}
+    if ok:
+        ref_ms = sum(m['reference_ms'] for m in ok)
+        cand_ms = sum(m['candidate_ms'] for m in ok)
+        row.update({
+            'count_error_mean': float(np.mean([m['count_error'] for m in ok])),
+            'count_error_max': max(m['count_error'] for m in ok),
+            'area_error_mean': float(np.mean([m['area_error'] for m in ok])),
+            'area_error_max': max(m['area_error'] for m in ok),
+            'iou_mean': float(np.mean([m['iou'] for m in ok])),
+            'iou_min': min(m['iou'] for m in ok),
+            'reference_ms': ref_ms / len(ok),
+            'candidate_ms': cand_ms / len(ok),
+            'speedup': ref_ms / cand_ms if cand_ms else float('inf'),
+        })
+    failures = []
+    if row['failed_images']:
+        failures.append(f"{row['failed_images']} image(s) without a result")
+    if ok and row['count_error_max'] > tolerances['max_count_error']:
+        failures.append(f"count error {row['count_error_max']:.1%} > {tolerances['max_count_error']:.1%}")
+    if ok and row['area_error_max'] > tolerances['max_area_error']:
+        failures.append(f"area error {row['area_error_max']:.1%} > {tolerances['max_area_error']:.1%}")
+    if ok and row['iou_min'] < tolerances['min_iou']:
+        failures.append(f"IoU {row['iou_min']:.3f} < {tolerances['min_iou']:.3f}")
+    row['passed'] = not failures
+    row['failures'] = failures
+    row['per_image'] = per_image
+    return row
+
+def format_table(rows):
+    header = ('method', 'mode', 'imgs', 'count err (mean/max)', 'area err (mean/max)', 'IoU (mean/min)',
+              'ref ms', 'mode ms', 'speedup', 'result')
+    lines = [header]
+    for r in rows:
+        if 'speedup' not in r:
+            lines.append((r['method'], r['mode'], str(r['images']), '-', '-', '-', '-', '-', '-', 'FAIL'))
+            continue
+        lines.append((
+            r['method'], r['mode'], str(r['images']),
+            f"{r['count_error_mean']:.1%} / {r['count_error_max']:.1%}",
+            f"{r['area_error_mean']:.1%} / {r['area_error_max']:.1%}",
+            f"{r['iou_mean']:.3f} / {r['iou_min']:.3f}",
+            f"{r['reference_ms']:.0f}", f"{r['candidate_ms']:.0f}", f"{r['speedup']:.1f}x",
+            'ok' if r['passed'] else 'FAIL',
+        ))
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    out = ['  '.join(cell.ljust(w) for cell, w in zip(line, widths)) for line in lines]
+    out.insert(1, '  '.join('-' * w for w in widths))
+    for r in rows:
+        for failure in r['failures']:
+            out.append(f"FAIL {r['method']} {r['mode']}: {failure}")
+    return '\n'.join(out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare fast analysis modes against the full-resolution reference.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', help="directory of images to evaluate on")
+    source.add_argument('--synthetic', type=int, metavar='N', help="generate N synthetic images instead")
+    parser.add_argument('--methods', default=','.join(METHODS), help="comma-separated (default: all)")
+    parser.add_argument('--modes', default=','.join(DEFAULT_MODES),
+                        help=f"comma-separated: preview@<max side>, {', '.join(MODES)}")
+    parser.add_argument('--tolerances', default='{}', help=f"JSON overriding {json.dumps(TOLERANCES)}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the full report (with per-image rows) here")
+    args = parser.parse_args(argv)
+
+    tolerances = dict(TOLERANCES, **json.loads(args.tolerances))
+    methods = [m for m in args.methods.split(',') if m]
+    unknown = [m for m in methods if m not in METHODS]
+    if unknown:
+        parser.error(f"unknown method(s): {', '.join(unknown)}")
+    modes = [m for m in args.modes.split(',') if m]
+    for mode in modes:
+        try:
+            resolve_mode(mode)
+        except ValueError as e:
+            parser.error(str(e))
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        paths = synthetic_corpus(synthetic_dir, args.synthetic, seed=args.seed) if args.synthetic else corpus(args.images)
+        if not paths:
+            parser.error("no images found")
+        rows = evaluate(paths, methods, modes, tolerances)
+
+    print(format_table(rows))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'tolerances': tolerances, 'images': len(paths), 'rows': rows}, f, indent=2)
+    return 0 if all(r['passed'] for r in rows) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
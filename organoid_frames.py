@@ -0,0 +1,150 @@
+import cv2
+import numpy as np
+import os
+
+from organoid_microscopy import MicroscopyImage, is_tiff, to_uint8
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.mpg', '.mpeg')
+
+class Frame:
+    # A decoded timepoint that did not come from its own image file. `path` is a virtual
+    # "<source>#<index>" name; its directory is where debug output for the frame is written.
+    __slots__ = ('image', 'path', 'index')
+
+    def __init__(self, image, path, index=0):
+        self.image = image
+        self.path = path
+        self.index = index
+
+    def load(self):
+        return self.image
+
+def to_bgr8(image, bit_depth=None):
+    img = np.asarray(image)
+    while img.ndim > 3:
+        img = img[0]
+
+    img = to_uint8(img, bit_depth)
+
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 1:
+        return cv2.cvtColor(img[:, :, 0], cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)
+    if img.shape[2] == 3:
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    return cv2.cvtColor(np.ascontiguousarray(img[:, :, 0]), cv2.COLOR_GRAY2BGR)
+
+def is_video(path):
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+def tiff_plane_count(path):
+    # Planes are timepoints/z positions; channels of one plane do not count as frames.
+    if not is_tiff(path):
+        return 0
+    try:
+        with MicroscopyImage(path) as stack:
+            return stack.planes
+    except Exception:
+        return 0
+
+def is_multiframe(path):
+    return is_video(path) or tiff_plane_count(path) > 1
+
+def _iter_tiff(path, step=1, channel=None, bit_depth=None):
+    with MicroscopyImage(path) as stack:
+        depth = bit_depth or stack.scale_depth(channel)
+        for i, _, plane in stack.iter_planes(channel=channel, step=step):
+            yield i, to_bgr8(plane, depth)
+
+def _iter_video(path, step=1):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video {path}")
+    try:
+        i = 0
+        while True:
+            if step > 1 and i % step:
+                if not cap.grab():
+                    break
+                i += 1
+                continue
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield i, frame
+            i += 1
+    finally:
+        cap.release()
+
+def open_frames(path, step=1, start_day=1, channel=None, bit_depth=None):
+    frames = _iter_video(path, step) if is_video(path) else _iter_tiff(path, step, channel, bit_depth)
+    day = start_day
+    for index, img in frames:
+        yield day, Frame(img, f"{path}#{index}", index)
+        day += 1
+
+def expand_sources(image_map, step=1, origins=None, channel=None, bit_depth=None,
+                   zstack=False, projection='max', z_scale=None):
+    # Expands multi-page TIFFs and videos in a {day: path} map into one day per frame, lazily.
+    # Plain images keep their day; frames take the following days. `origins` (if given) is filled
+    # with day -> file path for plain images and None for frames. TIFFs are always read through
+    # MicroscopyImage so `channel` and `bit_depth` apply to single-plane files as well. With
+    # `zstack`, each multi-plane TIFF yields one ZStack per timepoint instead of one frame per plane.
+    day = 1
+    for map_day, path in sorted(image_map.items()):
+        day = max(day, map_day)
+        if zstack and is_tiff(path) and tiff_plane_count(path) > 1:
+            from organoid_zstack import open_zstacks
+            for stack_day, stack in open_zstacks(path, channel=channel, bit_depth=bit_depth, projection=projection,
+                                                 z_scale=z_scale, start_day=day):
+                if origins is not None:
+                    origins[stack_day] = None
+                yield stack_day, stack
+                day = stack_day + 1
+        elif is_video(path) or is_tiff(path):
+            single = is_tiff(path) and tiff_plane_count(path) <= 1
+            for frame_day, frame in open_frames(path, step=step, start_day=day, channel=channel, bit_depth=bit_depth):
+                if origins is not None:
+                    origins[frame_day] = path if single else None
+                yield frame_day, frame
+                day = frame_day + 1
+        else:
+            if origins is not None:
+                origins[day] = path
+            yield day, path
+            day += 1
+
+def iter_images(image_paths):
+    # Accepts the usual {day: path} dict, {day: Frame} or any iterable of (day, path|Frame)
+    # pairs such as open_frames(), and yields one decoded BGR image at a time.
+    items = image_paths.items() if hasattr(image_paths, 'items') else image_paths
+    for day, source in items:
+        if isinstance(source, Frame):
+            img = source.load()
+            if img is None:
+                continue
+            yield day, source.path, img
+            continue
+
+        if not os.path.exists(source):
+            print(f"Error: {source} not found.")
+            continue
+
+        if is_tiff(source):
+            try:
+                with MicroscopyImage(source) as stack:
+                    img = to_bgr8(stack.read(), stack.scale_depth())
+            except Exception as e:
+                print(f"Error: Could not read {source}: {e}")
+                continue
+            yield day, source, img
+            continue
+
+        img = cv2.imread(source)
+        if img is None:
+            print(f"Error: Could not read {source}")
+            continue
+
+        yield day, source, img
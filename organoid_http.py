@@ -0,0 +1,148 @@
+import gzip
+import os
+import threading
+from collections import OrderedDict
+
+from werkzeug.security import safe_join
+
+from organoid_workspace import VERSION_LENGTH, file_digest
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESS_MIN_BYTES = int(os.environ.get('ORGANOID_COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_MAX_BYTES = 16 * 1024 * 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/css', 'text/plain', 'text/javascript',
+                      'application/javascript', 'image/svg+xml')
+COMPRESSED_CACHE_ENTRIES = 32
+VERSION_CACHE_ENTRIES = 1024
+
+def _encodings():
+    return ('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # mtime=0 keeps the output (and so its ETag) identical for identical input.
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+class CompressedCache:
+    # Compressed bodies of file responses (the /methods page, templates) keyed by their ETag and
+    # encoding, so a static page is compressed once rather than on every request.
+    def __init__(self, max_entries=COMPRESSED_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, data_fn, encoding):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        body = compress(data_fn(), encoding)
+        with self._lock:
+            self._entries[key] = body
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body
+
+compressed_cache = CompressedCache()
+
+class FileVersions:
+    # Content versions of static files, as Workspace.version_of computes them, keyed by path and
+    # recomputed only when the file's size or mtime changes.
+    def __init__(self, max_entries=VERSION_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(path)
+                return entry[1]
+        version = file_digest(path)[:VERSION_LENGTH]
+        with self._lock:
+            self._entries[path] = (stamp, version)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return version
+
+file_versions = FileVersions()
+
+def _current_version(request, static_prefix, static_folder):
+    # True when ?v= names the content the static file has now; any other value (a stale or made-up
+    # version) must not pin today's bytes in caches for a year.
+    if static_folder is None:
+        return False
+    path = safe_join(static_folder, request.path[len(static_prefix):])
+    return path is not None and file_versions.get(path) == request.args.get('v')
+
+def _compressible(response):
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return False
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return False
+    # Generators (the NDJSON stream) are left alone; file responses have a known length.
+    if response.is_streamed and not response.direct_passthrough:
+        return False
+    length = response.content_length
+    return length is None or COMPRESS_MIN_BYTES <= length <= COMPRESS_MAX_BYTES
+
+def _compress_response(request, response):
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(_encodings())
+    if not encoding:
+        return
+    response.direct_passthrough = False
+    etag, weak = response.get_etag()
+    if etag:
+        body = compressed_cache.get((etag, encoding), response.get_data, encoding)
+        if hasattr(response.response, 'close'):
+            response.response.close()
+        # A compressed variant is a different representation, so it needs its own validator.
+        response.set_etag(f"{etag}-{encoding}", weak)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return
+        body = compress(data, encoding)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+
+def finalize_response(request, response, static_prefix='/static/', static_folder=None):
+    # Applied to every response from after_request:
+    # - static files requested with their current content version (?v=<digest>, see
+    #   Workspace.url_for) are cached for a year as immutable; unversioned ones, and those whose
+    #   v does not match, keep Flask's no-cache + ETag revalidation;
+    # - JSON/HTML bodies are gzip- (or brotli-, when installed) compressed if the client accepts it;
+    # - GET responses get an ETag and answer If-None-Match with 304.
+    if (request.path.startswith(static_prefix) and request.args.get('v') and response.status_code == 200
+            and _current_version(request, static_prefix, static_folder)):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+
+    if request.method in ('GET', 'HEAD') and response.status_code == 200 and not response.is_streamed:
+        if not response.get_etag()[0]:
+            response.add_etag()
+
+    if _compressible(response):
+        _compress_response(request, response)
+
+    if request.method in ('GET', 'HEAD') and response.status_code == 200 and response.get_etag()[0]:
+        response.make_conditional(request)
+    return response
@@ -0,0 +1,269 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import organoid_shm
+from organoid_buffers import trim_pool
+from organoid_shm import SharedFrame, shareable, shared_frame
+
+# 'process' runs each image in a pooled worker process that is killed when it overruns its
+# deadline (or when the request is cancelled); 'inline' analyzes in the request thread, where
+# deadlines and cancellation can only be checked between images; 'queue' hands each image to
+# standalone workers (organoid_worker.py, on any node) through the ORGANOID_QUEUE task queue.
+ISOLATION = os.environ.get('ORGANOID_ISOLATION', 'process')
+IMAGE_TIMEOUT = float(os.environ.get('ORGANOID_IMAGE_TIMEOUT', '60'))
+# Whole-request budget for synchronous /analyze, kept under gunicorn's --timeout 300 so the
+# response (with whatever finished) is sent before the worker would be killed.
+REQUEST_BUDGET = float(os.environ.get('ORGANOID_REQUEST_BUDGET', '270'))
+MAX_IDLE_WORKERS = int(os.environ.get('ORGANOID_ISOLATION_IDLE', '2'))
+# forkserver forks workers from a clean helper process, so the request threads and any loaded
+# TensorFlow runtime of the server are never forked; Windows (the desktop build) only has spawn.
+START_METHOD = os.environ.get('ORGANOID_ISOLATION_START') or (
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+CANCEL_POLL = 0.2
+# A worker that gets no next image within this many seconds treats the request as done and empties
+# its buffer pool.
+WORKER_TRIM_IDLE = 1.0
+
+# Per-image statuses reported next to the results.
+OK = 'ok'
+EMPTY = 'empty'          # analyzed, but the image could not be read or produced no result
+FAILED = 'error'         # the analyzer raised or returned an error
+TIMEOUT = 'timeout'      # killed after its per-image deadline
+CANCELLED = 'cancelled'  # the request was cancelled while this image ran
+
+def _worker_main(conn):
+    # Loop of a pooled worker: (method, day, source, options, threads) in, (status, payload, peaks)
+    # out, where peaks is the MemoryTracker measurement of the image (the server cannot see it).
+    import cv2
+    from organoid_buffers import MemoryTracker
+    from organoid_dispatch import run_analysis
+
+    while True:
+        try:
+            if not conn.poll(WORKER_TRIM_IDLE):
+                trim_pool()
+            task = conn.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+        method, day, source, options, threads = task
+        cv2.setNumThreads(threads)
+        mem = MemoryTracker()
+        try:
+            with mem:
+                results = run_analysis(method, {day: source}, **options)
+            if isinstance(results, dict) and "error" in results:
+                conn.send((FAILED, results["error"], mem.peaks()))
+            else:
+                conn.send((OK, results, mem.peaks()))
+        except Exception as e:
+            conn.send((FAILED, f"{type(e).__name__}: {e}", mem.peaks()))
+        finally:
+            if isinstance(source, SharedFrame):
+                source.detach()
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child,), name='organoid-isolated', daemon=True)
+        self.process.start()
+        child.close()
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(5)
+        self.conn.close()
+
+class WorkerPool:
+    # Warm worker processes, reused across images and requests. A worker that overruns its
+    # deadline, is cancelled or dies (segfault, OOM kill) is discarded and the next image gets
+    # a fresh one, so a pathological image never takes the server process down with it.
+    def __init__(self, max_idle=MAX_IDLE_WORKERS, start_method=START_METHOD):
+        self.max_idle = max_idle
+        self.start_method = start_method
+        self._ctx = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self.started = 0
+        self.killed = 0
+        self.crashed = 0
+        self.tasks = 0
+
+    def _context(self):
+        # No forkserver preload: with one, the server's __main__ (app.py when run directly) would be
+        # imported into the fork server too. Each worker imports the analyzers once and is reused.
+        if self._ctx is None:
+            self._ctx = multiprocessing.get_context(self.start_method)
+        return self._ctx
+
+    def _take(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive():
+                    return worker
+            self.started += 1
+            ctx = self._context()
+        return _Worker(ctx)
+
+    def _give(self, worker):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(worker)
+                return
+        worker.close()
+
+    def _discard(self, worker):
+        with self._lock:
+            self.killed += 1
+        worker.kill()
+
+    def run(self, method, day, source, options, threads, timeout, cancel=None):
+        # (status, results-or-error message, memory peaks or None) for one image.
+        worker = self._take()
+        with self._lock:
+            self.tasks += 1
+        try:
+            worker.conn.send((method, day, source, options, threads))
+        except (OSError, ValueError) as e:
+            self._discard(worker)
+            return FAILED, f"Could not hand the image to a worker: {e}", None
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._discard(worker)
+                return TIMEOUT, f"Exceeded the {timeout:.0f} s per-image time limit", None
+            if cancel is not None and cancel.is_set():
+                self._discard(worker)
+                return CANCELLED, "Cancelled", None
+            if worker.conn.poll(min(remaining, CANCEL_POLL)):
+                try:
+                    status, payload, peaks = worker.conn.recv()
+                except (EOFError, OSError):
+                    break
+                self._give(worker)
+                return status, payload, peaks
+            if not worker.alive():
+                break
+        with self._lock:
+            self.crashed += 1
+        self._discard(worker)
+        return FAILED, f"Worker process exited unexpectedly (code {worker.process.exitcode})", None
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
+
+    def stats(self):
+        with self._lock:
+            return {'start_method': self.start_method, 'idle': len(self._idle), 'max_idle': self.max_idle,
+                    'started': self.started, 'killed': self.killed, 'crashed': self.crashed, 'tasks': self.tasks,
+                    'shared_memory': organoid_shm.stats()}
+
+pool = WorkerPool()
+
+def _label(source):
+    return os.path.basename(getattr(source, 'path', source))
+
+def _run_inline(method, day, source, options):
+    # Same contract as WorkerPool.run; the caller's own MemoryTracker sees this image.
+    from organoid_dispatch import run_analysis
+    try:
+        results = run_analysis(method, {day: source}, **options)
+    except Exception as e:
+        return FAILED, f"{type(e).__name__}: {e}", None
+    if isinstance(results, dict) and "error" in results:
+        return FAILED, results["error"], None
+    return OK, results, None
+
+def iter_guarded(method, sources, options, threads=1, image_timeout=IMAGE_TIMEOUT, budget=None, cancel=None,
+                 isolation=ISOLATION, memory=None):
+    # Analyzes (day, source) pairs one at a time and yields (status entry, results) for each, so a
+    # bad frame costs only its own time. Stops early (with a final entry whose status says why)
+    # when `cancel` is set or the request `budget` in seconds runs out. Peaks measured in worker
+    # processes are credited to the request's MemoryTracker `memory`.
+    try:
+        yield from _iter_guarded(method, sources, options, threads, image_timeout, budget, cancel, isolation, memory)
+    finally:
+        # In the thread that ran the request: inline analyses leave their buffers in its pool.
+        trim_pool()
+
+def _iter_guarded(method, sources, options, threads, image_timeout, budget, cancel, isolation, memory):
+    # In queue mode the next few images are already queued for other workers meanwhile.
+    started = time.monotonic()
+    queue_client = None
+    if isolation == 'queue':
+        import organoid_queue
+        queue_client = organoid_queue.client()
+        sources = queue_client.prefetch(method, sources, options, image_timeout)
+    for day, source in sources:
+        if cancel is not None and cancel.is_set():
+            yield {'day': day, 'source': _label(source), 'status': CANCELLED, 'stopped': True,
+                   'error': "Cancelled before this image started"}, []
+            return
+        timeout = image_timeout
+        if budget:
+            remaining = budget - (time.monotonic() - started)
+            if remaining <= 0:
+                yield {'day': day, 'source': _label(source), 'status': TIMEOUT, 'stopped': True,
+                       'error': f"Request time budget of {budget:.0f} s used up before this image"}, []
+                return
+            timeout = min(timeout, remaining)
+
+        t0 = time.perf_counter()
+        if queue_client is not None and isinstance(source, organoid_queue.Ticket):
+            status, payload, peaks = queue_client.wait(source, timeout, cancel)
+        elif isolation in ('process', 'queue') and shareable(source):
+            # Decoded frames go to the worker through shared memory instead of the pipe.
+            with shared_frame(source) as handle:
+                status, payload, peaks = pool.run(method, day, handle, options, threads, timeout, cancel)
+        elif isolation in ('process', 'queue'):
+            status, payload, peaks = pool.run(method, day, source, options, threads, timeout, cancel)
+        else:
+            status, payload, peaks = _run_inline(method, day, source, options)
+        if memory is not None:
+            memory.add_worker(peaks)
+        entry = {'day': day, 'source': _label(source), 'status': status,
+                 'elapsed_ms': round((time.perf_counter() - t0) * 1000, 1)}
+        results = []
+        if status == OK:
+            results = payload
+            if not results:
+                entry['status'] = EMPTY
+        else:
+            entry['error'] = payload
+            print(f"Image {entry['source']} (day {day}): {status} - {payload}")
+        yield entry, results
+
+def run_guarded(method, sources, options, **kwargs):
+    # (results, per-image status entries); see iter_guarded.
+    results, images = [], []
+    for entry, image_results in iter_guarded(method, sources, options, **kwargs):
+        images.append(entry)
+        results.extend(image_results)
+    return results, images
+
+def summarize(images):
+    counts = {}
+    for entry in images:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    return counts
+
+def is_partial(images):
+    return any(entry['status'] not in (OK, EMPTY) for entry in images)
@@ -0,0 +1,246 @@
+import os
+import re
+
+import cv2
+import numpy as np
+
+try:
+    import tifffile
+    TIFFFILE_AVAILABLE = True
+except ImportError:
+    TIFFFILE_AVAILABLE = False
+
+try:
+    import zarr
+    ZARR_AVAILABLE = True
+except ImportError:
+    ZARR_AVAILABLE = False
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+SPATIAL_AXES = 'YX'
+CHANNEL_AXES = ('C', 'S')
+# Planes sampled to infer the bit depth of a file without SignificantBits.
+DEPTH_SAMPLES = 16
+
+def is_tiff(path):
+    return os.path.splitext(path)[1].lower() in TIFF_EXTENSIONS
+
+def _significant_bits(tif):
+    # OME-XML records the real sensor depth (e.g. 12-bit data stored in 16-bit samples).
+    try:
+        match = re.search(r'SignificantBits="(\d+)"', tif.ome_metadata or '')
+    except Exception:
+        match = None
+    return int(match.group(1)) if match else None
+
+def _physical_sizes(tif):
+    # Voxel edge lengths from OME-XML, e.g. {'x': 0.65, 'y': 0.65, 'z': 2.0}, in their stated units.
+    sizes = {}
+    try:
+        ome = tif.ome_metadata or ''
+    except Exception:
+        ome = ''
+    for axis in ('X', 'Y', 'Z'):
+        match = re.search(rf'PhysicalSize{axis}="([0-9.eE+-]+)"', ome)
+        if match:
+            sizes[axis.lower()] = float(match.group(1))
+    return sizes
+
+def to_uint8(plane, bit_depth=None):
+    # Maps a native-depth plane onto 0-255. `bit_depth` is the sensor depth; when unknown it is
+    # taken from the plane's maximum so 12-bit data in 16-bit samples is not crushed to 0-15.
+    # Planes of one file should share a depth (MicroscopyImage.scale_depth), or each is stretched
+    # on its own scale.
+    arr = np.asarray(plane)
+    if arr.dtype == np.uint8:
+        return arr
+    if arr.dtype.kind == 'f':
+        return cv2.normalize(arr.astype(np.float32), None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    if arr.dtype.kind == 'b':
+        return arr.astype(np.uint8) * 255
+
+    if not bit_depth:
+        bit_depth = max(8, int(arr.max(initial=0)).bit_length())
+    alpha = 255.0 / ((1 << int(bit_depth)) - 1)
+    if arr.dtype in (np.uint16, np.int16):
+        return cv2.convertScaleAbs(np.ascontiguousarray(arr), alpha=alpha)
+    return np.clip(arr.astype(np.float32) * alpha, 0, 255).astype(np.uint8)
+
+class MicroscopyImage:
+    # Opens a TIFF/OME-TIFF without decoding it. Uncompressed, contiguous data is memory-mapped,
+    # so planes, channels and regions are numpy views backed by the page cache; tiled or compressed
+    # files go through a zarr store (only the touched tiles are decoded) when zarr is installed,
+    # otherwise one page at a time. Without tifffile, OpenCV reads pages with IMREAD_UNCHANGED.
+    def __init__(self, path):
+        self.path = path
+        self.backend = None
+        self.bit_depth = None
+        self.physical_size = {}
+        self._tif = None
+        self._data = None
+        self._pages = None
+        self._page_ndim = 0
+        self._depths = {}
+        if TIFFFILE_AVAILABLE:
+            self._open_tifffile()
+        else:
+            self._open_opencv()
+
+        self.channel_axis = next((a for a in self.axes if a in CHANNEL_AXES), None)
+        self.channels = self.shape[self.axes.index(self.channel_axis)] if self.channel_axis else 1
+        self.plane_axes = ''.join(a for a in self.axes if a not in SPATIAL_AXES and a not in CHANNEL_AXES)
+        self.plane_shape = tuple(self.shape[self.axes.index(a)] for a in self.plane_axes)
+        self.planes = int(np.prod(self.plane_shape)) if self.plane_shape else 1
+
+    def _open_tifffile(self):
+        self._tif = tifffile.TiffFile(self.path)
+        series = self._tif.series[0]
+        self.axes = series.axes
+        self.shape = tuple(series.shape)
+        self.dtype = np.dtype(series.dtype)
+        self.bit_depth = _significant_bits(self._tif)
+        self.physical_size = _physical_sizes(self._tif)
+
+        try:
+            self._data = tifffile.memmap(self.path, series=0, mode='r')
+            self.backend = 'memmap'
+            return
+        except Exception:
+            pass
+
+        if ZARR_AVAILABLE:
+            try:
+                self._data = zarr.open(series.aszarr(level=0), mode='r')
+                self.backend = 'zarr'
+                return
+            except Exception:
+                pass
+
+        if series.keyframe.compression not in tifffile.TIFF.DECOMPRESSORS:
+            # e.g. LZW without imagecodecs installed; OpenCV has its own libtiff.
+            self._tif.close()
+            self._tif = None
+            self._open_opencv()
+            return
+
+        self._pages = series.pages
+        self._page_ndim = series.keyframe.ndim
+        self.backend = 'pages'
+
+    def _open_opencv(self):
+        count = int(cv2.imcount(self.path)) if hasattr(cv2, 'imcount') else 1
+        first = cv2.imread(self.path, cv2.IMREAD_UNCHANGED)
+        if first is None:
+            raise ValueError(f"Could not read {self.path}")
+        page_axes = 'YXS' if first.ndim == 3 else 'YX'
+        self.axes = ('I' + page_axes) if count > 1 else page_axes
+        self.shape = ((count,) if count > 1 else ()) + first.shape
+        self.dtype = first.dtype
+        self._first = first
+        self._page_ndim = first.ndim
+        self.backend = 'opencv'
+
+    def _key(self, channel, region, index):
+        key = []
+        for axis, size in zip(self.axes, self.shape):
+            if axis == 'Y':
+                key.append(slice(region[1], region[1] + region[3]) if region else slice(None))
+            elif axis == 'X':
+                key.append(slice(region[0], region[0] + region[2]) if region else slice(None))
+            elif axis == self.channel_axis:
+                if channel is None and axis == 'S':
+                    key.append(slice(None))
+                else:
+                    key.append(min(int(channel or 0), size - 1))
+            else:
+                key.append(min(int(index.get(axis.lower(), 0)), size - 1))
+        return tuple(key)
+
+    def read(self, channel=None, region=None, **index):
+        # Returns one 2D plane (or YXS for RGB samples when channel is None) in its native dtype.
+        # `region` is (x, y, w, h); `index` selects the other axes by lowercase name, e.g. t=3, z=10.
+        # With the memmap backend the result is a view: nothing is read until it is touched.
+        key = self._key(channel, region, index)
+        if self._data is not None:
+            return self._samples_last(self._data[key], key)
+
+        n_page = self._page_ndim
+        lead_key, page_key = key[:len(key) - n_page], key[len(key) - n_page:]
+        lead_shape = self.shape[:len(self.shape) - n_page]
+        page_no = int(np.ravel_multi_index(lead_key, lead_shape)) if lead_shape else 0
+
+        if self.backend == 'opencv':
+            if page_no == 0:
+                page = self._first
+            else:
+                ok, mats = cv2.imreadmulti(self.path, start=page_no, count=1, flags=cv2.IMREAD_UNCHANGED)
+                if not ok or not mats:
+                    raise ValueError(f"Could not read page {page_no} of {self.path}")
+                page = mats[0]
+            if page.ndim == 3 and page.shape[2] in (3, 4):
+                # OpenCV returns BGR(A); hand back RGB(A) like tifffile so channel indices agree.
+                page = page[:, :, [2, 1, 0, 3][:page.shape[2]]]
+            return page[page_key]
+        return self._samples_last(self._pages[page_no].asarray()[page_key], key)
+
+    def _samples_last(self, plane, key):
+        # Planar-configuration RGB (axes SYX) keeps its samples first; callers expect YXS.
+        kept = [axis for axis, k in zip(self.axes, key) if isinstance(k, slice)]
+        if 'S' in kept and kept[-1] != 'S':
+            return np.moveaxis(plane, kept.index('S'), -1)
+        return plane
+
+    def iter_planes(self, channel=None, region=None, step=1):
+        # Yields (plane number, {axis: index}, array) over every non-spatial, non-channel position.
+        names = [a.lower() for a in self.plane_axes]
+        for i in range(0, self.planes, step):
+            coords = np.unravel_index(i, self.plane_shape) if self.plane_shape else ()
+            index = {name: int(c) for name, c in zip(names, coords)}
+            yield i, index, self.read(channel=channel, region=region, **index)
+
+    def scale_depth(self, channel=None):
+        # The bit depth every plane of `channel` is scaled to 8 bits with, so timepoints and z
+        # slices share one intensity scale: the sensor depth from the OME metadata, else the
+        # significant bits of the brightest of DEPTH_SAMPLES evenly spaced planes. Significant bits
+        # come in powers of two, so a plane brighter than the sampled ones is only clipped when it
+        # exceeds the inferred sensor range. None where to_uint8 needs no depth (8-bit, float).
+        if self.bit_depth:
+            return self.bit_depth
+        if self.dtype.kind not in 'iu' or self.dtype.itemsize == 1:
+            return None
+        if channel not in self._depths:
+            names = [a.lower() for a in self.plane_axes]
+            peak = 0
+            for i in np.unique(np.linspace(0, self.planes - 1, min(self.planes, DEPTH_SAMPLES)).astype(int)):
+                coords = np.unravel_index(i, self.plane_shape) if self.plane_shape else ()
+                plane = self.read(channel=channel, **{name: int(c) for name, c in zip(names, coords)})
+                peak = max(peak, int(np.max(plane, initial=0)))
+            self._depths[channel] = max(8, peak.bit_length())
+        return self._depths[channel]
+
+    def info(self):
+        return {
+            'path': os.path.basename(self.path),
+            'axes': self.axes,
+            'shape': list(self.shape),
+            'dtype': str(self.dtype),
+            'bit_depth': self.bit_depth,
+            'physical_size': self.physical_size,
+            'channels': self.channels,
+            'planes': self.planes,
+            'backend': self.backend,
+        }
+
+    def close(self):
+        self._data = None
+        self._pages = None
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
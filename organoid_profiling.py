@@ -0,0 +1,183 @@
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+# Profiling is only available to requests carrying this token (X-Admin-Token header or
+# admin_token field); without a token configured it is off, except locally in the desktop app.
+ADMIN_TOKEN = os.environ.get('ORGANOID_ADMIN_TOKEN')
+PROFILE_DIR = os.environ.get('ORGANOID_PROFILE_DIR', os.path.join('data', 'profiles'))
+KEEP_PROFILES = int(os.environ.get('ORGANOID_PROFILE_KEEP', '50'))
+SAMPLE_INTERVAL = float(os.environ.get('ORGANOID_PROFILE_INTERVAL', '0.005'))
+TOP_FUNCTIONS = 15
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+ARTIFACT_NAME = re.compile(r'^[0-9a-f]{16}\.(pstats|txt|folded)$')
+
+def is_admin(request, allow_local=False):
+    token = (request.headers.get('X-Admin-Token') or request.form.get('admin_token')
+             or request.args.get('admin_token'))
+    if ADMIN_TOKEN:
+        return bool(token) and hmac.compare_digest(token, ADMIN_TOKEN)
+    return allow_local and request.remote_addr in LOCAL_ADDRESSES
+
+def profile_mode(value):
+    # profile=1 (or cprofile) -> deterministic cProfile; profile=sample -> stack sampling.
+    if value in (None, '', '0', 'false', 'off'):
+        return None
+    return 'sample' if value == 'sample' else 'cprofile'
+
+class SamplingProfiler:
+    # Samples one thread's Python stack every `interval` seconds from a helper thread and counts
+    # identical stacks, giving the "folded" format that flamegraph.pl, speedscope and inferno read.
+    # Native calls (cv2.watershed, cv2.imwrite) show up as the Python line that made them, which
+    # is why the innermost frame carries its line number.
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = [f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"]
+        frame = frame.f_back
+        while frame is not None:
+            stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='organoid-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        return ''.join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def top(self, limit=TOP_FUNCTIONS):
+        leaves = Counter()
+        for stack, n in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += n
+        return [{'function': leaf, 'samples': n, 'share': round(n / max(self.samples, 1), 4)}
+                for leaf, n in leaves.most_common(limit)]
+
+class RequestProfile:
+    # Profiles the block it wraps (in the current thread) and saves the artifacts under
+    # PROFILE_DIR: <id>.pstats plus a text summary for cProfile, <id>.folded for sampling. A
+    # profile with mode None does nothing, so call sites can wrap unconditionally.
+    def __init__(self, mode, label='', directory=PROFILE_DIR):
+        self.mode = mode
+        self.label = label
+        self.directory = directory
+        self.id = uuid.uuid4().hex[:16]
+        self.wall_ms = None
+        self.top = []
+        self.files = []
+        self._profiler = None
+        self._started = None
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def __enter__(self):
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.mode == 'sample':
+            self._profiler = SamplingProfiler(threading.get_ident())
+            self._profiler.start()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.enabled:
+            return False
+        self.wall_ms = round((time.perf_counter() - self._started) * 1000, 1)
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+        else:
+            self._profiler.stop()
+        try:
+            self._save()
+        except OSError as e:
+            print(f"Could not save profile {self.id}: {e}")
+        return False
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, self.id)
+        if self.mode == 'cprofile':
+            self._profiler.dump_stats(base + '.pstats')
+            text = io.StringIO()
+            text.write(f"{self.label}\nwall time: {self.wall_ms} ms\n\n")
+            stats = pstats.Stats(self._profiler, stream=text)
+            stats.sort_stats('tottime').print_stats(40)
+            stats.sort_stats('cumulative').print_stats(40)
+            with open(base + '.txt', 'w') as f:
+                f.write(text.getvalue())
+            self.files = [self.id + '.pstats', self.id + '.txt']
+            self.top = [{'function': pstats.func_std_string(func), 'calls': nc, 'tottime_ms': round(tt * 1000, 2),
+                         'cumtime_ms': round(ct * 1000, 2)}
+                        for func, (_, nc, tt, ct, _) in sorted(stats.stats.items(), key=lambda kv: -kv[1][2])
+                        [:TOP_FUNCTIONS]]
+        else:
+            with open(base + '.folded', 'w') as f:
+                f.write(self._profiler.folded())
+            self.files = [self.id + '.folded']
+            self.top = self._profiler.top()
+        prune(self.directory)
+
+    def info(self, url_prefix='/profiles/'):
+        return {
+            'id': self.id,
+            'mode': self.mode,
+            'wall_ms': self.wall_ms,
+            'files': {name.rsplit('.', 1)[1]: url_prefix + name for name in self.files},
+            'top': self.top,
+        }
+
+def prune(directory=PROFILE_DIR, keep=KEEP_PROFILES):
+    # Keeps the artifacts of the newest `keep` profiles.
+    try:
+        names = [n for n in os.listdir(directory) if ARTIFACT_NAME.match(n)]
+    except OSError:
+        return
+    newest = {}
+    for name in names:
+        pid = name.split('.', 1)[0]
+        mtime = os.path.getmtime(os.path.join(directory, name))
+        newest[pid] = max(newest.get(pid, 0), mtime)
+    stale = set(sorted(newest, key=newest.get, reverse=True)[keep:])
+    for name in names:
+        if name.split('.', 1)[0] in stale:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+def artifact_path(name, directory=PROFILE_DIR):
+    # Absolute path of a saved artifact, or None for names that are not ours.
+    if not ARTIFACT_NAME.match(name):
+        return None
+    path = os.path.join(os.path.abspath(directory), name)
+    return path if os.path.exists(path) else None
@@ -0,0 +1,329 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import cv2
+
+from organoid_buffers import MemoryTracker, trim_pool
+from organoid_dispatch import run_analysis, attach_urls, resolve_method, model_availability
+from organoid_frames import Frame, iter_images
+from organoid_isolation import iter_guarded, is_partial, summarize
+from organoid_resources import governor
+from organoid_workspace import WORKSPACES_DIRNAME
+
+PREVIEW_MAX_SIDE = int(os.environ.get('ORGANOID_PREVIEW_MAX_SIDE', '480'))
+MAX_JOBS = int(os.environ.get('ORGANOID_PREVIEW_MAX_JOBS', '32'))
+JOB_TTL = float(os.environ.get('ORGANOID_PREVIEW_JOB_TTL', '900'))
+PREVIEW_DIRNAME = 'preview'
+# A job's id is <workspace id>.<random>, and its state is kept in <workspace>/job-<random>.json so
+# that every server process can answer /analyze/<job>, not just the one running it. The running
+# process refreshes the file's mtime at least this often (seconds) while queued and after every
+# image; a running job not heard from for JOB_TTL seconds is reported as failed.
+JOB_HEARTBEAT = 30
+JOB_ID = re.compile(r'^([0-9a-f]{16}-[0-9a-f]{8})\.([0-9a-f]{12})$')
+# Methods whose 480 px preview stays within organoid_eval's tolerances of the full-resolution run
+# (python organoid_eval.py --synthetic 3 --modes preview@480), plus the StarDist fallback (its
+# filters scale with the preview) when the StarDist model is not installed. Hough/AssayScope scale
+# their radii and vote threshold but still pick different circles on downsampled images, and the
+# U-Net fallback segments texture that does not survive downsampling; requests for those methods
+# are analyzed at full resolution and say so in `preview_skipped`.
+PREVIEW_METHODS = ('basic', 'watershed', 'morphology', 'arivis')
+
+# How preview measurements scale back to full resolution: areas by 1/s^2, volumes by 1/s^3,
+# lengths by 1/s (s = preview width / full width). Counts and shape ratios are scale-free, and
+# the analyzers already scale their own size filters (and morphology's cell area) by s.
+AREA_KEYS = ('avg_size', 'total_area')
+VOLUME_KEYS = ('total_volume', 'est_volume', 'avg_volume')
+LENGTH_KEYS = ('mean_radius',)
+
+def preview_unavailable(method):
+    # Why `method` gets no preview, or None when it does.
+    method = resolve_method(method)
+    if method in PREVIEW_METHODS or (method == 'stardist' and not model_availability()['stardist']):
+        return None
+    return (f"{method} has no preview: at preview resolution its results are outside organoid_eval's "
+            f"tolerances, so the images were analyzed at full resolution")
+
+def supports_preview(method):
+    return preview_unavailable(method) is None
+
+def downscale(img, max_side=PREVIEW_MAX_SIDE):
+    side = max(img.shape[:2])
+    if side <= max_side:
+        return img
+    f = max_side / side
+    return cv2.resize(img, (max(1, round(img.shape[1] * f)), max(1, round(img.shape[0] * f))),
+                      interpolation=cv2.INTER_AREA)
+
+def preview_image(source, max_side=PREVIEW_MAX_SIDE):
+    # Returns (downsampled BGR image, (full width, full height)). Decoding is a small share of the
+    # time (reduced-size JPEG decoding saves only ~25%), so the image is decoded as usual and shrunk
+    # with INTER_AREA, which keeps object areas unbiased.
+    img = next((i for _, _, i in iter_images([(0, source)])), None)
+    if img is None:
+        return None, None
+    return downscale(img, max_side), (img.shape[1], img.shape[0])
+
+def scale_result(res, scale, full):
+    for key in AREA_KEYS:
+        if key in res:
+            value = res[key] / scale ** 2
+            res[key] = int(round(value)) if isinstance(res[key], int) else value
+    for key in VOLUME_KEYS:
+        if key in res:
+            res[key] = res[key] / scale ** 3
+    for key in LENGTH_KEYS:
+        if key in res:
+            res[key] = res[key] / scale
+    for obj in res.get('objects', ()):
+        obj.update(x=obj['x'] / scale, y=obj['y'] / scale, area=obj['area'] / scale ** 2,
+                   width=obj['width'] / scale, height=obj['height'] / scale)
+    res['preview_resolution'] = res.get('resolution')
+    res['resolution'] = f"{full[0]}x{full[1]}"
+    res['preview_scale'] = scale
+    return res
+
+def run_preview(method, sources, workspace, options):
+    # The same analyzer on downsampled copies, written under <workspace>/preview so the full run's
+    # debug images are not touched. Shapes and overlays stay in preview pixels (debug_url is the
+    # preview image); numbers are scaled to full resolution. Each image is analyzed with its own
+    # scale, since uploads of one request need not share a size.
+    preview_dir = os.path.join(workspace.path, PREVIEW_DIRNAME)
+    os.makedirs(preview_dir, exist_ok=True)
+    previews = []
+    for day, source in sources:
+        img, full = preview_image(source)
+        if img is None:
+            continue
+        scale = img.shape[1] / full[0]
+        results = run_analysis(method, {day: Frame(img, os.path.join(preview_dir, f"day{day}"), day)},
+                               **dict(options, scale=scale))
+        if isinstance(results, dict):
+            return results
+        for res in results:
+            previews.append(attach_urls(scale_result(res, scale, full), method, workspace, {}, image_dir=preview_dir))
+    trim_pool()
+    return previews
+
+def _job_paths(workspace_path, key):
+    return (os.path.join(workspace_path, f"job-{key}.json"), os.path.join(workspace_path, f"job-{key}.cancel"))
+
+class JobCancel(threading.Event):
+    # A job's cancel flag. Set directly in the process running the job, or by DELETE /analyze/<job>
+    # in another server process, which leaves a marker file next to the job's state.
+    marker = None
+
+    def is_set(self):
+        if not super().is_set() and self.marker and os.path.exists(self.marker):
+            self.set()
+        return super().is_set()
+
+class ProgressiveJob:
+    # The full-resolution analysis of a request that already answered with a preview. `cancelled`
+    # is a JobCancel when the caller needs to see cancellation too (e.g. iter_uploaded).
+    def __init__(self, method, workspace, store=None, meta=None, cancelled=None, admission=None):
+        key = uuid.uuid4().hex[:12]
+        self.id = f"{workspace.id}.{key}"
+        self.path, cancel_marker = _job_paths(workspace.path, key)
+        self.method = method
+        self.workspace = workspace
+        self.store = store
+        self.meta = meta or {}
+        self.status = 'running'
+        self.response = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.cancelled = cancelled if cancelled is not None else JobCancel()
+        self.cancelled.marker = cancel_marker
+        # The request's organoid_admission ticket; the analysis waits in its queue, if need be.
+        self.admission = admission
+
+    def cancel(self):
+        # The image being analyzed is abandoned (its worker killed) and no further images start;
+        # whatever finished is still returned.
+        self.cancelled.set()
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'created': self.created, 'finished': self.finished, 'state': self.state()}, f)
+            os.replace(tmp, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not save job {self.id}: {e}")
+
+    def _touch(self):
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
+
+    def _admitted(self):
+        while not self.admission.wait(timeout=JOB_HEARTBEAT, cancel=self.cancelled):
+            if self.cancelled.is_set():
+                return False
+            self._touch()
+        self.save()  # no longer queued
+        return True
+
+    def run(self, sources, origins, options):
+        try:
+            if self.admission is not None and not self._admitted():
+                sources = ()  # cancelled while queued
+            results, images = [], []
+            with governor.request_slot() as threads, MemoryTracker() as mem:
+                for entry, image_results in iter_guarded(self.method, sources, options, threads=threads,
+                                                         cancel=self.cancelled, memory=mem):
+                    images.append(entry)
+                    results.extend(image_results)
+                    self._touch()
+            if not results and is_partial(images) and not self.cancelled.is_set():
+                raise RuntimeError(next(i['error'] for i in images if 'error' in i))
+            self.response = {
+                'success': True,
+                'method': self.method,
+                'workspace': self.workspace.id,
+                'results': [attach_urls(res, self.method, self.workspace, origins) for res in results],
+                'images': images,
+                'image_status': summarize(images),
+                'partial': is_partial(images),
+                'memory': mem.report(),
+                'threads': threads,
+            }
+            self.status = 'cancelled' if self.cancelled.is_set() else 'done'
+            if self.store is not None:
+                self.store.record(self.workspace.id, self.method, self.response['results'], images,
+                                  origin='job', **self.meta)
+        except Exception as e:
+            print(f"Background Analysis Error: {e}")
+            self.error = str(e)
+            self.status = 'error'
+        finally:
+            if self.admission is not None:
+                self.admission.release()
+            self.finished = time.time()
+            self.save()
+            self.workspace.release()
+
+    def state(self):
+        if self.response is not None:
+            return dict(self.response, job=self.id, status=self.status)
+        state = {'job': self.id, 'status': self.status, 'method': self.method,
+                 'elapsed_s': round((self.finished or time.time()) - self.created, 2)}
+        if self.error:
+            state['error'] = self.error
+        if self.admission is not None and self.admission.state == 'queued':
+            state['queued'] = True
+        return state
+
+class StoredJob:
+    # A job run by another server process, as last saved by it. cancel() leaves the marker its
+    # JobCancel polls.
+    def __init__(self, job_id, path, cancel_marker, saved, ttl_seconds):
+        self.id = job_id
+        self.path = path
+        self.cancel_marker = cancel_marker
+        self.saved = saved
+        self.ttl_seconds = ttl_seconds
+        self.status = saved['state']['status']
+        self.finished = saved['finished']
+
+    @classmethod
+    def load(cls, upload_root, job_id, ttl_seconds=JOB_TTL):
+        match = JOB_ID.match(job_id)
+        if not match:
+            return None
+        path, cancel_marker = _job_paths(os.path.join(upload_root, WORKSPACES_DIRNAME, match.group(1)),
+                                         match.group(2))
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            heard = os.path.getmtime(path)
+        except (OSError, ValueError):
+            return None
+        job = cls(job_id, path, cancel_marker, saved, ttl_seconds)
+        if job.finished is not None and job.finished < time.time() - ttl_seconds:
+            return None
+        if job.status == 'running' and heard < time.time() - ttl_seconds:
+            job.status = 'error'
+            job.saved['state'].update(status='error', error="The server process running this job stopped")
+        return job
+
+    def cancel(self):
+        if self.status == 'running':
+            open(self.cancel_marker, 'w').close()
+
+    def state(self):
+        state = dict(self.saved['state'], status=self.status)
+        if 'elapsed_s' in state and self.status == 'running':
+            state['elapsed_s'] = round(time.time() - self.saved['created'], 2)
+        return state
+
+class JobStore:
+    # Background full-resolution runs, one thread each (the resource governor still limits how many
+    # analyze at once). Finished jobs are kept for JOB_TTL seconds, at most MAX_JOBS of them in
+    # memory. With `upload_root`, jobs of other server processes are found through their saved state.
+    def __init__(self, max_jobs=MAX_JOBS, ttl_seconds=JOB_TTL, store=None, upload_root=None):
+        self.max_jobs = max_jobs
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self.upload_root = upload_root
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, method, workspace, sources, origins, options, meta=None, cancelled=None, admission=None):
+        job = ProgressiveJob(method, workspace, self.store, meta, cancelled, admission)
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        job.save()
+        thread = threading.Thread(target=job.run, args=(sources, origins, options),
+                                  name=f'organoid-job-{job.id[:8]}', daemon=True)
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+        if job is None and self.upload_root is not None:
+            job = StoredJob.load(self.upload_root, job_id, self.ttl_seconds)
+        return job
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        done = [jid for jid, j in self._jobs.items() if j.finished is not None]
+        for jid in done:
+            if self._jobs[jid].finished < cutoff or len(self._jobs) > self.max_jobs:
+                del self._jobs[jid]
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j.status == 'running')
+            return {'jobs': len(self._jobs), 'running': running, 'max_jobs': self.max_jobs,
+                    'ttl_seconds': self.ttl_seconds}
+
+def start_progressive(jobs, method, workspace, preview_sources, sources, origins, options, meta=None, admission=None):
+    # Answers with the preview and hands the full-resolution run (and the workspace) to a
+    # background job, whose state is polled at /analyze/<job>.
+    started = time.perf_counter()
+    with governor.request_slot():
+        previews = run_preview(method, preview_sources, workspace, options)
+    if isinstance(previews, dict):
+        return previews
+    job = jobs.submit(method, workspace, sources, origins, options, meta, admission=admission)
+    return {
+        'success': True,
+        'preview': True,
+        'method': method,
+        'workspace': workspace.id,
+        'job': job.id,
+        'status_url': f"/analyze/{job.id}",
+        'results': previews,
+        'preview_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
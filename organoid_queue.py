@@ -0,0 +1,577 @@
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+
+import cv2
+import numpy as np
+
+from organoid_frames import Frame
+from organoid_isolation import OK, EMPTY, TIMEOUT, CANCELLED
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Where ORGANOID_ISOLATION=queue sends images, and where organoid_worker.py takes them from:
+#   sqlite:///data/queue.sqlite  - one machine, any number of server and worker processes
+#   file:///mnt/shared/queue     - a directory on a filesystem shared by the nodes
+#   redis://host:6379/0          - Redis or a compatible server (Valkey, KeyDB); needs `redis`
+QUEUE_URL = os.environ.get('ORGANOID_QUEUE')
+# A claimed task whose worker stops renewing its lease (node lost, worker killed) goes back to
+# the queue for another worker, at most MAX_ATTEMPTS times.
+LEASE_SECONDS = float(os.environ.get('ORGANOID_QUEUE_LEASE', '30'))
+MAX_ATTEMPTS = 3
+# Tasks and results nobody picked up (the server restarted) are purged after this long.
+TASK_TTL = 3600
+# Images of one request kept queued ahead of the one being waited for.
+QUEUE_WINDOW = int(os.environ.get('ORGANOID_QUEUE_WINDOW', '4'))
+POLL_MIN = 0.02
+POLL_MAX = 0.25
+
+def _jsonable(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _dumps(data):
+    return json.dumps(data, default=_jsonable)
+
+def new_task_id():
+    return uuid.uuid4().hex
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class SQLiteQueue:
+    # Tasks and results in one SQLite file (WAL). Claiming is a short write transaction, so any
+    # number of local server and worker processes can share it; not meant for network filesystems.
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        meta TEXT NOT NULL,
+        data BLOB,
+        result TEXT,
+        result_data BLOB,
+        worker TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_until REAL,
+        created REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, created);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def put(self, task_id, meta, data):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("INSERT INTO tasks (id, state, meta, data, created) VALUES (?, 'pending', ?, ?, ?)",
+                     (task_id, _dumps(meta), data, now))
+        conn.execute("DELETE FROM tasks WHERE created < ?", (now - TASK_TTL,))
+
+    def claim(self, worker):
+        # (task_id, meta, data) of the oldest pending task, now leased to `worker`, or None.
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("UPDATE tasks SET state = 'pending' WHERE state = 'claimed' AND lease_until < ? "
+                         "AND attempts < ?", (now, MAX_ATTEMPTS))
+            row = conn.execute("SELECT id, meta, data FROM tasks WHERE state = 'pending' ORDER BY created LIMIT 1"
+                               ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE tasks SET state = 'claimed', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                             "WHERE id = ?", (worker, now + LEASE_SECONDS, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return None if row is None else (row[0], json.loads(row[1]), row[2])
+
+    def renew(self, task_id):
+        self._conn().execute("UPDATE tasks SET lease_until = ? WHERE id = ? AND state = 'claimed'",
+                             (time.time() + LEASE_SECONDS, task_id))
+
+    def release(self, task_id):
+        # Hands a claimed task back, e.g. when its worker is shutting down.
+        self._conn().execute("UPDATE tasks SET state = 'pending', worker = NULL, attempts = attempts - 1 "
+                             "WHERE id = ? AND state = 'claimed'", (task_id,))
+
+    def finish(self, task_id, result, data=None):
+        self._conn().execute("UPDATE tasks SET state = 'done', result = ?, result_data = ?, data = NULL "
+                             "WHERE id = ? AND state = 'claimed'", (_dumps(result), data, task_id))
+
+    def take_result(self, task_id):
+        # (result, data) once the task is done, removing it; None while it is pending or running.
+        conn = self._conn()
+        row = conn.execute("SELECT result, result_data FROM tasks WHERE id = ? AND state = 'done'",
+                           (task_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+        return json.loads(row[0]), row[1]
+
+    def cancel(self, task_id):
+        self._conn().execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def stats(self):
+        conn = self._conn()
+        counts = dict(conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        workers = [w for (w,) in conn.execute("SELECT DISTINCT worker FROM tasks WHERE state = 'claimed' "
+                                              "AND lease_until >= ?", (time.time(),))]
+        return {'backend': 'sqlite', 'pending': counts.get('pending', 0), 'running': counts.get('claimed', 0),
+                'finished': counts.get('done', 0), 'busy_workers': workers}
+
+class FileQueue:
+    # Tasks as files in a directory shared by the nodes (NFS, SMB). A task is claimed by renaming
+    # it from pending/ to claimed/, which only one worker can win; the worker keeps touching the
+    # claimed file while it runs, and a file left untouched past its lease is moved back.
+    def __init__(self, directory):
+        self.directory = directory
+        for sub in ('pending', 'claimed', 'done', 'data', 'tmp'):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+        self._puts = 0
+
+    def _path(self, sub, name):
+        return os.path.join(self.directory, sub, name)
+
+    def _write(self, sub, name, payload, mode='w'):
+        tmp = self._path('tmp', f"{name}.{uuid.uuid4().hex[:8]}")
+        with open(tmp, mode) as f:
+            f.write(payload)
+        os.replace(tmp, self._path(sub, name))
+
+    def _find(self, sub, task_id):
+        for name in os.listdir(os.path.join(self.directory, sub)):
+            if name.endswith(f"-{task_id}.json"):
+                return name
+        return None
+
+    def put(self, task_id, meta, data):
+        self._write('data', f"{task_id}.in", data, 'wb')
+        # The nanosecond prefix keeps pending/ in submission order.
+        self._write('pending', f"{time.time_ns():020d}-{task_id}.json", _dumps(dict(meta, attempts=0)))
+        self._puts += 1
+        if self._puts % 100 == 0:
+            self._purge()
+
+    def _purge(self):
+        cutoff = time.time() - TASK_TTL
+        for sub in ('pending', 'claimed', 'done', 'data', 'tmp'):
+            folder = os.path.join(self.directory, sub)
+            for name in os.listdir(folder):
+                try:
+                    if os.path.getmtime(os.path.join(folder, name)) < cutoff:
+                        os.remove(os.path.join(folder, name))
+                except OSError:
+                    pass
+
+    def _requeue_expired(self):
+        cutoff = time.time() - LEASE_SECONDS
+        for name in os.listdir(os.path.join(self.directory, 'claimed')):
+            path = self._path('claimed', name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    with open(path) as f:
+                        attempts = json.load(f).get('attempts', 0)
+                    if attempts < MAX_ATTEMPTS:
+                        os.rename(path, self._path('pending', name))
+            except (OSError, ValueError):
+                pass
+
+    def claim(self, worker):
+        self._requeue_expired()
+        for name in sorted(os.listdir(os.path.join(self.directory, 'pending'))):
+            claimed = self._path('claimed', name)
+            try:
+                os.rename(self._path('pending', name), claimed)
+            except OSError:
+                continue  # another worker was faster
+            task_id = name[:-5].split('-', 1)[1]
+            try:
+                with open(claimed) as f:
+                    meta = json.load(f)
+                with open(self._path('data', f"{task_id}.in"), 'rb') as f:
+                    data = f.read()
+            except (OSError, ValueError):
+                self._remove(task_id)  # cancelled while we claimed it
+                continue
+            meta['attempts'] = meta.get('attempts', 0) + 1
+            meta['worker'] = worker
+            with open(claimed, 'w') as f:
+                f.write(_dumps(meta))
+            return task_id, meta, data
+        return None
+
+    def renew(self, task_id):
+        name = self._find('claimed', task_id)
+        if name:
+            try:
+                os.utime(self._path('claimed', name))
+            except OSError:
+                pass
+
+    def release(self, task_id):
+        name = self._find('claimed', task_id)
+        if name:
+            try:
+                with open(self._path('claimed', name)) as f:
+                    meta = json.load(f)
+                meta['attempts'] = max(0, meta.get('attempts', 1) - 1)
+                self._write('pending', name, _dumps(meta))
+                os.remove(self._path('claimed', name))
+            except (OSError, ValueError):
+                pass
+
+    def finish(self, task_id, result, data=None):
+        if self._find('claimed', task_id) is None:
+            return  # cancelled meanwhile
+        if data is not None:
+            self._write('data', f"{task_id}.out", data, 'wb')
+        self._write('done', f"{task_id}.json", _dumps(result))
+        self._remove(task_id, keep_result=True)
+
+    def take_result(self, task_id):
+        path = self._path('done', f"{task_id}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            result = json.load(f)
+        data = None
+        out = self._path('data', f"{task_id}.out")
+        if os.path.exists(out):
+            with open(out, 'rb') as f:
+                data = f.read()
+        self._remove(task_id)
+        return result, data
+
+    def _remove(self, task_id, keep_result=False):
+        paths = [self._path('data', f"{task_id}.in")]
+        for sub in ('pending', 'claimed'):
+            name = self._find(sub, task_id)
+            if name:
+                paths.append(self._path(sub, name))
+        if not keep_result:
+            paths += [self._path('done', f"{task_id}.json"), self._path('data', f"{task_id}.out")]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def cancel(self, task_id):
+        self._remove(task_id)
+
+    def stats(self):
+        count = lambda sub: len(os.listdir(os.path.join(self.directory, sub)))
+        return {'backend': 'file', 'pending': count('pending'), 'running': count('claimed'),
+                'finished': count('done')}
+
+class RedisQueue:
+    # Tasks in Redis: a pending list, a sorted set of leases and one hash per task/result, all
+    # under `prefix`. Results and unclaimed tasks expire on their own after TASK_TTL.
+    def __init__(self, url, prefix='organoid:queue:'):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("The redis queue backend needs the `redis` package (pip install redis)")
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+    def put(self, task_id, meta, data):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('task', task_id), mapping={'meta': _dumps(meta), 'data': data, 'attempts': 0})
+        pipe.expire(self._key('task', task_id), int(TASK_TTL))
+        pipe.lpush(self._key('pending'), task_id)
+        pipe.execute()
+
+    def _requeue_expired(self):
+        for task_id in self.redis.zrangebyscore(self._key('leases'), '-inf', time.time()):
+            if self.redis.zrem(self._key('leases'), task_id):
+                attempts = self.redis.hget(self._key('task', task_id.decode()), 'attempts')
+                if attempts is not None and int(attempts) < MAX_ATTEMPTS:
+                    self.redis.rpush(self._key('pending'), task_id)
+
+    def claim(self, worker):
+        self._requeue_expired()
+        while True:
+            task_id = self.redis.rpop(self._key('pending'))
+            if task_id is None:
+                return None
+            task_id = task_id.decode()
+            self.redis.zadd(self._key('leases'), {task_id: time.time() + LEASE_SECONDS})
+            meta, data = self.redis.hmget(self._key('task', task_id), 'meta', 'data')
+            if meta is None:
+                self.redis.zrem(self._key('leases'), task_id)
+                continue  # cancelled or expired
+            self.redis.hincrby(self._key('task', task_id), 'attempts', 1)
+            self.redis.hset(self._key('task', task_id), 'worker', worker)
+            return task_id, json.loads(meta), data
+
+    def renew(self, task_id):
+        self.redis.zadd(self._key('leases'), {task_id: time.time() + LEASE_SECONDS}, xx=True)
+
+    def release(self, task_id):
+        if self.redis.zrem(self._key('leases'), task_id):
+            self.redis.hincrby(self._key('task', task_id), 'attempts', -1)
+            self.redis.rpush(self._key('pending'), task_id)
+
+    def finish(self, task_id, result, data=None):
+        if not self.redis.zrem(self._key('leases'), task_id):
+            return  # cancelled meanwhile
+        pipe = self.redis.pipeline()
+        mapping = {'result': _dumps(result)}
+        if data is not None:
+            mapping['data'] = data
+        pipe.hset(self._key('result', task_id), mapping=mapping)
+        pipe.expire(self._key('result', task_id), int(TASK_TTL))
+        pipe.delete(self._key('task', task_id))
+        pipe.execute()
+
+    def take_result(self, task_id):
+        result, data = self.redis.hmget(self._key('result', task_id), 'result', 'data')
+        if result is None:
+            return None
+        self.redis.delete(self._key('result', task_id))
+        return json.loads(result), data
+
+    def cancel(self, task_id):
+        pipe = self.redis.pipeline()
+        pipe.lrem(self._key('pending'), 0, task_id)
+        pipe.zrem(self._key('leases'), task_id)
+        pipe.delete(self._key('task', task_id), self._key('result', task_id))
+        pipe.execute()
+
+    def stats(self):
+        return {'backend': 'redis', 'pending': self.redis.llen(self._key('pending')),
+                'running': self.redis.zcard(self._key('leases'))}
+
+def open_queue(url=QUEUE_URL):
+    if not url:
+        raise ValueError("No task queue configured (set ORGANOID_QUEUE)")
+    if url.startswith('sqlite://'):
+        # sqlite:///relative/path or sqlite:////absolute/path, as in SQLAlchemy.
+        return SQLiteQueue(url[len('sqlite:///'):])
+    if url.startswith('file://'):
+        return FileQueue(url[len('file://'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisQueue(url)
+    raise ValueError(f"Unsupported queue URL: {url}")
+
+def remote_capable(source):
+    # Plain files and decoded frames are shipped as image bytes. Z-stacks are measured in 3D from
+    # the whole TIFF, so they are analyzed on the server instead.
+    from organoid_zstack import ZStack
+    return not isinstance(source, ZStack)
+
+def encode_source(source):
+    # (extension, bytes) for a task; decoded frames are sent as lossless PNG.
+    if isinstance(source, Frame):
+        img = source.load()
+        if img is None:
+            return None, None
+        ok, buf = cv2.imencode('.png', img)
+        return ('.png', buf.tobytes()) if ok else (None, None)
+    with open(source, 'rb') as f:
+        return os.path.splitext(source)[1].lower() or '.jpg', f.read()
+
+class Ticket:
+    # An image handed to the queue; stands in for its source in iter_guarded.
+    __slots__ = ('task_id', 'method', 'day', 'path', 'empty')
+
+    def __init__(self, task_id, method, day, path, empty=False):
+        self.task_id = task_id
+        self.method = method
+        self.day = day
+        self.path = path
+        self.empty = empty
+
+class QueueClient:
+    # Server side of queue isolation. submit() enqueues one image; wait() polls for the worker's
+    # result with the (status, payload, peaks) contract of WorkerPool.run and writes the returned overlay
+    # where the local analyzers would have, so attach_urls finds it. prefetch() keeps up to
+    # `window` images of a request queued ahead, so several workers analyze one request at once.
+    def __init__(self, backend, window=QUEUE_WINDOW):
+        self.backend = backend
+        self.window = window
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def submit(self, method, day, source, options, timeout, expires_in):
+        path = getattr(source, 'path', source)
+        ext, data = encode_source(source)
+        if data is None:
+            return Ticket(None, method, day, path, empty=True)
+        task_id = new_task_id()
+        self.backend.put(task_id, {'method': method, 'day': day, 'ext': ext, 'options': options,
+                                   'timeout': timeout, 'deadline': time.time() + expires_in}, data)
+        with self._lock:
+            self.submitted += 1
+        return Ticket(task_id, method, day, path)
+
+    def wait(self, ticket, timeout, cancel=None):
+        from organoid_dispatch import debug_path
+
+        if ticket.empty:
+            return OK, [], None
+        deadline = time.monotonic() + timeout
+        delay = POLL_MIN
+        while True:
+            found = self.backend.take_result(ticket.task_id)
+            if found is not None:
+                break
+            if cancel is not None and cancel.is_set():
+                self.discard(ticket)
+                with self._lock:
+                    self.cancelled += 1
+                return CANCELLED, "Cancelled", None
+            if time.monotonic() >= deadline:
+                self.discard(ticket)
+                with self._lock:
+                    self.timeouts += 1
+                return TIMEOUT, f"Exceeded the {timeout:.0f} s per-image time limit (queued)", None
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+
+        result, overlay = found
+        with self._lock:
+            self.completed += 1
+        if overlay is not None:
+            path = debug_path(ticket.method, os.path.dirname(ticket.path), ticket.day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(overlay)
+        if result['status'] in (OK, EMPTY):
+            return OK, result.get('results') or [], result.get('memory')
+        return result['status'], f"{result.get('error')} (worker {result.get('worker')})", result.get('memory')
+
+    def discard(self, ticket):
+        if ticket.task_id is not None:
+            self.backend.cancel(ticket.task_id)
+
+    def prefetch(self, method, sources, options, image_timeout):
+        # Yields (day, Ticket) in order, keeping `window` tasks queued ahead; z-stacks pass through
+        # as they are. Tasks still queued when the caller stops early are withdrawn.
+        pending = deque()
+        try:
+            for day, source in sources:
+                if not remote_capable(source):
+                    while pending:
+                        yield pending.popleft()
+                    yield day, source
+                    continue
+                pending.append((day, self.submit(method, day, source, options, image_timeout,
+                                                 image_timeout * (self.window + 1))))
+                if len(pending) >= self.window:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            for _, ticket in pending:
+                self.discard(ticket)
+
+    def stats(self):
+        with self._lock:
+            counters = {'submitted': self.submitted, 'completed': self.completed, 'timeouts': self.timeouts,
+                        'cancelled': self.cancelled, 'window': self.window}
+        try:
+            counters.update(self.backend.stats())
+        except Exception as e:
+            counters['error'] = str(e)
+        return counters
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = QueueClient(open_queue())
+        return _client
+
+def stats():
+    if not QUEUE_URL:
+        return {'enabled': False}
+    return dict(client().stats(), enabled=True)
+
+def run_task(backend, task_id, meta, data, worker, isolation, threads, stop):
+    # Worker side: analyzes one claimed task under the remaining deadline (renewing the lease
+    # meanwhile) and posts the result and overlay back. Returns the status.
+    from organoid_buffers import MemoryTracker
+    from organoid_dispatch import debug_path
+    from organoid_isolation import iter_guarded
+
+    remaining = min(meta['timeout'], meta['deadline'] - time.time())
+    if remaining <= 0:
+        backend.cancel(task_id)  # the server has given up on it already
+        return TIMEOUT
+
+    workdir = tempfile.mkdtemp(prefix='organoid-task-', dir=os.environ.get('ORGANOID_WORKER_TMP'))
+    done = threading.Event()
+
+    def keep_lease():
+        while not done.wait(LEASE_SECONDS / 3):
+            try:
+                backend.renew(task_id)
+            except Exception as e:
+                print(f"Could not renew the lease of {task_id}: {e}")
+
+    renewer = threading.Thread(target=keep_lease, daemon=True)
+    renewer.start()
+    try:
+        method, day = meta['method'], meta['day']
+        path = os.path.join(workdir, f"day{day}{meta['ext']}")
+        with open(path, 'wb') as f:
+            f.write(data)
+        with MemoryTracker() as mem:
+            entry, results = next(iter_guarded(method, [(day, path)], meta['options'], threads=threads,
+                                               image_timeout=remaining, cancel=stop, isolation=isolation,
+                                               memory=mem))
+        if entry['status'] == CANCELLED:
+            backend.release(task_id)  # this worker is stopping; another one takes it
+            return CANCELLED
+        overlay = None
+        debug_file = debug_path(method, workdir, day)
+        if os.path.exists(debug_file):
+            with open(debug_file, 'rb') as f:
+                overlay = f.read()
+        result = {'status': entry['status'], 'worker': worker, 'elapsed_ms': entry['elapsed_ms'],
+                  'memory': mem.peaks()}
+        if entry['status'] in (OK, EMPTY):
+            result['results'] = results
+        else:
+            result['error'] = entry.get('error')
+        backend.finish(task_id, result, overlay)
+        return entry['status']
+    finally:
+        done.set()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def _cgroup_cpu_limit():
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cores():
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit:
+        cores = min(cores, limit)
+    return max(1, cores)
+
+def worker_processes():
+    for var in ('ORGANOID_WORKERS', 'WEB_CONCURRENCY', 'WORKERS'):
+        value = os.environ.get(var)
+        if value and value.isdigit() and int(value) > 0:
+            return int(value)
+    return 1
+
+# BLAS pools are sized when NumPy is first imported, so this has to run before numpy/cv2 are
+# imported; app.py and desktop_app.py import this module first for that reason.
+_PROCESS_BUDGET = max(1, available_cores() // worker_processes())
+for _var in BLAS_ENV_VARS:
+    os.environ.setdefault(_var, str(_PROCESS_BUDGET))
+
+try:
+    from threadpoolctl import threadpool_limits
+    THREADPOOLCTL_AVAILABLE = True
+except ImportError:
+    THREADPOOLCTL_AVAILABLE = False
+
+class ResourceGovernor:
+    # Splits this worker process's share of the cores between the requests currently running in it.
+    # cv2.setNumThreads and the BLAS limit are process-wide, so every admission or release
+    # rebalances all running requests to budget // active.
+    def __init__(self, cores=None, workers=None):
+        self.cores = cores or available_cores()
+        self.workers = workers or worker_processes()
+        self.budget = max(1, self.cores // self.workers)
+        self.active = 0
+        self.peak_active = 0
+        self.threads = self.budget
+        self.decisions = 0
+        self.recent = deque(maxlen=20)
+        self.tensorflow = None
+        self._lock = threading.Lock()
+        self._blas_limiter = None
+
+    def _apply(self, threads):
+        try:
+            import cv2
+            cv2.setNumThreads(threads)
+        except ImportError:
+            pass
+
+        if THREADPOOLCTL_AVAILABLE:
+            try:
+                if self._blas_limiter is not None:
+                    self._blas_limiter.restore_original_limits()
+                self._blas_limiter = threadpool_limits(limits=threads, user_api='blas')
+            except Exception as e:
+                print(f"Could not limit BLAS threads: {e}")
+                self._blas_limiter = None
+
+    def _rebalance(self, reason):
+        threads = max(1, self.budget // max(1, self.active))
+        if threads != self.threads or self.decisions == 0:
+            self._apply(threads)
+        self.threads = threads
+        self.decisions += 1
+        self.recent.append({'time': time.time(), 'reason': reason, 'active': self.active, 'threads': threads})
+        return threads
+
+    def acquire(self):
+        with self._lock:
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            return self._rebalance('acquire')
+
+    def release(self):
+        with self._lock:
+            self.active = max(0, self.active - 1)
+            self._rebalance('release')
+
+    @contextmanager
+    def request_slot(self):
+        threads = self.acquire()
+        try:
+            yield threads
+        finally:
+            self.release()
+
+    def configure_tensorflow(self, tf):
+        # TensorFlow only accepts thread settings before its runtime starts, so the first
+        # call wins and later ones are recorded as no-ops.
+        if self.tensorflow is not None:
+            return self.tensorflow
+        intra = self.budget
+        inter = 1 if self.budget < 4 else 2
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(intra)
+            tf.config.threading.set_inter_op_parallelism_threads(inter)
+            self.tensorflow = {'intra_op': intra, 'inter_op': inter}
+        except RuntimeError as e:
+            print(f"TensorFlow threads already initialized: {e}")
+            self.tensorflow = {
+                'intra_op': tf.config.threading.get_intra_op_parallelism_threads(),
+                'inter_op': tf.config.threading.get_inter_op_parallelism_threads(),
+            }
+        return self.tensorflow
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cores': self.cores,
+                'workers': self.workers,
+                'process_budget': self.budget,
+                'active_requests': self.active,
+                'peak_active_requests': self.peak_active,
+                'threads_per_request': self.threads,
+                'blas_env': {var: os.environ.get(var) for var in BLAS_ENV_VARS},
+                'blas_runtime_control': THREADPOOLCTL_AVAILABLE,
+                'tensorflow': self.tensorflow,
+                'decisions': self.decisions,
+                'recent_decisions': list(self.recent),
+            }
+
+governor = ResourceGovernor()
@@ -0,0 +1,215 @@
+import os
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from organoid_workspace import WORKSPACES_DIRNAME, MANIFEST_NAME, INFLIGHT_MARKER
+
+MAX_BYTES = int(float(os.environ.get('ORGANOID_RETENTION_MAX_MB', '2048')) * 1024 * 1024)
+TTL_SECONDS = float(os.environ.get('ORGANOID_RETENTION_TTL_HOURS', '24')) * 3600
+SWEEP_INTERVAL = float(os.environ.get('ORGANOID_RETENTION_INTERVAL', '300'))
+INFLIGHT_STALE_SECONDS = float(os.environ.get('ORGANOID_INFLIGHT_STALE_SECONDS', '900'))
+LOW_WATERMARK = 0.9
+
+KEEP_NAMES = {'.gitkeep', WORKSPACES_DIRNAME, '.retention.lock'}
+
+def _tree_usage(path):
+    size = 0
+    newest = 0.0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            st = os.stat(current, follow_symlinks=False)
+        except OSError:
+            continue
+        newest = max(newest, st.st_mtime)
+        if not os.path.isdir(current) or os.path.islink(current):
+            size += st.st_size
+            continue
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    stack.append(entry.path)
+        except OSError:
+            continue
+    return size, newest
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class RetentionManager:
+    # Evicts whole workspaces (and any loose legacy entries) from the upload/result folders,
+    # oldest-used first, once they pass the TTL or the folders exceed max_bytes.
+    def __init__(self, upload_folder, results_folder=None, max_bytes=MAX_BYTES, ttl_seconds=TTL_SECONDS,
+                 interval=SWEEP_INTERVAL, inflight_stale_seconds=INFLIGHT_STALE_SECONDS):
+        self.upload_folder = upload_folder
+        self.results_folder = results_folder
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.interval = interval
+        self.inflight_stale_seconds = inflight_stale_seconds
+
+        self.usage_bytes = 0
+        self.entries = 0
+        self.inflight = 0
+        self.evicted_ttl = 0
+        self.evicted_size = 0
+        self.evicted_bytes = 0
+        self.sweeps = 0
+        self.last_sweep = None
+        self.last_sweep_seconds = None
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _entries(self):
+        found = []
+        jobs_dir = os.path.join(self.upload_folder, WORKSPACES_DIRNAME)
+        roots = [jobs_dir, self.upload_folder]
+        if self.results_folder:
+            roots.append(self.results_folder)
+
+        for root in roots:
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+            for name in names:
+                if root != jobs_dir and name in KEEP_NAMES:
+                    continue
+                found.append(os.path.join(root, name))
+        return found
+
+    def _describe(self, path):
+        size, newest = _tree_usage(path)
+        last_used = newest
+        manifest = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest):
+            last_used = os.path.getmtime(manifest)
+
+        inflight = False
+        marker = os.path.join(path, INFLIGHT_MARKER)
+        if os.path.exists(marker):
+            inflight = (time.time() - os.path.getmtime(marker)) < self.inflight_stale_seconds
+        elif os.path.basename(path).startswith('.staging-'):
+            inflight = (time.time() - newest) < self.inflight_stale_seconds
+
+        return {'path': path, 'size': size, 'last_used': last_used, 'inflight': inflight}
+
+    def _acquire_host_lock(self):
+        if fcntl is None:
+            return None
+        lock_path = os.path.join(self.upload_folder, '.retention.lock')
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        return fd
+
+    def sweep(self):
+        with self._lock:
+            lock_fd = self._acquire_host_lock()
+            if lock_fd is False:
+                # Another worker process on this host is sweeping the same folders.
+                return self.stats()
+            try:
+                return self._sweep()
+            finally:
+                if lock_fd is not None:
+                    os.close(lock_fd)
+
+    def _sweep(self):
+        started = time.time()
+        entries = [self._describe(p) for p in self._entries()]
+        total = sum(e['size'] for e in entries)
+
+        evictable = sorted((e for e in entries if not e['inflight']), key=lambda e: e['last_used'])
+        cutoff = started - self.ttl_seconds
+        target = self.max_bytes * LOW_WATERMARK
+        remaining = []
+
+        for e in evictable:
+            if self.ttl_seconds > 0 and e['last_used'] < cutoff:
+                _remove(e['path'])
+                total -= e['size']
+                self.evicted_ttl += 1
+                self.evicted_bytes += e['size']
+            else:
+                remaining.append(e)
+
+        if self.max_bytes > 0 and total > self.max_bytes:
+            for e in remaining:
+                if total <= target:
+                    break
+                _remove(e['path'])
+                total -= e['size']
+                self.evicted_size += 1
+                self.evicted_bytes += e['size']
+
+        self.usage_bytes = total
+        self.entries = len([e for e in entries if os.path.exists(e['path'])])
+        self.inflight = len([e for e in entries if e['inflight']])
+        self.sweeps += 1
+        self.last_sweep = started
+        self.last_sweep_seconds = time.time() - started
+        return self.stats()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Retention sweep failed: {e}")
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='organoid-retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def touch(self, workspace_id):
+        manifest = os.path.join(self.upload_folder, WORKSPACES_DIRNAME, os.path.basename(workspace_id), MANIFEST_NAME)
+        try:
+            os.utime(manifest)
+        except OSError:
+            pass
+
+    def stats(self):
+        return {
+            'usage_bytes': self.usage_bytes,
+            'usage_mb': round(self.usage_bytes / (1024 * 1024), 2),
+            'max_mb': round(self.max_bytes / (1024 * 1024), 2),
+            'ttl_hours': round(self.ttl_seconds / 3600, 2),
+            'entries': self.entries,
+            'inflight': self.inflight,
+            'evicted_ttl': self.evicted_ttl,
+            'evicted_size': self.evicted_size,
+            'evicted_mb': round(self.evicted_bytes / (1024 * 1024), 2),
+            'sweeps': self.sweeps,
+            'last_sweep': self.last_sweep,
+            'last_sweep_seconds': self.last_sweep_seconds,
+        }
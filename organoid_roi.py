@@ -0,0 +1,216 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from organoid_frames import Frame, iter_images
+
+# 'auto' finds the circular well (or matrix dome) in each image, blanks everything outside it and
+# analyzes only its bounding box; 'off' analyzes whole frames. Per request with the `roi` field.
+ROI_MODE = os.environ.get('ORGANOID_ROI', 'off')
+ROI_MODES = ('off', 'auto')
+# Detection runs on a copy shrunk to this longest side; the well is the largest thing in the frame.
+DETECT_MAX_SIDE = 256
+# Well radius bounds as fractions of the shorter and longer image side.
+MIN_WELL_RADIUS = 0.25
+MAX_WELL_RADIUS = 0.75
+# Median grey-level step across the rim a candidate needs, so a faint ring of organoids is not
+# taken for the wall.
+MIN_RIM_CONTRAST = float(os.environ.get('ORGANOID_ROI_CONTRAST', '12'))
+# At least this share of the rim must lie inside the frame, and this share of that must be on an edge.
+MIN_RIM_VISIBLE = 0.4
+MIN_RIM_SUPPORT = 0.6
+RIM_SAMPLES = 360
+# The mask stops this fraction of the radius inside the detected edge, so the wall's own
+# gradient is not segmented.
+RIM_INSET = 0.03
+CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+class Roi:
+    # A detected well in full-frame pixels: centre, masked radius and the crop box (x0, y0, x1, y1).
+    __slots__ = ('x', 'y', 'r', 'box', 'shape')
+
+    def __init__(self, x, y, r, shape):
+        h, w = shape[:2]
+        self.x, self.y, self.r = float(x), float(y), float(r) * (1 - RIM_INSET)
+        self.shape = (h, w)
+        self.box = (max(0, int(self.x - self.r)), max(0, int(self.y - self.r)),
+                    min(w, int(np.ceil(self.x + self.r)) + 1), min(h, int(np.ceil(self.y + self.r)) + 1))
+
+    @property
+    def fraction(self):
+        x0, y0, x1, y1 = self.box
+        return (x1 - x0) * (y1 - y0) / float(self.shape[0] * self.shape[1])
+
+    def info(self):
+        x0, y0, x1, y1 = self.box
+        return {'x': round(self.x, 1), 'y': round(self.y, 1), 'r': round(self.r, 1),
+                'crop': [x0, y0, x1 - x0, y1 - y0], 'pixels': round(self.fraction, 3)}
+
+def _rim_score(gray, edges, x, y, r):
+    # (median grey-level step across the rim, share of the rim inside the frame, share of the
+    # visible rim lying on an edge) for one candidate circle.
+    h, w = gray.shape
+    angles = np.linspace(0, 2 * np.pi, RIM_SAMPLES, endpoint=False)
+    px = np.round(x + r * np.cos(angles)).astype(int)
+    py = np.round(y + r * np.sin(angles)).astype(int)
+    inside = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+    visible = inside.mean()
+    if not inside.any():
+        return 0.0, 0.0, 0.0
+    support = float(edges[py[inside], px[inside]].astype(bool).mean())
+
+    yy, xx = np.ogrid[:h, :w]
+    dist = np.hypot(xx - x, yy - y)
+    inner = gray[(dist > 0.85 * r) & (dist < 0.95 * r)]
+    outer = gray[(dist > 1.05 * r) & (dist < 1.15 * r)]
+    if inner.size == 0 or outer.size == 0:
+        return 0.0, visible, support
+    return abs(float(np.median(inner)) - float(np.median(outer))), visible, support
+
+def detect_well(img):
+    # The most contrasted large circle whose rim is traced by an actual edge, or None when the
+    # image shows no well (e.g. a field of view entirely inside it). Uneven illumination can give a
+    # broad circular brightness step; it has no sharp edge and is rejected.
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    h, w = gray.shape[:2]
+    scale = min(1.0, DETECT_MAX_SIDE / float(max(h, w)))
+    small = cv2.resize(gray, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (5, 5), 0)
+    sh, sw = small.shape
+    min_r = int(MIN_WELL_RADIUS * min(sh, sw))
+    max_r = int(MAX_WELL_RADIUS * max(sh, sw))
+    circles = cv2.HoughCircles(small, cv2.HOUGH_GRADIENT, 2, max(sh, sw), param1=80, param2=30,
+                               minRadius=min_r, maxRadius=max_r)
+    if circles is None:
+        return None
+
+    # Edges within a pixel or two of the circle count as support.
+    edges = cv2.dilate(cv2.Canny(small, 40, 80), np.ones((5, 5), np.uint8))
+    best = None
+    for x, y, r in circles[0][:5]:
+        contrast, visible, support = _rim_score(small, edges, x, y, r)
+        if (contrast >= MIN_RIM_CONTRAST and visible >= MIN_RIM_VISIBLE and support >= MIN_RIM_SUPPORT
+                and (best is None or contrast > best[0])):
+            best = (contrast, x, y, r)
+    if best is None:
+        return None
+    _, x, y, r = best
+    return Roi(x / scale, y / scale, r / scale, gray.shape)
+
+def find_roi(img, key=None):
+    # Cached per image content, or per `key` (experiment/well) so a well found on day 1 is reused
+    # for the rest of the time course as long as the frame size matches.
+    if key is None:
+        key = ('image', hashlib.sha1(img[::8, ::8].tobytes()).hexdigest(), img.shape)
+    else:
+        key = ('well', key, img.shape)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    roi = detect_well(img)
+
+    with _cache_lock:
+        _cache[key] = roi
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return roi
+
+def crop(img, roi):
+    # Copy of the well's bounding box with everything outside the well set to the rim's mean
+    # colour, so thresholds see a flat background instead of the plate wall.
+    x0, y0, x1, y1 = roi.box
+    box = img[y0:y1, x0:x1]
+    centre, radius = (round(roi.x - x0), round(roi.y - y0)), int(roi.r)
+    mask = np.zeros(box.shape[:2], np.uint8)
+    cv2.circle(mask, centre, radius, 255, max(2, radius // 20))
+    mask &= cv2.circle(np.zeros_like(mask), centre, radius, 255, -1)
+    fill = cv2.mean(box, mask)[:box.shape[2] if box.ndim == 3 else 1]
+    out = np.empty_like(box)
+    out[:] = np.round(fill).astype(box.dtype)
+    cv2.circle(mask, centre, radius, 255, -1)
+    cv2.copyTo(box, mask, out)
+    return out
+
+def roi_options(mode=None, experiment=None, well=None):
+    # run_analysis options for a request: the ROI mode (anything but 'auto' is off) and, when the
+    # request names its well, the key under which that well's images share one detection.
+    mode = mode or ROI_MODE
+    key = f"{experiment or ''}/{well}" if mode == 'auto' and well else None
+    return {'roi': mode, 'roi_key': key}
+
+def roi_sources(image_map, rois, key=None):
+    # (day, source) pairs with each image replaced by its cropped well; `rois` is filled with
+    # day -> (Roi, path, source) as they are found. Z-stacks and images without a detectable
+    # well pass through unchanged.
+    from organoid_zstack import ZStack
+
+    items = image_map.items() if hasattr(image_map, 'items') else image_map
+    for day, source in items:
+        if isinstance(source, ZStack):
+            yield day, source
+            continue
+        for _, path, img in iter_images([(day, source)]):
+            roi = find_roi(img, key)
+            if roi is None:
+                yield day, Frame(img, path, getattr(source, 'index', 0))
+                continue
+            rois[day] = (roi, path, source)
+            yield day, Frame(crop(img, roi), path, getattr(source, 'index', 0))
+
+def _shift(shape, dx, dy):
+    shape = dict(shape)
+    if shape['type'] == 'polygon':
+        shape['points'] = [[x + dx, y + dy] for x, y in shape['points']]
+    else:
+        shape['x'] += dx
+        shape['y'] += dy
+    return shape
+
+def restore(results, rois, debug_file):
+    # Maps results of cropped images back to full-frame pixels: vector shapes and measured objects
+    # are offset, the resolution is the whole frame's, and a debug image written for the crop is
+    # replaced by one of the full frame: the plain image in vector mode, the overlay pasted in with
+    # the well outlined otherwise. `debug_file(day, path)` names that image.
+    for res in results:
+        found = rois.get(res.get('day'))
+        if found is None:
+            continue
+        roi, path, source = found
+        x0, y0, x1, y1 = roi.box
+        if 'shapes' in res:
+            res['shapes'] = [_shift(s, x0, y0) for s in res['shapes']]
+        for obj in res.get('objects', ()):
+            obj['x'] += x0
+            obj['y'] += y0
+        res['resolution'] = f"{roi.shape[1]}x{roi.shape[0]}"
+        res['roi'] = roi.info()
+
+        name = debug_file(res['day'], path)
+        if not os.path.exists(name):
+            continue
+        full = next((i for _, _, i in iter_images([(res['day'], source)])), None)
+        if full is None:
+            continue
+        if 'shapes' not in res:
+            debug = cv2.imread(name)
+            if debug is None or debug.shape[:2] != (y1 - y0, x1 - x0):
+                continue
+            # Only the well is taken from the overlay; around it the frame shows as uploaded.
+            full = full.copy()
+            mask = np.zeros(debug.shape[:2], np.uint8)
+            cv2.circle(mask, (round(roi.x - x0), round(roi.y - y0)), int(roi.r), 255, -1)
+            cv2.copyTo(debug, mask, full[y0:y1, x0:x1])
+            cv2.circle(full, (round(roi.x), round(roi.y)), int(roi.r), (0, 200, 255), 2)
+        cv2.imwrite(name, full)
+    return results
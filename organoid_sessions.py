@@ -0,0 +1,258 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from organoid_frames import expand_sources, iter_images
+from organoid_resources import governor
+from organoid_sweep import SWEEP_METHODS, StagedImage, parse_grid, segment
+from organoid_uploads import WORKSPACE_ID
+from organoid_vectors import circle, polygon
+from organoid_workspace import WORKSPACES_DIRNAME, MANIFEST_NAME, INFLIGHT_MARKER
+
+MAX_SESSIONS = int(os.environ.get('ORGANOID_SESSION_MAX', '8'))
+MAX_BYTES = int(float(os.environ.get('ORGANOID_SESSION_MAX_MB', '512')) * 1024 * 1024)
+TTL_SECONDS = float(os.environ.get('ORGANOID_SESSION_TTL', '600'))
+EXPIRE_INTERVAL = 30
+# A session created from a workspace is described in <workspace>/session.json (method, source
+# arguments, current parameters); its mtime is the session's last use. Another server process that
+# gets a request for the session rebuilds its stages from the workspace's files.
+SESSION_NAME = 'session.json'
+
+class SessionTooLarge(ValueError):
+    pass
+
+def shape_of(obj):
+    if obj is None:
+        return None
+    if isinstance(obj, tuple):
+        return circle(*obj)
+    return polygon(obj)
+
+class Session:
+    # Decoded images and their parameter-independent stages for one upload, kept in memory so
+    # changing a threshold only reruns the stages after it.
+    def __init__(self, method, images, session_id=None, path=None, source_args=None):
+        self.id = session_id or uuid.uuid4().hex
+        self.method = method
+        self.images = images
+        self.path = path
+        self.source_args = dict(source_args or {})
+        self.params = dict(SWEEP_METHODS[method][2])
+        self.created = time.time()
+        self.last_used = self.created
+        self.updates = 0
+        self.lock = threading.Lock()
+
+    def nbytes(self):
+        return sum(staged.nbytes() for _, staged in self.images)
+
+    def update(self, params=None):
+        _, points = parse_grid(self.method, params or {})
+        if len(points) != 1:
+            raise ValueError("Session updates take single parameter values, not lists.")
+
+        with self.lock:
+            started = time.perf_counter()
+            self.params.update(points[0])
+            results = []
+            for day, staged in self.images:
+                objects = segment(staged, self.method, self.params)
+                areas = [a for a, _ in objects]
+                total = float(sum(areas))
+                h, w = staged.shape
+                results.append({
+                    'day': day,
+                    'count': len(objects),
+                    'total_area': total,
+                    'avg_size': total / len(objects) if objects else 0.0,
+                    'resolution': f"{w}x{h}",
+                    'objects': [dict(shape_of(o) or {}, area=a) for a, o in objects],
+                })
+            self.updates += 1
+            self.last_used = time.time()
+            self.save()
+            return {'session': self.id, 'method': self.method, 'params': dict(self.params), 'results': results,
+                    'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+    def save(self):
+        # Writes the descriptor other server processes rebuild this session from; also keeps the
+        # workspace marked in flight so retention leaves it alone while the session is used.
+        if self.path is None:
+            return
+        tmp = os.path.join(self.path, f".{SESSION_NAME}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump({'method': self.method, 'params': self.params, 'source_args': self.source_args}, f)
+        os.replace(tmp, os.path.join(self.path, SESSION_NAME))
+        try:
+            os.utime(os.path.join(self.path, INFLIGHT_MARKER))
+        except OSError:
+            pass
+
+class SessionStore:
+    # LRU of live sessions, bounded by count and by the bytes of their cached stages. Sessions idle
+    # for longer than ttl_seconds are dropped by a background thread (and on every access). With
+    # `upload_root`, sessions are shared through their workspaces: every server process can update
+    # or delete any session, caching its own copy of the stages.
+    def __init__(self, max_sessions=MAX_SESSIONS, max_bytes=MAX_BYTES, ttl_seconds=TTL_SECONDS, upload_root=None):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.upload_root = upload_root
+        self.restored = 0
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _stage(self, method, image_paths):
+        if method not in SWEEP_METHODS:
+            raise ValueError(f"Method '{method}' does not support sessions. Expected one of {tuple(SWEEP_METHODS)}.")
+        blur = SWEEP_METHODS[method][1]
+        images = [(day, StagedImage(img, blur)) for day, _, img in iter_images(image_paths)]
+        if not images:
+            raise ValueError("No readable images")
+        return images
+
+    def _add(self, session):
+        size = session.nbytes()
+        if size > self.max_bytes:
+            raise SessionTooLarge(f"Session needs {size / 1048576:.0f} MB; the limit is {self.max_bytes / 1048576:.0f} MB.")
+        with self._lock:
+            self._sessions[session.id] = session
+            self._evict()
+
+    def create(self, method, image_paths, workspace=None, source_args=None):
+        # With a finalized `workspace` (whose files `image_paths` were expanded from with
+        # `source_args`), the session takes the workspace's id and keeps its files.
+        images = self._stage(method, image_paths)
+        if workspace is not None and self.upload_root is not None:
+            session = Session(method, images, workspace.id, workspace.path, source_args)
+        else:
+            session = Session(method, images)
+        initial = session.update()
+        self._add(session)
+        with self._lock:
+            self.created += 1
+        return session, initial
+
+    def _path(self, session_id):
+        if self.upload_root is None or not WORKSPACE_ID.match(session_id):
+            return None
+        return os.path.join(self.upload_root, WORKSPACES_DIRNAME, session_id)
+
+    def _load(self, path):
+        # The saved descriptor, or None once the session was deleted or has expired (its files
+        # are removed then).
+        try:
+            with open(os.path.join(path, SESSION_NAME)) as f:
+                saved = json.load(f)
+            last_used = os.path.getmtime(os.path.join(path, SESSION_NAME))
+        except (OSError, ValueError):
+            return None
+        if last_used < time.time() - self.ttl_seconds:
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        return saved
+
+    def _restore(self, session_id, path, saved):
+        # A session created by another server process: stage its images here.
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            files = json.load(f)['files']
+        image_map = {e['day']: os.path.join(path, e['name']) for e in files}
+        with governor.request_slot():
+            images = self._stage(saved['method'], expand_sources(image_map, **saved['source_args']))
+        session = Session(saved['method'], images, session_id, path, saved['source_args'])
+        self._add(session)
+        with self._lock:
+            self.restored += 1
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        path = self._path(session_id)
+        if path is None:
+            return session
+        saved = self._load(path)
+        if saved is None:
+            with self._lock:
+                self._sessions.pop(session_id, None)
+            return None
+        if session is None:
+            try:
+                session = self._restore(session_id, path, saved)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not restore session {session_id}: {e}")
+                return None
+        with session.lock:
+            # Another process may have changed the parameters since this copy last ran.
+            session.params = dict(saved['params'])
+        return session
+
+    def delete(self, session_id):
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+        path = self._path(session_id)
+        if path is not None and os.path.exists(os.path.join(path, SESSION_NAME)):
+            shutil.rmtree(path, ignore_errors=True)
+            found = True
+        return found
+
+    def _usage(self):
+        return sum(s.nbytes() for s in self._sessions.values())
+
+    def _evict(self):
+        while self._sessions and (len(self._sessions) > self.max_sessions or self._usage() > self.max_bytes):
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        for sid in [sid for sid, s in self._sessions.items() if s.last_used < cutoff]:
+            del self._sessions[sid]
+            self.expired += 1
+
+    def expire(self):
+        with self._lock:
+            self._expire()
+
+    def _run(self):
+        while not self._stop.wait(EXPIRE_INTERVAL):
+            self.expire()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='organoid-sessions', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {
+                'sessions': len(self._sessions),
+                'max_sessions': self.max_sessions,
+                'usage_mb': round(self._usage() / (1024 * 1024), 2),
+                'max_mb': round(self.max_bytes / (1024 * 1024), 2),
+                'ttl_seconds': self.ttl_seconds,
+                'created': self.created,
+                'restored': self.restored,
+                'evicted': self.evicted,
+                'expired': self.expired,
+                'active': [{'id': s.id, 'method': s.method, 'images': len(s.images), 'updates': s.updates,
+                            'idle_seconds': round(now - s.last_used, 1)} for s in self._sessions.values()],
+            }
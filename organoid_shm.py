@@ -0,0 +1,103 @@
+import atexit
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from organoid_frames import Frame
+
+SHARED_MEMORY = os.environ.get('ORGANOID_SHARED_MEMORY', '1') not in ('0', 'false', 'off')
+# Short enough for macOS, whose POSIX shared-memory names are limited to 31 characters.
+NAME_PREFIX = 'org_'
+
+# Segments created by this process and not unlinked yet. Each one is unlinked as soon as its
+# image has been analyzed; whatever is left at exit (or after a crash, by Python's resource
+# tracker) is unlinked too, so segments never outlive the server.
+_owned = {}
+_lock = threading.Lock()
+_counters = {'segments': 0, 'bytes': 0}
+
+def _create(nbytes):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes),
+                                     name=f"{NAME_PREFIX}{os.getpid()}_{uuid.uuid4().hex[:12]}")
+    with _lock:
+        _owned[shm.name] = shm
+        _counters['segments'] += 1
+        _counters['bytes'] += nbytes
+    return shm
+
+def _release(shm):
+    with _lock:
+        _owned.pop(shm.name, None)
+    try:
+        shm.close()
+    except BufferError:
+        pass  # a view is still alive; the mapping goes away with it
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+@atexit.register
+def release_all():
+    with _lock:
+        owned = list(_owned.values())
+    for shm in owned:
+        _release(shm)
+
+class SharedFrame(Frame):
+    # A decoded frame whose pixels live in a shared-memory segment. Pickling it sends only the
+    # segment name, shape and dtype; load() in the worker maps the same pages as an ndarray view,
+    # so a 4K-16K frame crosses the process boundary without being serialized or copied.
+    __slots__ = ('shm_name', 'shape', 'dtype', '_shm')
+
+    def __init__(self, shm_name, shape, dtype, path, index=0):
+        super().__init__(None, path, index)
+        self.shm_name = shm_name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self._shm = None
+
+    def __reduce__(self):
+        return (SharedFrame, (self.shm_name, self.shape, self.dtype, self.path, self.index))
+
+    def load(self):
+        if self.image is None:
+            self._shm = shared_memory.SharedMemory(name=self.shm_name)
+            self.image = np.ndarray(self.shape, np.dtype(self.dtype), buffer=self._shm.buf)
+        return self.image
+
+    def detach(self):
+        # Worker side, after the analysis: drops the view and unmaps the segment (the owner unlinks it).
+        self.image = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                pass
+            self._shm = None
+
+def shareable(source):
+    # Decoded in-memory frames (TIFF pages, video frames, previews). Paths and lazily read
+    # z-stacks are cheaper to open in the worker than to ship, so they are sent as they are.
+    return SHARED_MEMORY and isinstance(source, Frame) and source.image is not None
+
+@contextmanager
+def shared_frame(frame):
+    # Copies the frame's pixels into a new segment (the only copy made) and yields a handle for a
+    # worker. The segment is unlinked on exit, including when the worker was killed mid-image.
+    img = np.ascontiguousarray(frame.image)
+    shm = _create(img.nbytes)
+    try:
+        np.ndarray(img.shape, img.dtype, buffer=shm.buf)[...] = img
+        yield SharedFrame(shm.name, img.shape, img.dtype.str, frame.path, frame.index)
+    finally:
+        _release(shm)
+
+def stats():
+    with _lock:
+        return {'enabled': SHARED_MEMORY, 'live_segments': len(_owned),
+                'segments_created': _counters['segments'], 'bytes_shared': _counters['bytes']}
@@ -0,0 +1,305 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+RESULTS_DB = os.environ.get('ORGANOID_RESULTS_DB', os.path.join('data', 'results.sqlite'))
+BATCH_SIZE = 64
+FLUSH_INTERVAL = 0.5
+MAX_QUEUE = 1000
+QUERY_LIMIT = 1000
+
+# Per-day columns; any other scalar a method reports (circularity, volume, homogeneity, ...)
+# goes into the day's `metrics` JSON.
+DAY_COLUMNS = ('count', 'total_area', 'avg_size')
+SKIP_KEYS = ('day', 'shapes', 'objects', 'original_url', 'debug_url', 'source')
+GROUP_COLUMNS = ('experiment', 'well', 'method', 'date')
+OBJECT_COLUMNS = ('kind', 'x', 'y', 'area', 'width', 'height')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_key TEXT NOT NULL UNIQUE,
+    experiment TEXT,
+    well TEXT,
+    method TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    created REAL NOT NULL,
+    date TEXT NOT NULL,
+    images INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_experiment ON runs (experiment, well, method, created);
+CREATE INDEX IF NOT EXISTS runs_method ON runs (method, created);
+CREATE INDEX IF NOT EXISTS runs_date ON runs (date, method);
+CREATE TABLE IF NOT EXISTS days (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    day INTEGER NOT NULL,
+    source TEXT,
+    resolution TEXT,
+    count INTEGER,
+    total_area REAL,
+    avg_size REAL,
+    metrics TEXT,
+    PRIMARY KEY (run_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS objects (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    day INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    x REAL,
+    y REAL,
+    area REAL,
+    width REAL,
+    height REAL,
+    PRIMARY KEY (run_id, day, idx)
+) WITHOUT ROWID;
+"""
+
+def _scalar(value):
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value)
+    return value if isinstance(value, str) else None
+
+def day_row(res):
+    metrics = {}
+    for key, value in res.items():
+        if key in SKIP_KEYS or key in DAY_COLUMNS or key == 'resolution':
+            continue
+        value = _scalar(value)
+        if value is not None:
+            metrics[key] = value
+    return (int(res['day']), res.get('source'), res.get('resolution'),
+            *(_scalar(res.get(key)) for key in DAY_COLUMNS), json.dumps(metrics) if metrics else None)
+
+def object_rows(objects):
+    # (kind, x, y, area, width, height) per segmented object, as the analyzer measured it
+    # (Overlay.measure); recorded whatever the output mode.
+    return [tuple(_scalar(obj.get(key)) for key in OBJECT_COLUMNS) for obj in objects or ()]
+
+class ResultStore:
+    # Persistent results of every analysis, in SQLite: one row per run (indexed by experiment,
+    # well, method and date), per day/frame, and per measured object.
+    # record() only converts and enqueues; a writer thread inserts in batches, one transaction per
+    # batch, so requests never wait on the disk. WAL mode lets queries read while it writes, and
+    # several gunicorn workers can share one file.
+    def __init__(self, path=RESULTS_DB, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.enabled = bool(path) and path != 'off'
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self._queue = queue.Queue(maxsize=MAX_QUEUE)
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.enabled:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            with self._connect() as conn:
+                conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def record(self, run_key, method, results, images=None, experiment=None, well=None, origin='analyze'):
+        # Called on the request path: only enqueues. The results are converted to rows by the
+        # writer thread, so they must not be modified afterwards.
+        if not self.enabled or not results:
+            return False
+        entry = {
+            'run': (run_key, experiment or None, well or None, method, origin, time.time()),
+            'images': len(images) if images is not None else len({res['day'] for res in results}),
+            'failed': sum(1 for i in images or () if 'error' in i),
+            'results': results,
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.recorded += 1
+        return True
+
+    def _write(self, conn, batch):
+        with conn:
+            for entry in batch:
+                run_key, experiment, well, method, origin, created = entry['run']
+                date = time.strftime('%Y-%m-%d', time.localtime(created))
+                # A run recorded in several parts (the watch folder) accumulates its counts.
+                conn.execute(
+                    "INSERT INTO runs (run_key, experiment, well, method, origin, created, date, images, failed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (run_key) DO UPDATE SET "
+                    "images = images + excluded.images, failed = failed + excluded.failed",
+                    (run_key, experiment, well, method, origin, created, date, entry['images'], entry['failed']))
+                run_id = conn.execute("SELECT id FROM runs WHERE run_key = ?", (run_key,)).fetchone()[0]
+                results = entry['results']
+                conn.executemany(
+                    "INSERT OR REPLACE INTO days (run_id, day, source, resolution, count, total_area, avg_size, metrics) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(run_id, *day_row(res)) for res in results])
+                for res in results:
+                    day = int(res['day'])
+                    conn.execute("DELETE FROM objects WHERE run_id = ? AND day = ?", (run_id, day))
+                    conn.executemany(
+                        "INSERT INTO objects (run_id, day, idx, kind, x, y, area, width, height) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(run_id, day, i, *row) for i, row in enumerate(object_rows(res.get('objects')))])
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            while True:
+                try:
+                    batch = [self._queue.get(timeout=self.flush_interval)]
+                except queue.Empty:
+                    if self._stop.is_set():
+                        break
+                    continue
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self._write(conn, batch)
+                    self.written += len(batch)
+                except (sqlite3.Error, KeyError, TypeError, ValueError) as e:
+                    self.errors += 1
+                    self.last_error = str(e)
+                    print(f"Results store error: {e}")
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            conn.close()
+
+    def start(self):
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='organoid-results', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def flush(self):
+        # Blocks until everything recorded so far is written (the writer must be running).
+        self._queue.join()
+
+    def _where(self, experiment=None, well=None, method=None, since=None, until=None):
+        clauses, params = [], []
+        for column, value in (('experiment', experiment), ('well', well), ('method', method)):
+            if value:
+                clauses.append(f"r.{column} = ?")
+                params.append(value)
+        if since:
+            clauses.append("r.date >= ?")
+            params.append(since)
+        if until:
+            clauses.append("r.date <= ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def runs(self, limit=100, offset=0, **filters):
+        # SQLite reads a negative LIMIT as "no limit", so it is clamped like the upper bound.
+        where, params = self._where(**filters)
+        rows = self._reader().execute(
+            "SELECT r.run_key, r.experiment, r.well, r.method, r.origin, r.created, r.date, r.images, r.failed, "
+            "(SELECT COALESCE(SUM(d.count), 0) FROM days d WHERE d.run_id = r.id) AS objects "
+            f"FROM runs r{where} ORDER BY r.created DESC LIMIT ? OFFSET ?",
+            params + [max(1, min(limit, QUERY_LIMIT)), max(0, offset)]).fetchall()
+        return [dict(row) for row in rows]
+
+    def run(self, run_key, with_objects=False):
+        conn = self._reader()
+        run = conn.execute("SELECT * FROM runs WHERE run_key = ?", (run_key,)).fetchone()
+        if run is None:
+            return None
+        days = []
+        for row in conn.execute("SELECT * FROM days WHERE run_id = ? ORDER BY day", (run['id'],)):
+            day = dict(row)
+            day.pop('run_id')
+            day.update(json.loads(day.pop('metrics') or '{}'))
+            days.append(day)
+        result = dict(run)
+        result.pop('id')
+        result['days'] = days
+        if with_objects:
+            by_day = {}
+            for row in conn.execute("SELECT day, kind, x, y, area, width, height FROM objects "
+                                    "WHERE run_id = ? ORDER BY day, idx", (run['id'],)):
+                by_day.setdefault(row['day'], []).append({k: row[k] for k in row.keys() if k != 'day'})
+            for day in days:
+                day['objects'] = by_day.get(day['day'], [])
+        return result
+
+    def aggregate(self, group_by=('experiment', 'method'), **filters):
+        # Cross-run summary: runs, images, total/mean object count and mean object size per group.
+        group_by = [c for c in group_by if c in GROUP_COLUMNS] or ['method']
+        columns = ", ".join(f"r.{c}" for c in group_by)
+        where, params = self._where(**filters)
+        rows = self._reader().execute(
+            f"SELECT {columns}, COUNT(DISTINCT r.id) AS runs, COUNT(d.day) AS images, "
+            "SUM(d.count) AS objects, AVG(d.count) AS mean_count, AVG(d.avg_size) AS mean_size, "
+            "AVG(d.total_area) AS mean_total_area, MIN(r.date) AS first_date, MAX(r.date) AS last_date "
+            f"FROM runs r JOIN days d ON d.run_id = r.id{where} GROUP BY {columns} ORDER BY {columns}",
+            params).fetchall()
+        return [dict(row) for row in rows]
+
+    def objects(self, bins=20, max_area=None, **filters):
+        # Size distribution of individual objects across runs, as a histogram of object areas.
+        bins = max(1, bins)
+        where, params = self._where(**filters)
+        conn = self._reader()
+        if max_area is None:
+            max_area = conn.execute(f"SELECT MAX(o.area) FROM runs r JOIN objects o ON o.run_id = r.id{where}",
+                                    params).fetchone()[0] or 0
+        width = max(float(max_area), 1.0) / bins
+        rows = conn.execute(
+            f"SELECT MIN(CAST(o.area / ? AS INTEGER), ?) AS bin, COUNT(*) AS n "
+            f"FROM runs r JOIN objects o ON o.run_id = r.id{where} GROUP BY bin ORDER BY bin",
+            [width, bins - 1] + params).fetchall()
+        counts = [0] * bins
+        for row in rows:
+            counts[row['bin']] = row['n']
+        return {'bin_width': width, 'edges': [round(i * width, 2) for i in range(bins + 1)], 'counts': counts,
+                'objects': sum(counts)}
+
+    def stats(self):
+        info = {'enabled': self.enabled, 'path': self.path, 'recorded': self.recorded, 'written': self.written,
+                'queued': self._queue.qsize(), 'dropped': self.dropped, 'errors': self.errors,
+                'last_error': self.last_error}
+        if self.enabled:
+            conn = self._reader()
+            for table in ('runs', 'days', 'objects'):
+                info[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        return info
+
+def query_filters(args):
+    # experiment / well / method / since / until (YYYY-MM-DD) from a request's query string.
+    return {key: args.get(key) or None for key in ('experiment', 'well', 'method', 'since', 'until')}
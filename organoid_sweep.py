@@ -0,0 +1,255 @@
+import itertools
+import json
+import time
+
+import cv2
+import numpy as np
+
+from organoid_circles import detect_circles, DP, MIN_DIST, PARAM1, PARAM2, MIN_RADIUS, MAX_RADIUS
+from organoid_frames import iter_images
+
+MAX_POINTS = 500
+MARKER_CACHE = 8
+
+# method -> (pipeline, fixed blur kernel, default parameters). Everything up to the parameter being
+# swept is computed once per image; only the stages after it run per grid point.
+SWEEP_METHODS = {
+    'basic': ('contours', 5, {'min_area': 100}),
+    'watershed': ('watershed', 5, {'fg_fraction': 0.4, 'min_area': 100}),
+    'arivis': ('watershed', 5, {'fg_fraction': 0.5, 'min_area': 100}),
+    'morphology': ('watershed', 5, {'fg_fraction': 0.5, 'min_area': 100}),
+    'stardist': ('watershed', 7, {'fg_fraction': 0.55, 'min_area': 80}),
+    'hough': ('hough', 5, {'dp': DP, 'min_dist': MIN_DIST, 'param1': PARAM1, 'param2': PARAM2,
+                           'min_radius': MIN_RADIUS, 'max_radius': MAX_RADIUS}),
+    'assayscope': ('hough', 5, {'dp': DP, 'min_dist': MIN_DIST, 'param1': PARAM1, 'param2': PARAM2,
+                                'min_radius': MIN_RADIUS, 'max_radius': MAX_RADIUS}),
+}
+
+class StagedImage:
+    # The parameter-independent stages of one image, computed on first use and kept: grayscale,
+    # blur + Otsu (with the analyzers' polarity flip), opening, sure background, distance transform
+    # and the Hough median blur. Watershed markers (and their areas/contours) are memoized for the
+    # last MARKER_CACHE foreground fractions.
+    def __init__(self, img, blur=5):
+        self.img = img
+        self.blur = blur
+        self.shape = img.shape[:2]
+        self._gray = None
+        self._thresh = None
+        self._opening = None
+        self._sure_bg = None
+        self._dist = None
+        self._median = None
+        self._contours = None
+        self._markers = {}
+        self._areas = {}
+        self._label_contours = {}
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def thresh(self):
+        if self._thresh is None:
+            blurred = cv2.GaussianBlur(self.gray, (self.blur, self.blur), 0)
+            _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=blurred)
+            if cv2.countNonZero(thresh) > (thresh.size / 2):
+                thresh = cv2.bitwise_not(thresh, dst=thresh)
+            self._thresh = thresh
+        return self._thresh
+
+    @property
+    def opening(self):
+        if self._opening is None:
+            kernel = np.ones((3, 3), np.uint8)
+            self._opening = cv2.morphologyEx(self.thresh, cv2.MORPH_OPEN, kernel, iterations=2)
+            self._sure_bg = cv2.dilate(self._opening, kernel, iterations=3)
+        return self._opening
+
+    @property
+    def dist(self):
+        if self._dist is None:
+            self._dist = cv2.distanceTransform(self.opening, cv2.DIST_L2, 5)
+        return self._dist
+
+    @property
+    def median(self):
+        if self._median is None:
+            self._median = cv2.medianBlur(self.gray, 5)
+        return self._median
+
+    def markers(self, fg_fraction):
+        key = round(float(fg_fraction), 6)
+        if key not in self._markers:
+            dist = self.dist
+            _, fg = cv2.threshold(dist, key * dist.max(), 255, 0)
+            sure_fg = fg.astype(np.uint8)
+            unknown = cv2.subtract(self._sure_bg, sure_fg)
+            _, markers = cv2.connectedComponents(sure_fg)
+            markers += 1
+            markers[unknown == 255] = 0
+            if len(self._markers) >= MARKER_CACHE:
+                oldest = next(iter(self._markers))
+                for memo in (self._markers, self._areas, self._label_contours):
+                    memo.pop(oldest, None)
+            self._markers[key] = cv2.watershed(self.img, markers)
+        return self._markers[key]
+
+    def label_areas(self, fg_fraction):
+        key = round(float(fg_fraction), 6)
+        if key not in self._areas:
+            self._areas[key] = label_areas(self.markers(key))
+        return self._areas[key]
+
+    def label_contours(self, fg_fraction):
+        # label -> outer contour. Watershed separates touching labels with -1 lines, so one
+        # findContours over all labels finds almost every region; the rare label whose region
+        # merged with a neighbour through a diagonal gap is traced on its own mask.
+        key = round(float(fg_fraction), 6)
+        if key not in self._label_contours:
+            markers = self.markers(key)
+            labels, _ = self.label_areas(key)
+            contours, _ = cv2.findContours(np.uint8(markers > 1), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            found = {}
+            for cnt in contours:
+                x, y = cnt[0][0]
+                found.setdefault(int(markers[y, x]), cnt)
+            for label in labels:
+                if int(label) not in found:
+                    cnts, _ = cv2.findContours(np.uint8(markers == label), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+                    if cnts:
+                        found[int(label)] = cnts[0]
+            self._label_contours[key] = found
+        return self._label_contours[key]
+
+    def nbytes(self):
+        arrays = [self.img, self._gray, self._thresh, self._opening, self._sure_bg, self._dist, self._median]
+        arrays += list(self._markers.values())
+        return int(sum(a.nbytes for a in arrays if a is not None))
+
+    def contour_areas(self):
+        if self._contours is None:
+            contours, _ = cv2.findContours(self.thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            self._contours = (contours, np.array([cv2.contourArea(c) for c in contours], np.float64))
+        return self._contours
+
+    def circles(self, params):
+        return detect_circles(self.gray, blurred=self.median, **params)
+
+def label_areas(markers):
+    # Pixel count per watershed label, same as countNonZero(markers == label); labels <= 1 are
+    # background/boundary.
+    counts = np.bincount((markers.ravel() + 1).astype(np.intp))
+    labels = np.arange(len(counts)) - 1
+    keep = labels > 1
+    return labels[keep], counts[keep].astype(np.float64)
+
+def evaluate(staged, method, params):
+    pipeline, _, defaults = SWEEP_METHODS[method]
+    p = dict(defaults, **params)
+
+    if pipeline == 'contours':
+        _, areas = staged.contour_areas()
+        areas = areas[areas > p['min_area']]
+    elif pipeline == 'watershed':
+        _, areas = staged.label_areas(p['fg_fraction'])
+        areas = areas[areas > p['min_area']]
+    else:
+        circles = staged.circles(p)
+        if circles is None:
+            areas = np.zeros(0)
+        else:
+            radii = np.uint16(np.around(circles))[0, :, 2].astype(np.float64)
+            areas = np.pi * radii ** 2
+
+    count = int(len(areas))
+    total = float(areas.sum()) if count else 0.0
+    return {'count': count, 'total_area': total, 'avg_size': total / count if count else 0.0}
+
+def segment(staged, method, params):
+    # Like evaluate(), but also returns the kept objects as (area, contour) or (area, circle) pairs.
+    pipeline, _, defaults = SWEEP_METHODS[method]
+    p = dict(defaults, **params)
+
+    if pipeline == 'contours':
+        contours, areas = staged.contour_areas()
+        return [(float(a), c) for a, c in zip(areas, contours) if a > p['min_area']]
+    if pipeline == 'watershed':
+        labels, areas = staged.label_areas(p['fg_fraction'])
+        found = staged.label_contours(p['fg_fraction'])
+        return [(float(a), found.get(int(label))) for label, a in zip(labels, areas) if a > p['min_area']]
+
+    circles = staged.circles(p)
+    if circles is None:
+        return []
+    return [(float(np.pi * float(c[2]) ** 2), tuple(int(v) for v in c)) for c in np.uint16(np.around(circles))[0]]
+
+def parse_grid(method, grid):
+    # `grid` is {param: value or [values]} (or its JSON text). Unknown parameters are rejected so a
+    # typo does not silently sweep nothing.
+    if method not in SWEEP_METHODS:
+        raise ValueError(f"Method '{method}' does not support sweeps. Expected one of {tuple(SWEEP_METHODS)}.")
+    if isinstance(grid, str):
+        grid = json.loads(grid) if grid.strip() else {}
+    if grid is not None and not isinstance(grid, dict):
+        raise ValueError("The grid must be an object of {parameter: value or [values]}.")
+    defaults = SWEEP_METHODS[method][2]
+
+    names = []
+    values = []
+    for name, vals in (grid or {}).items():
+        if name not in defaults:
+            raise ValueError(f"Unknown parameter '{name}' for {method}. Expected one of {tuple(defaults)}.")
+        vals = vals if isinstance(vals, (list, tuple)) else [vals]
+        if not vals:
+            raise ValueError(f"Empty value list for '{name}'.")
+        try:
+            floats = [float(v) for v in vals]
+        except (TypeError, ValueError):
+            raise ValueError(f"Values for '{name}' must be numbers: {vals}")
+        names.append(name)
+        values.append(floats)
+
+    points = int(np.prod([len(v) for v in values])) if values else 1
+    if points > MAX_POINTS:
+        raise ValueError(f"Grid has {points} points; at most {MAX_POINTS} are allowed.")
+    return names, [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+def run_sweep(method, image_paths, grid):
+    # Returns a compact table: one row per (day, grid point) with the swept parameters, count,
+    # total and mean area. Intermediates memoized on StagedImage are shared by all grid points.
+    names, points = parse_grid(method, grid)
+    blur = SWEEP_METHODS[method][1]
+    columns = ['day'] + names + ['count', 'total_area', 'avg_size']
+    rows = []
+    prepare_s = 0.0
+    evaluate_s = 0.0
+
+    for day, img_path, img in iter_images(image_paths):
+        started = time.perf_counter()
+        staged = StagedImage(img, blur)
+        if SWEEP_METHODS[method][0] == 'hough':
+            staged.median
+        elif SWEEP_METHODS[method][0] == 'watershed':
+            staged.dist
+        else:
+            staged.contour_areas()
+        prepare_s += time.perf_counter() - started
+
+        started = time.perf_counter()
+        for point in points:
+            res = evaluate(staged, method, point)
+            rows.append([day] + [point[n] for n in names] + [res['count'], res['total_area'], res['avg_size']])
+        evaluate_s += time.perf_counter() - started
+
+    return {
+        'method': method,
+        'defaults': SWEEP_METHODS[method][2],
+        'columns': columns,
+        'rows': rows,
+        'points': len(points),
+        'timing': {'prepare_ms': round(prepare_s * 1000, 1), 'evaluate_ms': round(evaluate_s * 1000, 1)},
+    }
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+_IMPORTED = time.perf_counter()
+
+import cv2
+import numpy as np
+
+from organoid_frames import iter_images
+from organoid_analysis_unet import import_tensorflow, load_unet_model, prob_map_to_mask
+from organoid_unet_runtime import (INPUT_SIZE, MODEL_DIR, MODEL_STEM, RUNTIMES, TFLITE_AVAILABLE, TFLiteUNet,
+                                   backend_for, preprocess)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+CALIBRATION_LIMIT = 64
+MIN_AREA = 80
+BENCH_RUNS = 20
+
+# Converts the Keras U-Net to ONNX and/or TFLite (optionally int8), checks the exported model
+# against Keras, and benchmarks each backend in a fresh process so import cost and resident
+# memory are measured honestly:
+#
+#   python organoid_unet_export.py export --format both --int8 --images calibration_dir/
+#   python organoid_unet_export.py validate models/unet_organoid_model.int8.onnx --images dir/
+#   python organoid_unet_export.py benchmark
+
+def image_batches(image_dir, limit=CALIBRATION_LIMIT):
+    names = sorted(n for n in os.listdir(image_dir) if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS)
+    paths = {i: os.path.join(image_dir, n) for i, n in enumerate(names[:limit])}
+    for _, path, img in iter_images(paths):
+        yield path, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def load_keras(path=None):
+    tf = import_tensorflow()
+    if path:
+        return tf.keras.models.load_model(path, compile=False)
+    return load_unet_model()
+
+def _model_fn(tf, model):
+    return tf.function(lambda x: model(x, training=False))
+
+def _signature(tf, batch):
+    return (tf.TensorSpec((batch, INPUT_SIZE[1], INPUT_SIZE[0], 1), tf.float32, name='input'),)
+
+def export_onnx(model, out_dir=MODEL_DIR, int8=False, image_dir=None, opset=13):
+    tf = import_tensorflow()
+    import tf2onnx
+
+    path = os.path.join(out_dir, f"{MODEL_STEM}.onnx")
+    tf2onnx.convert.from_function(_model_fn(tf, model), input_signature=_signature(tf, None),
+                                  opset=opset, output_path=path)
+    written = [path]
+    if int8:
+        from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+        int8_path = os.path.join(out_dir, f"{MODEL_STEM}.int8.onnx")
+        if image_dir:
+            # Static quantization calibrates activation ranges on real images (QDQ, per channel).
+            reader = _CalibrationReader(image_dir, _onnx_input_name(path))
+            quantize_static(path, int8_path, reader, quant_format=QuantFormat.QDQ,
+                            per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        else:
+            quantize_dynamic(path, int8_path, weight_type=QuantType.QUInt8)
+        written.append(int8_path)
+    return written
+
+def _onnx_input_name(path):
+    import onnx
+    return onnx.load(path).graph.input[0].name
+
+class _CalibrationReader:
+    def __init__(self, image_dir, input_name):
+        self.input_name = input_name
+        self._batches = (preprocess(gray) for _, gray in image_batches(image_dir))
+
+    def get_next(self):
+        batch = next(self._batches, None)
+        return None if batch is None else {self.input_name: batch}
+
+    def rewind(self):
+        pass
+
+def _save_fixed_shape(tf, model, saved):
+    # A SavedModel with a (1, 256, 256, 1) signature. Keras 3 needs Model.export() for the weights
+    # to be frozen into the converted model; older tf.keras saves a plain tf.Module instead.
+    try:
+        model.export(saved, format='tf_saved_model', input_signature=list(_signature(tf, 1)))
+    except (AttributeError, TypeError):
+        module = tf.Module()
+        module.model = model
+        module.serve = tf.function(lambda x: model(x, training=False), input_signature=_signature(tf, 1))
+        tf.saved_model.save(module, saved, signatures=module.serve)
+
+def export_tflite(model, out_dir=MODEL_DIR, int8=False, image_dir=None):
+    tf = import_tensorflow()
+    written = []
+    with tempfile.TemporaryDirectory() as saved:
+        _save_fixed_shape(tf, model, saved)
+        for quantize in ([False, True] if int8 else [False]):
+            converter = tf.lite.TFLiteConverter.from_saved_model(saved)
+            if quantize:
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+                if image_dir:
+                    # Integer kernels with float input/output, calibrated on real images; without
+                    # images this is dynamic-range quantization (int8 weights only).
+                    converter.representative_dataset = lambda: ([preprocess(g)] for _, g in image_batches(image_dir))
+            data = converter.convert()
+            path = os.path.join(out_dir, f"{MODEL_STEM}{'.int8' if quantize else ''}.tflite")
+            with open(path, 'wb') as f:
+                f.write(data)
+            written.append(path)
+    return written
+
+def _objects(prob_map, shape):
+    contours, _ = cv2.findContours(prob_map_to_mask(prob_map, shape), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    areas = [a for a in (cv2.contourArea(c) for c in contours) if a > MIN_AREA]
+    return len(areas), float(sum(areas))
+
+def load_exported(path):
+    backend = backend_for(path)
+    if backend == 'tflite' and not TFLITE_AVAILABLE:
+        # TensorFlow is loaded here anyway, and its interpreter runs the same kernels.
+        return TFLiteUNet(path, interpreter_cls=import_tensorflow().lite.Interpreter)
+    return RUNTIMES[backend][0](path)
+
+def validate(model_path, image_dir, keras_model=None):
+    # Per image: probability-map differences, IoU of the 0.5-thresholded masks, and the count and
+    # total area the analyzer would report from each model.
+    keras_model = keras_model or load_keras()
+    candidate = load_exported(model_path)
+    rows = []
+    for path, gray in image_batches(image_dir):
+        batch = preprocess(gray)
+        ref = keras_model.predict(batch, verbose=0)[0, :, :, 0]
+        out = candidate.predict(batch)[0, :, :, 0]
+        a, b = ref > 0.5, out > 0.5
+        union = np.logical_or(a, b).sum()
+        ref_count, ref_area = _objects(ref, gray.shape)
+        count, area = _objects(out, gray.shape)
+        rows.append({
+            'image': os.path.basename(path),
+            'max_abs_diff': float(np.abs(ref - out).max()),
+            'mean_abs_diff': float(np.abs(ref - out).mean()),
+            'mask_iou': float(np.logical_and(a, b).sum() / union) if union else 1.0,
+            'count': [ref_count, count],
+            'total_area': [ref_area, area],
+        })
+    return {
+        'model': model_path,
+        'images': len(rows),
+        'max_abs_diff': max((r['max_abs_diff'] for r in rows), default=0.0),
+        'min_mask_iou': min((r['mask_iou'] for r in rows), default=1.0),
+        'count_mismatches': sum(1 for r in rows if r['count'][0] != r['count'][1]),
+        'per_image': rows,
+    }
+
+def _max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def bench_self(backend, model_path=None, keras_path=None, runs=BENCH_RUNS):
+    # Runs in the process being measured: time from importing the runtime to a loaded model,
+    # peak RSS and per-image latency.
+    if backend == 'keras':
+        model = load_keras(keras_path)
+    else:
+        model = RUNTIMES[backend][0](model_path)
+    load_s = time.perf_counter() - _IMPORTED
+
+    batch = preprocess(np.random.default_rng(0).integers(0, 255, (1024, 1024), dtype=np.uint8))
+    model.predict(batch, verbose=0)
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        model.predict(batch, verbose=0)
+        times.append((time.perf_counter() - started) * 1000)
+    return {
+        'backend': backend,
+        'model': model_path or keras_path or 'keras',
+        'load_s': round(load_s, 2),
+        'peak_rss_mb': round(_max_rss_mb(), 1),
+        'latency_ms_median': round(float(np.median(times)), 1),
+        'latency_ms_p95': round(float(np.percentile(times, 95)), 1),
+    }
+
+def benchmark(model_paths, keras_path=None, runs=BENCH_RUNS):
+    results = []
+    for backend, path in [('keras', None)] + [(backend_for(p), p) for p in model_paths]:
+        cmd = [sys.executable, os.path.abspath(__file__), '_bench', backend, '--runs', str(runs)]
+        if path:
+            cmd += ['--model', path]
+        if keras_path:
+            cmd += ['--keras-model', keras_path]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        lines = [l for l in proc.stdout.splitlines() if l.startswith('{')]
+        results.append(json.loads(lines[-1]) if lines else {'backend': backend, 'model': path,
+                                                            'error': proc.stderr.strip()[-300:]})
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export, validate and benchmark the U-Net.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('export')
+    p.add_argument('--format', choices=('onnx', 'tflite', 'both'), default='onnx')
+    p.add_argument('--int8', action='store_true', help="also write an int8-quantized model")
+    p.add_argument('--images', help="calibration/validation images (enables static int8)")
+    p.add_argument('--keras-model', help="default: the model analyze_organoids_unet would load")
+    p.add_argument('--out', default=MODEL_DIR)
+
+    p = sub.add_parser('validate')
+    p.add_argument('model')
+    p.add_argument('--images', required=True)
+    p.add_argument('--keras-model')
+
+    p = sub.add_parser('benchmark')
+    p.add_argument('models', nargs='*')
+    p.add_argument('--keras-model')
+    p.add_argument('--runs', type=int, default=BENCH_RUNS)
+
+    p = sub.add_parser('_bench')
+    p.add_argument('backend')
+    p.add_argument('--model')
+    p.add_argument('--keras-model')
+    p.add_argument('--runs', type=int, default=BENCH_RUNS)
+
+    args = parser.parse_args(argv)
+
+    if args.command == '_bench':
+        print(json.dumps(bench_self(args.backend, args.model, args.keras_model, args.runs)))
+        return
+
+    if args.command == 'export':
+        model = load_keras(args.keras_model)
+        os.makedirs(args.out, exist_ok=True)
+        written = []
+        if args.format in ('onnx', 'both'):
+            written += export_onnx(model, args.out, args.int8, args.images)
+        if args.format in ('tflite', 'both'):
+            written += export_tflite(model, args.out, args.int8, args.images)
+        for path in written:
+            print(f"Wrote {path} ({os.path.getsize(path) / 1048576:.1f} MB)")
+            if args.images:
+                report = validate(path, args.images, model)
+                print(f"  max |p - p_keras| = {report['max_abs_diff']:.4f}, min mask IoU = "
+                      f"{report['min_mask_iou']:.4f}, count mismatches = {report['count_mismatches']}/{report['images']}")
+        return
+
+    if args.command == 'validate':
+        print(json.dumps(validate(args.model, args.images, load_keras(args.keras_model)), indent=2))
+        return
+
+    models = args.models
+    if not models and os.path.isdir(MODEL_DIR):
+        models = sorted(os.path.join(MODEL_DIR, n) for n in os.listdir(MODEL_DIR)
+                        if n.startswith(MODEL_STEM) and n.endswith(('.onnx', '.tflite')))
+    for row in benchmark(models, args.keras_model, args.runs):
+        print(json.dumps(row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from organoid_resources import governor
+
+try:
+    import onnxruntime as ort
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+
+try:
+    from tflite_runtime.interpreter import Interpreter as TFLiteInterpreter
+    TFLITE_AVAILABLE = True
+except ImportError:
+    try:
+        from ai_edge_litert.interpreter import Interpreter as TFLiteInterpreter
+        TFLITE_AVAILABLE = True
+    except ImportError:
+        TFLITE_AVAILABLE = False
+
+# 'auto' serves an exported model when one exists and its runtime is installed, else Keras;
+# 'keras', 'onnx' and 'tflite' force a backend.
+UNET_BACKEND = os.environ.get('ORGANOID_UNET_BACKEND', 'auto')
+UNET_MODEL = os.environ.get('ORGANOID_UNET_MODEL')
+MODEL_DIR = 'models'
+MODEL_STEM = 'unet_organoid_model'
+INPUT_SIZE = (256, 256)
+
+# Exported files written by organoid_unet_export, in the order 'auto' tries them. Quantized
+# models come first because int8 is an explicit opt-in at export time.
+RUNTIME_MODELS = (
+    ('onnx', f'{MODEL_STEM}.int8.onnx'),
+    ('onnx', f'{MODEL_STEM}.onnx'),
+    ('tflite', f'{MODEL_STEM}.int8.tflite'),
+    ('tflite', f'{MODEL_STEM}.tflite'),
+)
+
+def preprocess(gray):
+    # One grayscale image -> the (1, 256, 256, 1) float32 batch every backend takes.
+    resized = cv2.resize(gray, INPUT_SIZE)
+    return (resized.astype(np.float32) / 255.0)[None, :, :, None]
+
+def backend_for(path):
+    return 'tflite' if path.endswith('.tflite') else 'onnx'
+
+class OnnxUNet:
+    backend = 'onnx'
+
+    def __init__(self, path, threads=None):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or governor.budget
+        options.inter_op_num_threads = 1
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch, verbose=0):
+        return self.session.run(None, {self.input_name: np.asarray(batch, np.float32)})[0]
+
+class TFLiteUNet:
+    # Exported with a fixed batch of 1; an interpreter is not thread-safe, so calls are serialized.
+    backend = 'tflite'
+
+    def __init__(self, path, threads=None, interpreter_cls=None):
+        self.path = path
+        interpreter_cls = interpreter_cls or TFLiteInterpreter
+        self.interpreter = interpreter_cls(model_path=path, num_threads=threads or governor.budget)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.lock = threading.Lock()
+
+    def predict(self, batch, verbose=0):
+        out = []
+        with self.lock:
+            for x in np.asarray(batch, np.float32):
+                x = x[None]
+                scale, zero = self.input['quantization']
+                if self.input['dtype'] != np.float32 and scale:
+                    x = np.round(x / scale + zero).astype(self.input['dtype'])
+                self.interpreter.set_tensor(self.input['index'], x)
+                self.interpreter.invoke()
+                y = self.interpreter.get_tensor(self.output['index'])
+                scale, zero = self.output['quantization']
+                if self.output['dtype'] != np.float32 and scale:
+                    y = (y.astype(np.float32) - zero) * scale
+                out.append(y[0])
+        return np.stack(out)
+
+RUNTIMES = {'onnx': (OnnxUNet, ONNXRUNTIME_AVAILABLE), 'tflite': (TFLiteUNet, TFLITE_AVAILABLE)}
+
+def find_runtime_model(backend=UNET_BACKEND, model_dir=MODEL_DIR):
+    # (backend, path) of the exported model to serve, or None to use Keras.
+    if backend == 'keras':
+        return None
+    if UNET_MODEL:
+        candidates = [(backend_for(UNET_MODEL), UNET_MODEL)]
+    else:
+        candidates = [(b, os.path.join(model_dir, name)) for b, name in RUNTIME_MODELS]
+    for b, path in candidates:
+        if backend not in ('auto', b) or not os.path.exists(path):
+            continue
+        if not RUNTIMES[b][1]:
+            print(f"Found {path} but the {b} runtime is not installed.")
+            continue
+        return b, path
+    if backend != 'auto':
+        print(f"No usable {backend} U-Net model; falling back to Keras.")
+    return None
+
+_runtime_model = None
+_runtime_checked = False
+_runtime_lock = threading.Lock()
+
+def load_runtime_model():
+    # Looked up and loaded once per process, like the Keras model. None means serve with Keras.
+    global _runtime_model, _runtime_checked
+    with _runtime_lock:
+        if not _runtime_checked:
+            _runtime_checked = True
+            found = find_runtime_model()
+            if found is not None:
+                backend, path = found
+                print(f"Loading exported U-Net ({backend}) from {path}...")
+                _runtime_model = RUNTIMES[backend][0](path)
+        return _runtime_model
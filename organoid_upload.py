@@ -0,0 +1,120 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+RETRIES = 5
+POLL_INTERVAL = 1.0
+
+# Uploads an image set through the chunked /uploads API, resuming after dropped connections, and
+# prints the analysis once the background job is done. The server starts analyzing each file as
+# soon as it has arrived. An interrupted run can be continued with --resume <upload id>:
+#   python organoid_upload.py --server http://localhost:5174 --method watershed plates/*.tif
+# Only the standard library is used, so it runs on acquisition machines without the app installed.
+
+def sha256_of(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def call(server, method, path, body=None, headers=None):
+    # (status, JSON body); HTTP errors are returned, not raised.
+    data = json.dumps(body).encode() if isinstance(body, dict) else body
+    headers = dict(headers or {})
+    if isinstance(body, dict):
+        headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(server.rstrip('/') + path, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, json.loads(resp.read() or b'{}')
+    except urllib.error.HTTPError as e:
+        try:
+            return e.code, json.loads(e.read() or b'{}')
+        except ValueError:
+            return e.code, {'error': e.reason}
+
+def send_file(server, upload_id, entry, path, chunk_size):
+    offset = entry['received']
+    failures = 0
+    with open(path, 'rb') as f:
+        while offset < entry['size']:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            try:
+                status, body = call(server, 'PUT', entry['upload_url'], chunk,
+                                    {'Upload-Offset': str(offset), 'Content-Type': 'application/octet-stream'})
+            except OSError as e:
+                failures += 1
+                if failures > RETRIES:
+                    raise
+                print(f"  {entry['name']}: {e}; resuming")
+                time.sleep(min(2 ** failures, 30))
+                status, state = call(server, 'GET', f"/uploads/{upload_id}")
+                offset = state['files'][entry['file']]['received']
+                continue
+            if status == 409:
+                offset = body['received']  # the server has more (or less) than we thought
+            elif status == 422:
+                failures += 1
+                if failures > RETRIES:
+                    raise RuntimeError(body['error'])
+                print(f"  {entry['name']}: {body['error']}")
+                offset = 0
+            elif status != 200:
+                raise RuntimeError(f"{entry['name']}: {body.get('error', status)}")
+            else:
+                offset = body['received']
+    print(f"  {entry['name']}: {entry['size']} bytes verified")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload images in resumable chunks and analyze them.")
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--server', default='http://localhost:5174')
+    parser.add_argument('--method', default='basic')
+    parser.add_argument('--options', default='{}', help="JSON of further /analyze fields, e.g. '{\"frame_step\": 2}'")
+    parser.add_argument('--resume', metavar='UPLOAD_ID', help="continue an interrupted upload")
+    parser.add_argument('--json', help="write the final analysis response here")
+    args = parser.parse_args(argv)
+
+    paths = {os.path.basename(p): p for p in args.files}
+    if len(paths) != len(args.files):
+        parser.error("file names must be unique")
+
+    if args.resume:
+        status, state = call(args.server, 'GET', f"/uploads/{args.resume}")
+    else:
+        files = [{'name': name, 'size': os.path.getsize(p), 'sha256': sha256_of(p)} for name, p in paths.items()]
+        body = dict(json.loads(args.options), method=args.method, files=files)
+        status, state = call(args.server, 'POST', '/uploads', body)
+    if status not in (200, 201):
+        print(f"Error: {state.get('error', status)}")
+        return 1
+    print(f"Upload {state['upload']}: {len(state['files'])} files, {state['size']} bytes")
+
+    for entry in state['files']:
+        if not entry['complete']:
+            send_file(args.server, state['upload'], entry, paths[entry['name']], state['chunk_size'])
+
+    while True:
+        status, result = call(args.server, 'GET', state['status_url'])
+        if status != 202:
+            break
+        time.sleep(POLL_INTERVAL)
+    if status != 200:
+        print(f"Analysis failed: {result.get('error', status)}")
+        return 1
+    for res in result['results']:
+        print(f"  day {res['day']}: {res.get('count')} objects, average size {res.get('avg_size', 0):.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0 if not result.get('partial') else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+from organoid_frames import expand_sources
+from organoid_roi import roi_options
+from organoid_workspace import Workspace, WORKSPACES_DIRNAME, MANIFEST_NAME, INFLIGHT_MARKER, CHUNK_SIZE, file_digest
+
+# Suggested size of each PUT; any size works, chunks only have to arrive in order.
+UPLOAD_CHUNK_SIZE = int(os.environ.get('ORGANOID_UPLOAD_CHUNK_MB', '8')) * 1024 * 1024
+# An upload with no chunk for this long is given up: its analysis finishes with the files that
+# arrived. Kept at the retention sweep's in-flight staleness so the workspace outlives it.
+UPLOAD_IDLE_TIMEOUT = float(os.environ.get('ORGANOID_UPLOAD_IDLE', '900'))
+MAX_UPLOAD_FILES = 10000
+PART_SUFFIX = '.part'
+WAIT_POLL = 0.5
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+WORKSPACE_ID = re.compile(r'^[0-9a-f]{16}-[0-9a-f]{8}$')
+
+class UploadError(ValueError):
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+# Incremental SHA-256 of each .part file received by this process: (upload id, file) -> (offset,
+# hasher). A file whose chunks went to several server processes is hashed from disk at the end.
+_hashers = {}
+_hashers_lock = threading.Lock()
+# Wakes analyses waiting on a file as soon as it completes here; other processes' files are
+# noticed by polling.
+_arrived = threading.Condition()
+
+def _declared_files(files):
+    if not isinstance(files, list) or not files:
+        raise UploadError("`files` must list the files to upload")
+    if len(files) > MAX_UPLOAD_FILES:
+        raise UploadError(f"At most {MAX_UPLOAD_FILES} files per upload")
+    declared = []
+    for f in files:
+        if not isinstance(f, dict):
+            raise UploadError(f"Each file must be an object with name, size and sha256: {f!r}")
+        name = str(f.get('name') or '')
+        size = f.get('size')
+        sha256 = str(f.get('sha256') or '').lower()
+        # bool is an int subclass; `"size": true` is not a size.
+        if not name or not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise UploadError(f"Each file needs a name and a positive size: {f}")
+        if not SHA256.match(sha256):
+            raise UploadError(f"Each file needs its SHA-256 as 64 hex digits: {name}")
+        declared.append({'name': name, 'size': size, 'sha256': sha256})
+    # Same day order as /analyze, which sorts the uploads by file name.
+    return sorted(declared, key=lambda f: f['name'])
+
+def create_upload(upload_root, files):
+    # Reserves a workspace for the declared files. Its id comes from their declared hashes, so it is
+    # known (and final) before any bytes arrive.
+    workspace = Workspace(upload_root)
+    try:
+        for i, f in enumerate(_declared_files(files)):
+            workspace.reserve(f['name'], i + 1, f['sha256'], f['size'])
+        workspace.finalize()
+    except Exception:
+        workspace.discard()
+        raise
+    return workspace
+
+class ChunkedUpload:
+    # The receiving side of an upload, rebuilt from the workspace manifest on every request so that
+    # any server process can take any chunk. Each file is appended to <day><ext>.part and renamed
+    # to its final name once its bytes hash to the declared SHA-256; a file that does not is reset.
+    def __init__(self, path, manifest):
+        self.path = path
+        self.id = manifest['id']
+        self.files = manifest['files']
+        self.job = manifest.get('job')
+
+    @classmethod
+    def load(cls, upload_root, upload_id):
+        if not WORKSPACE_ID.match(upload_id):
+            return None
+        path = os.path.join(upload_root, WORKSPACES_DIRNAME, upload_id)
+        try:
+            with open(os.path.join(path, MANIFEST_NAME)) as f:
+                return cls(path, json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def final_path(self, entry):
+        return os.path.join(self.path, entry['name'])
+
+    def received(self, entry):
+        final = self.final_path(entry)
+        if os.path.exists(final):
+            return entry['size']
+        try:
+            return os.path.getsize(final + PART_SUFFIX)
+        except OSError:
+            return 0
+
+    def file_state(self, index):
+        entry = self.files[index]
+        received = self.received(entry)
+        return {'file': index, 'name': entry['filename'], 'day': entry['day'], 'size': entry['size'],
+                'received': received, 'complete': os.path.exists(self.final_path(entry)),
+                'upload_url': f"/uploads/{self.id}/files/{index}"}
+
+    def state(self):
+        files = [self.file_state(i) for i in range(len(self.files))]
+        return {'upload': self.id, 'job': self.job, 'status_url': f"/analyze/{self.job}",
+                'files': files, 'complete': all(f['complete'] for f in files),
+                'received': sum(f['received'] for f in files), 'size': sum(f['size'] for f in files),
+                'chunk_size': UPLOAD_CHUNK_SIZE}
+
+    def _entry(self, index):
+        if not 0 <= index < len(self.files):
+            raise UploadError(f"Unknown file {index}", 404)
+        return self.files[index]
+
+    def write_chunk(self, index, offset, stream):
+        # Appends the request body at `offset`, which must be the number of bytes received so far
+        # (GET /uploads/<id> tells a client where to resume after a dropped connection).
+        entry = self._entry(index)
+        final = self.final_path(entry)
+        if os.path.exists(final):
+            return self.file_state(index)
+        part = final + PART_SUFFIX
+        received = self.received(entry)
+        if offset is not None and offset != received:
+            raise UploadError(f"Chunk starts at byte {offset}, expected {received}", 409, received=received)
+
+        key = (self.id, index)
+        with _hashers_lock:
+            known = _hashers.pop(key, None)
+        sha = known[1] if known is not None and known[0] == received else None
+        if sha is None and received == 0:
+            sha = hashlib.sha256()
+        try:
+            with open(part, 'ab') as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if received + len(chunk) > entry['size']:
+                        raise UploadError(f"More than the declared {entry['size']} bytes", 413,
+                                          received=received)
+                    out.write(chunk)
+                    if sha is not None:
+                        sha.update(chunk)
+                    received += len(chunk)
+        finally:
+            # Also after a dropped connection: the bytes that did arrive are kept and hashed.
+            if sha is not None and received < entry['size']:
+                with _hashers_lock:
+                    _hashers[key] = (received, sha)
+            self.heartbeat()
+
+        if received == entry['size']:
+            digest = sha.hexdigest() if sha is not None else file_digest(part)
+            if digest != entry['sha256']:
+                os.remove(part)
+                raise UploadError(f"SHA-256 of {entry['filename']} does not match; upload it again", 422,
+                                  received=0)
+            os.replace(part, final)
+            with _arrived:
+                _arrived.notify_all()
+        return self.file_state(index)
+
+    def heartbeat(self):
+        try:
+            os.utime(os.path.join(self.path, INFLIGHT_MARKER))
+        except OSError:
+            pass
+
+    def discard(self):
+        with _hashers_lock:
+            for key in [k for k in _hashers if k[0] == self.id]:
+                del _hashers[key]
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def idle_seconds(self):
+        try:
+            return time.time() - os.path.getmtime(os.path.join(self.path, INFLIGHT_MARKER))
+        except OSError:
+            return float('inf')
+
+def iter_uploaded(upload, cancel, origins=None, idle_timeout=UPLOAD_IDLE_TIMEOUT, **source_args):
+    # (day, source) pairs in /analyze's day order, each file as soon as it has arrived and been
+    # verified, so analysis overlaps the rest of the transfer. Stops when `cancel` is set, when the
+    # upload is deleted, or when no chunk arrives for `idle_timeout` seconds.
+    next_day = 1
+    for entry in upload.files:
+        path = upload.final_path(entry)
+        while not os.path.exists(path):
+            if cancel.is_set() or not os.path.isdir(upload.path):
+                return
+            if upload.idle_seconds() > idle_timeout:
+                print(f"Upload {upload.id} abandoned; analyzing only the files that arrived")
+                return
+            with _arrived:
+                _arrived.wait(WAIT_POLL)
+        for day, source in expand_sources({max(next_day, entry['day']): path}, origins=origins, **source_args):
+            yield day, source
+            next_day = day + 1
+
+def upload_params(body):
+    # (method, options, source_args, meta) from POST /uploads, with /analyze's form fields and defaults.
+    try:
+        method = body.get('method', 'basic')
+        options = {'circle_mode': body.get('circle_mode', 'full'), 'estimate_radius': bool(body.get('estimate_radius')),
+                   'output': body.get('output', 'image')}
+        source_args = {'step': max(1, int(body.get('frame_step') or 1)),
+                       'channel': None if body.get('channel') is None else int(body['channel']),
+                       'bit_depth': None if body.get('bit_depth') is None else int(body['bit_depth']),
+                       'zstack': bool(body.get('zstack')), 'projection': body.get('projection', 'max'),
+                       'z_scale': None if body.get('z_scale') is None else float(body['z_scale'])}
+    except (TypeError, ValueError) as e:
+        raise UploadError(f"Invalid analysis option: {e}")
+    meta = {'experiment': body.get('experiment'), 'well': body.get('well')}
+    options.update(roi_options(body.get('roi'), **meta))
+    return method, options, source_args, meta
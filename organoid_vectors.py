@@ -0,0 +1,111 @@
+import os
+
+import cv2
+import numpy as np
+
+OUTPUT_MODES = ('image', 'vector')
+POLYGON_EPSILON = 1.0
+BROWSER_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+def css_color(bgr):
+    # Clamped like OpenCV's drawing saturates colour values (morphology computes them).
+    b, g, r = (max(0, min(255, int(c))) for c in bgr[:3])
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def polygon(cnt, color=None, width=None):
+    # Contours are simplified with approxPolyDP (1 px tolerance); that typically drops 60-90% of
+    # the points of a CHAIN_APPROX_SIMPLE contour with no visible change.
+    points = cv2.approxPolyDP(cnt, POLYGON_EPSILON, True).reshape(-1, 2).tolist()
+    return _styled({'type': 'polygon', 'points': points}, color, width)
+
+def circle(x, y, r, color=None, width=None):
+    return _styled({'type': 'circle', 'x': int(x), 'y': int(y), 'r': int(r)}, color, width)
+
+def box(x, y, w, h, color=None, width=None):
+    return _styled({'type': 'box', 'x': int(x), 'y': int(y), 'w': int(w), 'h': int(h)}, color, width)
+
+def marker(x, y, size, color=None, width=None):
+    return _styled({'type': 'marker', 'x': int(x), 'y': int(y), 'size': int(size)}, color, width)
+
+def _styled(shape, color, width):
+    if color is not None:
+        shape['color'] = css_color(color)
+    if width is not None:
+        shape['width'] = int(width)
+    return shape
+
+class Overlay:
+    # What an analyzer draws for its debug output. In 'image' mode the calls draw on a copy of the
+    # image that save() JPEG-encodes, exactly as before; in 'vector' mode they only record
+    # geometry, which attach() puts in the result for the browser to draw over the original.
+    # Separately, measure()/measure_circle() record each counted object as the analyzer measured
+    # it; attach() returns those as `objects` in both modes (the results store keeps them).
+    def __init__(self, img, output='image', pool=None):
+        self.img = img
+        self.vector = output == 'vector'
+        self.shapes = []
+        self.objects = []
+        self.canvas = None
+        if not self.vector:
+            self.canvas = pool.copy_of('debug', img) if pool is not None else img.copy()
+
+    def contours(self, cnts, color, thickness=1):
+        if self.vector:
+            self.shapes.extend(polygon(c, color, thickness) for c in cnts)
+        else:
+            cv2.drawContours(self.canvas, cnts, -1, color, thickness)
+
+    def circle(self, center, radius, color, thickness=1):
+        if self.vector:
+            self.shapes.append(circle(center[0], center[1], radius, color, thickness))
+        else:
+            cv2.circle(self.canvas, center, radius, color, thickness)
+
+    def box(self, p1, p2, color, thickness=1):
+        if self.vector:
+            self.shapes.append(box(p1[0], p1[1], int(p2[0]) - int(p1[0]), int(p2[1]) - int(p1[1]), color, thickness))
+        else:
+            cv2.rectangle(self.canvas, p1, p2, color, thickness)
+
+    def marker(self, center, size, color, thickness=1):
+        x, y = center
+        if self.vector:
+            self.shapes.append(marker(x, y, size, color, thickness))
+        else:
+            cv2.line(self.canvas, (x - size, y), (x + size, y), color, thickness)
+            cv2.line(self.canvas, (x, y - size), (x, y + size), color, thickness)
+
+    def measure(self, cnt, area=None):
+        # An object outlined by `cnt`: centroid and bounding size of the contour, and the area the
+        # analyzer counted (a pixel count for label masks), or the contour's own area.
+        m = cv2.moments(cnt)
+        x, y, w, h = cv2.boundingRect(cnt)
+        cx, cy = (m['m10'] / m['m00'], m['m01'] / m['m00']) if m['m00'] else (x + w / 2, y + h / 2)
+        self.objects.append({'kind': 'polygon', 'x': float(cx), 'y': float(cy),
+                             'area': float(cv2.contourArea(cnt) if area is None else area),
+                             'width': float(w), 'height': float(h)})
+
+    def measure_circle(self, center, radius, kind='circle'):
+        # A detected circle, drawn as a circle or (AssayScope) its bounding box; its area is pi r^2.
+        r = float(radius)
+        self.objects.append({'kind': kind, 'x': float(center[0]), 'y': float(center[1]),
+                             'area': float(np.pi * r * r), 'width': 2 * r, 'height': 2 * r})
+
+    def save(self, debug_dir, name, source_path):
+        # Vector mode writes nothing when the browser can show the uploaded file itself; frames,
+        # TIFFs and other formats get a plain (un-annotated) JPEG to draw on instead.
+        if self.vector:
+            ext = os.path.splitext(source_path)[1].lower()
+            if os.path.exists(source_path) and ext in BROWSER_EXTENSIONS:
+                return
+            image = self.img
+        else:
+            image = self.canvas
+        os.makedirs(debug_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(debug_dir, name), image)
+
+    def attach(self, result):
+        if self.vector:
+            result['shapes'] = self.shapes
+        result['objects'] = self.objects
+        return result
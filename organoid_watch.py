@@ -0,0 +1,264 @@
+import os
+import queue
+import threading
+import time
+
+from organoid_dispatch import attach_urls, resolve_method
+from organoid_frames import VIDEO_EXTENSIONS, expand_sources
+from organoid_isolation import run_guarded
+from organoid_microscopy import TIFF_EXTENSIONS
+from organoid_resources import governor
+from organoid_workspace import Workspace
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+
+SETTLE_SECONDS = float(os.environ.get('ORGANOID_WATCH_SETTLE', '2'))
+POLL_INTERVAL = float(os.environ.get('ORGANOID_WATCH_POLL', '1'))
+HEARTBEAT_INTERVAL = 60
+# Notifications do not fire for every filesystem (network shares in particular), so the folder is
+# still rescanned this often when watchdog is in use.
+RESCAN_INTERVAL = 30
+MAX_ERRORS = 50
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp') + TIFF_EXTENSIONS + VIDEO_EXTENSIONS
+# Names acquisition software and copy tools use while a file is still being written.
+TEMP_PREFIXES = ('.', '~')
+TEMP_SUFFIXES = ('.tmp', '.part', '.partial', '.crdownload', '.filepart')
+
+def is_candidate(name):
+    name = os.path.basename(name).lower()
+    if name.startswith(TEMP_PREFIXES) or name.endswith(TEMP_SUFFIXES):
+        return False
+    return os.path.splitext(name)[1] in IMAGE_EXTENSIONS
+
+def _readable(path):
+    # On Windows a writer usually holds the file open exclusively; opening it is the final check.
+    try:
+        with open(path, 'rb') as f:
+            f.read(1)
+        return True
+    except OSError:
+        return False
+
+if WATCHDOG_AVAILABLE:
+    class _ChangeHandler(FileSystemEventHandler):
+        def __init__(self, watcher):
+            super().__init__()
+            self.watcher = watcher
+
+        def on_any_event(self, event):
+            if not event.is_directory:
+                self.watcher.notice(getattr(event, 'dest_path', None) or event.src_path)
+
+class FolderWatcher:
+    # Watches one acquisition folder and analyzes each new image once it has stopped changing.
+    # Change notification comes from watchdog (inotify/FSEvents/ReadDirectoryChangesW) when it is
+    # installed, otherwise from a scandir poll that only stats directory entries. A file is ready
+    # once its size and mtime have been unchanged for settle_seconds and it can be opened. Ready
+    # files go to a single worker thread, and their results are appended to one long-lived
+    # workspace as consecutive days.
+    def __init__(self, folder, method, upload_root, options=None, source_args=None, include_existing=False,
+                 settle_seconds=SETTLE_SECONDS, poll_interval=POLL_INTERVAL, store=None, meta=None):
+        if not os.path.isdir(folder):
+            raise ValueError(f"Not a directory: {folder}")
+        self.folder = os.path.abspath(folder)
+        self.method = resolve_method(method)
+        self.options = dict(options or {})
+        self.source_args = dict(source_args or {})
+        self.include_existing = include_existing
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.backend = 'watchdog' if WATCHDOG_AVAILABLE else 'polling'
+        self.store = store
+        self.meta = meta or {}
+
+        self.workspace = Workspace(upload_root)
+        self.workspace.finalize()
+        self.results = []
+        self.errors = []
+        self.detected = 0
+        self.processed = 0
+        self.failed = 0
+        self.next_day = 1
+        self.started = None
+        self.current = None
+
+        self._pending = {}
+        self._known = set()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._threads = []
+
+    def notice(self, path):
+        # Called for every change (watchdog thread or poll); only records the file's signature.
+        if not is_candidate(path):
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._pending.pop(path, None)
+            return
+        signature = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if path in self._known:
+                return
+            previous = self._pending.get(path)
+            if previous is None:
+                self.detected += 1
+            if previous is None or previous[0] != signature:
+                self._pending[path] = (signature, time.monotonic())
+
+    def _scan(self):
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if entry.is_file() and entry.path not in self._known:
+                        self.notice(entry.path)
+        except OSError as e:
+            self._error(None, f"Cannot read {self.folder}: {e}")
+
+    def _settle(self):
+        now = time.monotonic()
+        with self._lock:
+            pending = list(self._pending.items())
+        ready = []
+        for path, (signature, since) in pending:
+            try:
+                st = os.stat(path)
+            except OSError:
+                with self._lock:
+                    self._pending.pop(path, None)
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != signature:
+                with self._lock:
+                    self._pending[path] = (current, now)
+            elif st.st_size > 0 and now - since >= self.settle_seconds and _readable(path):
+                ready.append((st.st_mtime_ns, path))
+        for _, path in sorted(ready):
+            with self._lock:
+                self._pending.pop(path, None)
+                self._known.add(path)
+            self._queue.put(path)
+
+    def _watch_loop(self):
+        last_beat = last_scan = time.monotonic()
+        while not self._stop.wait(self.poll_interval):
+            if self._observer is None or time.monotonic() - last_scan >= RESCAN_INTERVAL:
+                self._scan()
+                last_scan = time.monotonic()
+            self._settle()
+            if time.monotonic() - last_beat >= HEARTBEAT_INTERVAL:
+                self.workspace.heartbeat()
+                last_beat = time.monotonic()
+
+    def _work_loop(self):
+        try:
+            while True:
+                path = self._queue.get()
+                if path is None or self._stop.is_set():
+                    break
+                self._process(path)
+        finally:
+            self.workspace.release()
+
+    def _process(self, path):
+        name = os.path.basename(path)
+        day = self.next_day
+        self.current = name
+        try:
+            entry = self.workspace.add_file(path, day)
+            stored = os.path.join(self.workspace.path, entry['name'])
+            origins = {}
+            sources = expand_sources({day: stored}, origins=origins, **self.source_args)
+            with governor.request_slot() as threads:
+                results, images = run_guarded(self.method, sources, self.options, threads=threads,
+                                              cancel=self._stop)
+            failures = [i for i in images if 'error' in i]
+            if not results:
+                raise RuntimeError(failures[0]['error'] if failures else "No readable image")
+            for image in failures:
+                # Frames of a stack that failed while the rest were analyzed.
+                self._error(name, f"day {image['day']}: {image['error']}")
+            for res in results:
+                res['source'] = name
+                attach_urls(res, self.method, self.workspace, origins)
+            if self.store is not None:
+                self.store.record(self.workspace.id, self.method, results, images, origin='watch', **self.meta)
+            with self._lock:
+                self.results.extend(results)
+                self.processed += 1
+            self.next_day = max([day] + [i['day'] for i in images]) + 1
+        except Exception as e:
+            self.next_day = day + 1
+            with self._lock:
+                self.failed += 1
+            self._error(name, str(e))
+        finally:
+            self.current = None
+
+    def _error(self, name, message):
+        print(f"Watch Error ({name or self.folder}): {message}")
+        with self._lock:
+            self.errors.append({'file': name, 'error': message, 'time': time.time()})
+            del self.errors[:-MAX_ERRORS]
+
+    def start(self):
+        if self.include_existing:
+            self._scan()
+        else:
+            with os.scandir(self.folder) as it:
+                self._known.update(e.path for e in it if e.is_file() and is_candidate(e.name))
+        if WATCHDOG_AVAILABLE:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_ChangeHandler(self), self.folder, recursive=False)
+                self._observer.start()
+            except Exception as e:
+                print(f"File notifications unavailable ({e}); polling {self.folder} instead.")
+                self._observer = None
+                self.backend = 'polling'
+        self.started = time.time()
+        for target, name in ((self._watch_loop, 'organoid-watch'), (self._work_loop, 'organoid-watch-worker')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        # Files already queued are dropped; the one being analyzed finishes in the background.
+        self._stop.set()
+        self._queue.put(None)
+        if self._observer is not None:
+            self._observer.stop()
+
+    @property
+    def running(self):
+        return self.started is not None and not self._stop.is_set()
+
+    def status(self, since=0):
+        with self._lock:
+            return {
+                'running': self.running,
+                'folder': self.folder,
+                'method': self.method,
+                'backend': self.backend,
+                'workspace': self.workspace.id,
+                'detected': self.detected,
+                'pending': len(self._pending),
+                'queued': self._queue.qsize(),
+                'current': self.current,
+                'processed': self.processed,
+                'failed': self.failed,
+                'errors': self.errors[-10:],
+                'total': len(self.results),
+                'results': self.results[max(0, since):],
+            }
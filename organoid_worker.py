@@ -0,0 +1,81 @@
+import argparse
+import os
+import signal
+import sys
+import threading
+
+from organoid_isolation import ISOLATION, pool
+from organoid_queue import QUEUE_URL, open_queue, run_task, worker_name
+
+IDLE_POLL = 0.2
+
+# Standalone analysis worker for ORGANOID_ISOLATION=queue. Start any number of them, on any node
+# that can reach the queue, to add capacity without touching the web tier:
+#   python organoid_worker.py --queue sqlite:///data/queue.sqlite --concurrency 2
+# Each consumer thread claims one image at a time and analyzes it in a pooled subprocess that is
+# killed at the image's deadline, so a crash costs that image, not the worker. SIGTERM or Ctrl+C
+# hands the images in progress back to the queue.
+
+def consume(backend, name, isolation, threads, stop, counts, lock):
+    while not stop.is_set():
+        try:
+            task = backend.claim(name)
+        except Exception as e:
+            print(f"Could not claim a task: {e}")
+            stop.wait(IDLE_POLL * 10)
+            continue
+        if task is None:
+            stop.wait(IDLE_POLL)
+            continue
+        task_id, meta, data = task
+        try:
+            status = run_task(backend, task_id, meta, data, name, isolation, threads, stop)
+        except Exception as e:
+            print(f"Task {task_id} failed in the worker: {type(e).__name__}: {e}")
+            backend.finish(task_id, {'status': 'error', 'error': f"{type(e).__name__}: {e}", 'worker': name})
+            status = 'error'
+        with lock:
+            counts[status] = counts.get(status, 0) + 1
+        print(f"{meta['method']} day {meta['day']}: {status}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consume analysis tasks from the shared queue.")
+    parser.add_argument('--queue', default=QUEUE_URL, help="queue URL (default: $ORGANOID_QUEUE)")
+    parser.add_argument('--concurrency', type=int, default=1, help="images analyzed at once")
+    parser.add_argument('--threads', type=int, help="OpenCV threads per image (default: cores / concurrency)")
+    parser.add_argument('--isolation', choices=('process', 'inline'),
+                        default=ISOLATION if ISOLATION in ('process', 'inline') else 'process')
+    parser.add_argument('--name', default=worker_name())
+    args = parser.parse_args(argv)
+    if not args.queue:
+        parser.error("no queue given (--queue or ORGANOID_QUEUE)")
+
+    backend = open_queue(args.queue)
+    concurrency = max(1, args.concurrency)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // concurrency)
+    pool.max_idle = max(pool.max_idle, concurrency)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    counts = {}
+    lock = threading.Lock()
+    consumers = [threading.Thread(target=consume, args=(backend, f"{args.name}/{i}", args.isolation, threads,
+                                                        stop, counts, lock), daemon=True)
+                 for i in range(concurrency)]
+    print(f"Worker {args.name}: {concurrency} x {threads} threads, {args.isolation} isolation, queue {args.queue}")
+    for consumer in consumers:
+        consumer.start()
+    try:
+        while any(c.is_alive() for c in consumers):
+            for consumer in consumers:
+                consumer.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for consumer in consumers:
+            consumer.join()
+    pool.shutdown()
+    print(f"Worker {args.name} stopped: {counts}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
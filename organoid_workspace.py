@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from werkzeug.utils import secure_filename
+
+WORKSPACES_DIRNAME = 'jobs'
+MANIFEST_NAME = 'manifest.json'
+INFLIGHT_MARKER = '.inflight'
+CHUNK_SIZE = 1024 * 1024
+VERSION_LENGTH = 12
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class Workspace:
+    # Each request gets its own directory under <upload_root>/jobs named after the SHA-256 of its
+    # inputs plus a per-request nonce, so identical uploads are recognisable but never share files.
+    def __init__(self, upload_root, url_prefix='/static/uploads'):
+        self.upload_root = upload_root
+        self.url_prefix = url_prefix.rstrip('/')
+        self.root = os.path.join(upload_root, WORKSPACES_DIRNAME)
+        self.nonce = uuid.uuid4().hex[:8]
+        self.id = None
+        self.digest = None
+        self.path = os.path.join(self.root, f".staging-{self.nonce}")
+        self.files = []
+        self.created = time.time()
+        os.makedirs(self.path)
+        open(os.path.join(self.path, INFLIGHT_MARKER), 'w').close()
+
+    def save_upload(self, file_storage, day):
+        return self._store(file_storage.stream, file_storage.filename or '', day)
+
+    def add_file(self, path, day):
+        # Copies a file from disk (e.g. a watched acquisition folder) in as the given day.
+        with open(path, 'rb') as src:
+            entry = self._store(src, os.path.basename(path), day)
+        if self.id is not None:
+            self.write_manifest()
+        return entry
+
+    def _store(self, stream, filename, day):
+        ext = os.path.splitext(secure_filename(filename))[1].lower() or '.jpg'
+        dest = os.path.join(self.path, f"day{day}{ext}")
+
+        sha = hashlib.sha256()
+        size = 0
+        with open(dest, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+        entry = {'day': day, 'filename': filename, 'sha256': sha.hexdigest(), 'size': size,
+                 'name': os.path.basename(dest)}
+        self.files.append(entry)
+        return entry
+
+    def reserve(self, filename, day, sha256, size):
+        # Declares a file that arrives later in chunks (organoid_uploads); its declared hash counts
+        # towards the workspace id, and the bytes are verified against it on arrival.
+        ext = os.path.splitext(secure_filename(filename))[1].lower() or '.jpg'
+        entry = {'day': day, 'filename': filename, 'sha256': sha256, 'size': size, 'name': f"day{day}{ext}"}
+        self.files.append(entry)
+        return entry
+
+    def finalize(self):
+        combined = hashlib.sha256()
+        for entry in sorted(self.files, key=lambda e: e['day']):
+            combined.update(entry['sha256'].encode())
+        self.digest = combined.hexdigest()
+        self.id = f"{self.digest[:16]}-{self.nonce}"
+
+        final_path = os.path.join(self.root, self.id)
+        os.rename(self.path, final_path)
+        self.path = final_path
+
+        self.write_manifest()
+        return self
+
+    def write_manifest(self, **extra):
+        manifest = {'id': self.id, 'digest': self.digest, 'created': self.created, 'files': self.files}
+        manifest.update(extra)
+        tmp = os.path.join(self.path, f".{MANIFEST_NAME}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, MANIFEST_NAME))
+
+    def image_map(self):
+        return {e['day']: os.path.join(self.path, e['name']) for e in self.files}
+
+    def url_for(self, path):
+        # URLs carry a digest of the file's bytes (?v=...), so browsers may cache them as immutable.
+        rel = os.path.relpath(path, self.upload_root).replace(os.sep, '/')
+        return f"{self.url_prefix}/{rel}?v={self.version_of(path)}"
+
+    def version_of(self, path):
+        # Uploads were hashed while saving; generated files (overlays, frames) are hashed here.
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.path):
+            name = os.path.basename(path)
+            for entry in self.files:
+                if entry['name'] == name:
+                    return entry['sha256'][:VERSION_LENGTH]
+        return file_digest(path)[:VERSION_LENGTH]
+
+    def heartbeat(self):
+        # Long-lived workspaces refresh the in-flight marker so retention does not treat it as stale.
+        try:
+            os.utime(os.path.join(self.path, INFLIGHT_MARKER))
+        except OSError:
+            pass
+
+    def release(self):
+        try:
+            os.remove(os.path.join(self.path, INFLIGHT_MARKER))
+        except OSError:
+            pass
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
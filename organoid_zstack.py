@@ -0,0 +1,159 @@
+import cv2
+import numpy as np
+
+from organoid_frames import Frame, iter_images, to_bgr8
+from organoid_microscopy import MicroscopyImage, to_uint8
+
+PROJECTIONS = ('max', 'efi')
+FOCUS_WINDOW = 9
+
+def _gray_slice(plane, bit_depth):
+    img = to_uint8(plane, bit_depth)
+    if img.ndim == 3:
+        code = cv2.COLOR_RGBA2GRAY if img.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+        img = cv2.cvtColor(np.ascontiguousarray(img), code)
+    return np.ascontiguousarray(img)
+
+def _focus(gray, out=None):
+    # Local sharpness: |Laplacian| of the lightly blurred slice, averaged over a small window so the
+    # extended-focus selection does not flicker pixel to pixel.
+    lap = cv2.Laplacian(cv2.GaussianBlur(gray, (3, 3), 0), cv2.CV_32F, ksize=3)
+    cv2.absdiff(lap, 0, dst=lap)
+    return cv2.blur(lap, (FOCUS_WINDOW, FOCUS_WINDOW), dst=out)
+
+class ZStack(Frame):
+    # One timepoint of a z-stack. Slices are read from the (memory-mapped) file one at a time, so
+    # neither the projection nor the voxel count ever holds more than a slice plus 2D accumulators.
+    def __init__(self, path, index=None, z_axis='z', channel=None, bit_depth=None, projection='max',
+                 z_scale=None, day_index=0):
+        super().__init__(None, f"{path}#{day_index}", day_index)
+        self.source = path
+        self.fixed = dict(index or {})
+        self.z_axis = z_axis
+        self.channel = channel
+        self.bit_depth = bit_depth
+        self.projection = projection if projection in PROJECTIONS else 'max'
+        self.z_scale = z_scale
+        self.physical_size = {}
+        self.slices = 0
+
+    def iter_slices(self):
+        # Every slice is scaled with the file's one bit depth, so a dim slice stays dim and the
+        # projection's threshold means the same on each slice in voxel_volumes.
+        with MicroscopyImage(self.source) as stack:
+            if not self.bit_depth:
+                self.bit_depth = stack.scale_depth(self.channel)
+            depth = self.bit_depth
+            self.physical_size = stack.physical_size
+            if self.z_scale is None:
+                size = stack.physical_size
+                self.z_scale = size['z'] / size['x'] if size.get('z') and size.get('x') else 1.0
+            n = stack.shape[stack.axes.index(self.z_axis.upper())]
+            for z in range(n):
+                index = dict(self.fixed, **{self.z_axis: z})
+                yield _gray_slice(stack.read(channel=self.channel, **index), depth)
+
+    def load(self):
+        if self.image is None:
+            self.image = to_bgr8(self.project())
+        return self.image
+
+    def project(self):
+        proj = None
+        best = None
+        count = 0
+        for gray in self.iter_slices():
+            count += 1
+            if proj is None:
+                proj = gray.copy()
+                if self.projection == 'efi':
+                    best = _focus(gray)
+                    sharp = np.empty_like(best)
+                    take = np.empty(gray.shape, np.bool_)
+                continue
+            if self.projection == 'max':
+                np.maximum(proj, gray, out=proj)
+            else:
+                _focus(gray, out=sharp)
+                np.greater(sharp, best, out=take)
+                np.copyto(proj, gray, where=take)
+                np.maximum(best, sharp, out=best)
+        self.slices = count
+        return proj
+
+    def voxel_volumes(self, labels, threshold, inverted=False):
+        # Second streaming pass: per slice, pixels on the object side of `threshold` inside each
+        # label are counted as voxels. Returns voxel counts per label value (index = label) scaled
+        # by z_scale, i.e. in xy-pixel^3 like the spherical estimate.
+        flat = labels.ravel()
+        offset = int(min(0, flat.min()))
+        index = flat - offset if offset else flat
+        n = int(flat.max()) - offset + 1
+        counts = np.zeros(n, np.float64)
+        fg = np.empty(labels.shape, np.uint8)
+        for gray in self.iter_slices():
+            blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=gray)
+            mode = cv2.THRESH_BINARY_INV if inverted else cv2.THRESH_BINARY
+            cv2.threshold(blurred, threshold, 1, mode, dst=fg)
+            counts += np.bincount(index, weights=fg.ravel(), minlength=n)
+        counts *= self.z_scale
+        return counts, offset
+
+    def voxel_size_um3(self):
+        size = self.physical_size
+        if size.get('x') and size.get('y') and size.get('z'):
+            return size['x'] * size['y'] * size['z']
+        return None
+
+def projection_threshold(proj_gray):
+    # The Otsu threshold of the projection, and whether objects are darker than the background
+    # (same polarity rule as the 2D analyzers).
+    blurred = cv2.GaussianBlur(proj_gray, (5, 5), 0)
+    thr, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return thr, cv2.countNonZero(binary) > binary.size / 2
+
+def open_zstacks(path, channel=None, bit_depth=None, projection='max', z_scale=None, start_day=1):
+    # One ZStack per non-z position (normally time). The z axis is 'Z' if the file declares one,
+    # otherwise the only non-spatial axis (ImageJ/plain multi-page TIFFs).
+    with MicroscopyImage(path) as stack:
+        axes = stack.plane_axes
+        shape = stack.plane_shape
+        # Inferred once for the file, so all timepoints share it too.
+        bit_depth = bit_depth or stack.scale_depth(channel)
+    z_axis = 'z' if 'Z' in axes else (axes[0].lower() if axes else None)
+    if z_axis is None:
+        return
+    others = [(a.lower(), n) for a, n in zip(axes, shape) if a.lower() != z_axis]
+    positions = int(np.prod([n for _, n in others])) if others else 1
+    for i in range(positions):
+        coords = np.unravel_index(i, [n for _, n in others]) if others else ()
+        index = {name: int(c) for (name, _), c in zip(others, coords)}
+        yield start_day + i, ZStack(path, index, z_axis, channel=channel, bit_depth=bit_depth,
+                                    projection=projection, z_scale=z_scale, day_index=i)
+
+def iter_stacks(image_paths):
+    # iter_images() plus the ZStack each image was projected from (None for ordinary images).
+    items = image_paths.items() if hasattr(image_paths, 'items') else image_paths
+    for day, source in items:
+        stack = source if isinstance(source, ZStack) else None
+        for image_day, img_path, img in iter_images([(day, source)]):
+            yield image_day, img_path, img, stack
+
+def volume_report(stack, labels, proj_gray, object_labels, spherical):
+    # Per-object voxel volumes next to the spherical estimates, in the analyzers' pixel units.
+    thr, inverted = projection_threshold(proj_gray)
+    counts, offset = stack.voxel_volumes(labels, thr, inverted)
+    voxel = [float(counts[int(label) - offset]) for label in object_labels]
+    report = {
+        "z_slices": int(stack.slices),
+        "projection": stack.projection,
+        "z_scale": float(stack.z_scale),
+        "voxel_volume": float(sum(voxel)),
+        "avg_voxel_volume": float(np.mean(voxel)) if voxel else 0.0,
+        "volumes": [{"spherical": float(s), "voxel": v} for s, v in zip(spherical, voxel)],
+    }
+    um3 = stack.voxel_size_um3()
+    if um3:
+        # Counts are in xy-pixel cubes; undo z_scale to get voxels, then multiply by dx*dy*dz.
+        report["voxel_volume_um3"] = float(sum(voxel) * um3 / stack.z_scale)
+    return report
@@ -3,14 +3,17 @@
 # Use this for deployment or when you want multiple workers and no debug mode.
 
 PORT="${PORT:-5174}"
-WORKERS="${WORKERS:-2}"
+# Exported so each worker sizes its thread and memory budgets for $WORKERS processes.
+export WORKERS="${WORKERS:-2}"
+export THREADS="${THREADS:-4}"
 
 echo "Starting Organoid Analysis (Gunicorn)..."
 echo "  Port: $PORT"
 echo "  Workers: $WORKERS"
+echo "  Threads: $THREADS"
 echo "  URL: http://0.0.0.0:$PORT"
 echo "  Press Ctrl+C to stop"
 echo ""
 
 cd "$(dirname "$0")"
-exec gunicorn -w "$WORKERS" -b "0.0.0.0:$PORT" --timeout 300 "app:app"
+exec gunicorn -w "$WORKERS" --threads "$THREADS" -b "0.0.0.0:$PORT" --timeout 300 "app:app"